@@ -17,7 +17,9 @@ from crossmap.settings import CrossmapSettings
 from crossmap.crossmap import Crossmap, validate_dataset_label
 from crossmap.crossmap import remove_db_and_files
 from crossmap.info import CrossmapInfo
-from crossmap.tools import concise_exception_handler, json_print, tsv_print
+from crossmap.benchmark import CrossmapBenchmark
+from crossmap.tools import concise_exception_handler
+from crossmap.tools import json_print, jsonl_print, tsv_print
 
 # this is a command line utility
 if __name__ != "__main__":
@@ -36,7 +38,8 @@ parser.add_argument("action", action="store",
                              "add", "remove",
                              "server", "gui",
                              "distances", "vectors", "matrix", "counts",
-                             "diffuse", "features", "summary"])
+                             "diffuse", "features", "summary",
+                             "benchmark-index"])
 parser.add_argument("--config", action="store",
                     help="configuration file",
                     default=None)
@@ -57,10 +60,29 @@ parser.add_argument("--diffusion", action="store",
 parser.add_argument("--factors", action="store",
                     default=None,
                     help="comma-separated ids for decomposition")
+parser.add_argument("--workers", action="store",
+                    type=int, default=1,
+                    help="number of worker processes for batch processing")
 parser.add_argument("--pretty", action="store_true",
                     help="pretty-print JSON outputs for human readability")
 parser.add_argument("--tsv", action="store_true",
                     help="output results in a table format")
+parser.add_argument("--jsonl", action="store_true",
+                    help="output results as they are produced, one per line")
+
+# benchmarking of indexing parameters
+parser.add_argument("--build_quality", action="store",
+                    default=None,
+                    help="comma-separated values for efConstruction")
+parser.add_argument("--search_quality", action="store",
+                    default=None,
+                    help="comma-separated values for efSearch")
+parser.add_argument("--methods", action="store",
+                    default=None,
+                    help="comma-separated indexing methods")
+parser.add_argument("--sample", action="store",
+                    type=int, default=100,
+                    help="number of dataset items to use as queries")
 
 # manual investigation/debugging
 parser.add_argument("--ids", action="store",
@@ -95,8 +117,10 @@ action = config.action
 if config.logging is not None:
     logging.getLogger().setLevel(config.logging)
 
-# output as json or tsv
+# output as json, tsv, or json lines
 output = tsv_print if config.tsv else json_print
+if config.jsonl:
+    output = jsonl_print
 
 # for build, settings check all data files are available
 # for other actions, the settings can be lenient
@@ -113,6 +137,8 @@ if action in {"build", "search", "decompose", "add", "remove"}:
 if action in {"features", "diffuse", "distances", "matrix",
               "counts", "summary"}:
     crossmap = CrossmapInfo(settings)
+if action == "benchmark-index":
+    crossmap = CrossmapBenchmark(settings)
 
 
 # ############################################################################
@@ -133,11 +159,14 @@ if action in {"search", "decompose"}:
         sys.exit()
     factors = None if config.factors is None else config.factors.split(",")
     if config.text is None:
-        action_fun = crossmap.search_file
+        action_fun = crossmap.search_file_iter
         if action == "decompose":
-            action_fun = crossmap.decompose_file
+            action_fun = crossmap.decompose_file_iter
         result = action_fun(config.data, config.dataset, n=config.n,
-                            diffusion=config.diffusion, factors=factors)
+                            diffusion=config.diffusion, factors=factors,
+                            workers=config.workers)
+        if not config.jsonl:
+            result = list(result)
     else:
         action_fun = crossmap.search
         if action == "decompose":
@@ -193,6 +222,27 @@ if action in {"features", "summary"}:
     output(action_fun(), pretty=config.pretty)
 
 
+# ############################################################################
+# actions associated with tuning performance
+
+if action == "benchmark-index":
+    config.dataset = validate_dataset_label(crossmap, config.dataset)
+    if config.dataset is None:
+        sys.exit()
+    qualities = [config.build_quality, config.search_quality]
+    qualities = [None if _ is None else [int(q) for q in _.split(",")]
+                 for _ in qualities]
+    methods = None if config.methods is None else config.methods.split(",")
+    result = crossmap.benchmark_index(config.dataset, n=config.n,
+                                      build_qualities=qualities[0],
+                                      search_qualities=qualities[1],
+                                      filepath=config.data,
+                                      sample=config.sample,
+                                      diffusion=config.diffusion,
+                                      methods=methods)
+    output(result, pretty=config.pretty)
+
+
 # ############################################################################
 # actions associated with the user interface
 
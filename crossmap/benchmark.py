@@ -0,0 +1,200 @@
+"""
+Add-on class to measure recall and latency of nearest-neighbor indexes
+"""
+
+from itertools import product
+from math import ceil
+from os import listdir
+from os.path import getsize, join
+from random import Random
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from logging import info
+from numpy import argsort, array, percentile
+from scipy.sparse import vstack
+from .distance import sparse_euc_distances
+from .tools import open_file, yaml_document
+from .crossmap import Crossmap
+
+
+# tolerance for comparing approximate and exact distances
+distance_tolerance = 1e-5
+
+
+class CrossmapBenchmark(Crossmap):
+
+    def __init__(self, settings):
+        """start up an existing crossmap project for benchmarking
+
+        :param settings: a CrossmapSettings object
+        """
+
+        super().__init__(settings)
+        self.load()
+
+    def _dataset_matrix(self, dataset):
+        """collect all data vectors for a dataset
+
+        :param dataset: string, name of dataset
+        :return: list of integer indexes, csr matrix with one row per item
+        """
+
+        idxs, items = [], []
+        for row in self.db.all_data(dataset):
+            idxs.append(row["idx"])
+            items.append(row["data"])
+        if len(items) == 0:
+            raise Exception("dataset has no items: " + str(dataset))
+        return idxs, vstack(items, format="csr")
+
+    def queries(self, dataset, filepath=None, sample=100, diffusion=None,
+                seed=0):
+        """prepare query vectors for benchmarking
+
+        :param dataset: string, name of dataset
+        :param filepath: string, path to a data file with queries; when None,
+            queries are sampled from the dataset
+        :param sample: integer, number of items to sample from the dataset
+        :param diffusion: dict, map assigning diffusion weights
+        :param seed: integer, seed for random sampling
+        :return: csr matrix with one row per query
+        """
+
+        vectors = []
+        if filepath is not None:
+            with open_file(filepath, "rt") as f:
+                for id, doc in yaml_document(f):
+                    raw, diffused = self._prep_vector(doc, diffusion)
+                    if len(raw.data) > 0:
+                        vectors.append(diffused)
+        else:
+            size = self.db.dataset_size(dataset)
+            idxs = Random(seed).sample(range(size), min(sample, size))
+            for row in self.db.get_data(dataset, idxs=idxs):
+                v = row["data"]
+                if diffusion is not None:
+                    v = self.diffuser.diffuse(v, diffusion)
+                vectors.append(v)
+        if len(vectors) == 0:
+            raise Exception("no queries available for benchmarking")
+        return vstack(vectors, format="csr")
+
+    def benchmark_index(self, dataset, n=10, build_qualities=None,
+                        search_qualities=None, filepath=None, sample=100,
+                        diffusion=None, methods=None):
+        """measure recall and latency for several index parameters
+
+        :param dataset: string, name of dataset
+        :param n: integer, number of nearest neighbors
+        :param build_qualities: list of integers, values for efConstruction
+        :param search_qualities: list of integers, values for efSearch
+        :param filepath: string, path to a data file with queries
+        :param sample: integer, number of queries sampled from the dataset
+            (used only when filepath is None)
+        :param diffusion: dict, map assigning diffusion weights
+        :param methods: list of strings, indexing methods
+        :return: list of dicts, one for each combination of parameters
+        """
+
+        indexing = self.settings.indexing
+        if methods is None:
+            methods = ["hnsw"]
+        if build_qualities is None:
+            build_qualities = [indexing.build_quality]
+        if search_qualities is None:
+            search_qualities = [indexing.search_quality]
+        idxs, data = self._dataset_matrix(dataset)
+        vs = self.queries(dataset, filepath, sample, diffusion)
+        info("Computing exact neighbors: " + str(vs.shape[0]) + " queries")
+        exact = exact_neighbors(vs, data, idxs, n,
+                                batch_size=self.settings.logging.progress)
+
+        result = []
+        for method, build_quality in product(methods, build_qualities):
+            info("Building index: " + method +
+                 ", efConstruction=" + str(build_quality))
+            index = self.indexer._method_index(method)
+            index.addDataPointBatch(data, idxs)
+            start = perf_counter()
+            index.createIndex(index_params={"efConstruction": build_quality},
+                              print_progress=False)
+            build_time = perf_counter() - start
+            index_size = _index_size(index)
+            for search_quality in search_qualities:
+                index.setQueryTimeParams({"efSearch": search_quality})
+                recall, latencies = _query_stats(index, vs, exact, n)
+                p50, p95, p99 = percentile(latencies, [50, 95, 99])
+                result.append(dict(dataset=dataset, method=method, n=n,
+                                   queries=vs.shape[0],
+                                   build_quality=build_quality,
+                                   search_quality=search_quality,
+                                   recall=round(recall, 6),
+                                   latency_p50=float(p50),
+                                   latency_p95=float(p95),
+                                   latency_p99=float(p99),
+                                   build_time=build_time,
+                                   index_size=index_size))
+        return result
+
+
+def exact_neighbors(vs, data, idxs, n, batch_size=10000):
+    """find nearest neighbors by scanning all data items
+
+    :param vs: csr matrix, one row per query
+    :param data: csr matrix, one row per data item
+    :param idxs: list of integer indexes for the data items
+    :param n: integer, number of nearest neighbors
+    :param batch_size: integer, number of data items to process at once
+    :return: list with one tuple per query, each holding a list of
+        integer indexes and a list of l2 distances
+    """
+
+    candidates = [([], []) for _ in range(vs.shape[0])]
+    for i in range(ceil(data.shape[0] / batch_size)):
+        start, end = i * batch_size, min((i + 1) * batch_size, data.shape[0])
+        distances = sparse_euc_distances(vs, data[start:end])
+        for j, row in enumerate(distances):
+            top = argsort(row, kind="stable")[:n]
+            old_idxs, old_distances = candidates[j]
+            merged = sorted(zip(old_distances + [float(row[_]) for _ in top],
+                                old_idxs + [idxs[start + _] for _ in top]))
+            merged = merged[:n]
+            candidates[j] = ([_[1] for _ in merged], [_[0] for _ in merged])
+    return candidates
+
+
+def _query_stats(index, vs, exact, n):
+    """time individual queries and compare their results to exact neighbors
+
+    Approximate hits count as correct when their distance does not exceed
+    the n-th exact distance, so that ties among exact neighbors do not
+    affect recall.
+
+    :param index: nmslib index
+    :param vs: csr matrix, one row per query
+    :param exact: list of tuples, output from exact_neighbors
+    :param n: integer, number of nearest neighbors
+    :return: average recall, list of latencies in milliseconds
+    """
+
+    hits, total, latencies = 0, 0, []
+    for i in range(vs.shape[0]):
+        start = perf_counter()
+        nns, distances = index.knnQueryBatch(vs[i], n, num_threads=1)[0]
+        latencies.append(1000 * (perf_counter() - start))
+        exact_distances = exact[i][1]
+        if len(exact_distances) == 0:
+            continue
+        threshold = exact_distances[-1] + distance_tolerance
+        hits += int(sum(array(distances) <= threshold))
+        total += len(exact_distances)
+    recall = hits / total if total > 0 else 1.0
+    return recall, latencies
+
+
+def _index_size(index):
+    """measure the size of an index written to disk, in bytes"""
+
+    with TemporaryDirectory() as tmp_dir:
+        index.saveIndex(join(tmp_dir, "index"), save_data=True)
+        return sum([getsize(join(tmp_dir, _)) for _ in listdir(tmp_dir)])
@@ -1,15 +1,21 @@
 """
-A simple cache object that uses a pair of integers as keys.
+A simple cache object that uses a pair of integers as keys,
+and a cache for complete query results.
 
-Values in the cache are deep-copied during get() and set().
+Values in the caches are copied during get() and set().
 This means the output can be adjusted in-place without corrupting the cache.
+(Copies can be skipped for values that are only read.)
 """
 
 # For a reason I don't understand "from copy import deepcopy" does not permit
 # using deepcopy as a function...
 # To get around that, deepcopy is given an alias as "safecopy"
 from copy import deepcopy as safecopy
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps, loads
 from math import floor
+from threading import Event, Lock
 from time import time
 
 
@@ -30,28 +36,43 @@ class CrossmapCache:
         for i in range(num_items):
             self._cache.pop(time_keys[i][1])
 
-    def set(self, k1, k2, data):
+    def set(self, k1, k2, data, copy=True):
         """set the contents of a cache
 
         :param k1: integer, first identifier
         :param k2: integer, second identifier
         :param data: any data object
+        :param copy: logical, set False to store data without a copy
+            (only for data that will not be modified)
         """
 
         if len(self._cache) >= self.max_size:
             self._make_space(floor(self.max_size/8))
-        self._cache[(k1, k2)] = (time(), safecopy(data))
+        self._cache[(k1, k2)] = (time(), safecopy(data) if copy else data)
 
     def clear(self):
         """remove all content from the cache"""
 
         self._cache = dict()
 
-    def get(self, k1, k2s):
+    def remove(self, k1, k2s):
+        """remove some items from the cache
+
+        :param k1: integer, first identifier
+        :param k2s: list of integers, second identifiers
+        """
+
+        cache = self._cache
+        for k2 in k2s:
+            cache.pop((k1, k2), None)
+
+    def get(self, k1, k2s, copy=True):
         """get data from the cache
 
         :param k1: integer, first identifier
         :param k2s: list of integers, second identifiers
+        :param copy: logical, set False to obtain data without a copy
+            (only when the output will not be modified)
         :return: two items; a dict with data for items available from cache,
             a list of indexes not available through the cache
         """
@@ -66,8 +87,158 @@ class CrossmapCache:
             if key in cache:
                 value = cache[key][1]
                 cache[key] = (timestamp, value)
-                result[k2] = safecopy(value)
+                result[k2] = safecopy(value) if copy else value
             else:
                 missing.append(k2)
         return result, missing
 
+
+class CrossmapResultCache:
+    """Cache for json-compatible query results, with request coalescing
+
+    Entries are evicted when they are older than a time-to-live, or, in
+    least-recently-used order, when the total size of the cached results
+    exceeds a budget. Each entry is associated with dataset labels, so that
+    entries can be invalidated when a dataset changes. Identical requests
+    that arrive while a result is being computed wait for that result
+    instead of computing it again.
+    """
+
+    # label signaling that an entry depends on all datasets
+    all_datasets = "*"
+
+    def __init__(self, max_bytes=pow(2, 26), ttl=600):
+        """set up an empty cache
+
+        :param max_bytes: integer, budget for the size of cached results
+            (estimated from their json representations)
+        :param ttl: number, time-to-live for entries in seconds
+        """
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._cache = OrderedDict()
+        self._in_flight = dict()
+        self._lock = Lock()
+        # counter used to discard results computed before an invalidation
+        self._generation = 0
+
+    @staticmethod
+    def key(**kwargs):
+        """create a canonical hash from query components
+
+        :param kwargs: json-compatible objects describing a query
+        :return: string
+        """
+
+        raw = dumps(kwargs, sort_keys=True, default=str)
+        return sha256(raw.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def dependencies(cls, dataset, data_pos="", diffusion=None):
+        """list dataset labels that a search or decomposition depends on
+
+        :param dataset: string or list, datasets that are searched
+        :param data_pos: string, query (a single word can be an item id
+            from any dataset)
+        :param diffusion: dict, map assigning diffusion weights to datasets
+        :return: list of dataset labels
+        """
+
+        if dataset == "all" or isinstance(dataset, list) or \
+                len(data_pos.split(" ")) == 1:
+            return [cls.all_datasets]
+        result = [dataset]
+        if diffusion is not None:
+            result.extend([_ for _ in diffusion.keys() if _ != dataset])
+        return result
+
+    def _pop(self, key):
+        """remove one entry from the cache"""
+
+        entry = self._cache.pop(key)
+        self.size -= len(entry[2])
+
+    def _get(self, key):
+        """retrieve a result from the cache, or None"""
+
+        entry = self._cache.get(key, None)
+        if entry is None:
+            return None
+        if time() - entry[0] > self.ttl:
+            self._pop(key)
+            return None
+        self._cache.move_to_end(key)
+        return loads(entry[2])
+
+    def _set(self, key, datasets, value):
+        """store a result in the cache, evicting older entries if needed"""
+
+        raw = dumps(value)
+        if len(raw) > self.max_bytes:
+            return
+        if key in self._cache:
+            self._pop(key)
+        self._cache[key] = (time(), set(datasets), raw)
+        self.size += len(raw)
+        while self.size > self.max_bytes:
+            self._pop(next(iter(self._cache)))
+
+    def get(self, key, datasets, compute):
+        """get a result from the cache, or compute it
+
+        :param key: string, output from key()
+        :param datasets: list of dataset labels that the result depends on
+        :param compute: function without arguments that computes a result
+        :return: result from the cache, or output from compute()
+        """
+
+        with self._lock:
+            result = self._get(key)
+            if result is not None:
+                return result
+            flight = self._in_flight.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = dict(event=Event(), result=None, error=None,
+                              generation=self._generation)
+                self._in_flight[key] = flight
+        if not leader:
+            flight["event"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return loads(dumps(flight["result"]))
+        try:
+            flight["result"] = compute()
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+                if flight["error"] is None and \
+                        flight["generation"] == self._generation:
+                    self._set(key, datasets, flight["result"])
+            flight["event"].set()
+        return loads(dumps(flight["result"]))
+
+    def invalidate(self, dataset):
+        """remove entries that depend on a dataset
+
+        :param dataset: string, dataset label
+        """
+
+        with self._lock:
+            self._generation += 1
+            labels = {dataset, self.all_datasets}
+            for key in [k for k, v in self._cache.items() if v[1] & labels]:
+                self._pop(key)
+
+    def clear(self):
+        """remove all content from the cache"""
+
+        with self._lock:
+            self._generation += 1
+            self._cache = OrderedDict()
+            self.size = 0
@@ -0,0 +1,104 @@
+"""
+Pool of candidate data items for greedy decompositions
+
+A pool holds nearest neighbors of a query together with their data
+vectors, fetched in one batch. During a greedy decomposition, the next
+component is the candidate nearest to the current residual. Because
+residuals differ from the query only on the query's support, distances
+between a residual and all candidates can be computed from a few
+precomputed quantities, without further searches or db queries.
+"""
+
+from numpy import argmin, array, concatenate, zeros
+from scipy.sparse import vstack
+from .csr import dense_on_support
+
+
+class CrossmapCandidatePool:
+    """Nearest neighbors of a query, with their data vectors"""
+
+    def __init__(self, q, support, dataset, suggest, get_data):
+        """create an empty pool
+
+        :param q: csr vector, query
+        :param support: sorted array of dimensional indexes; residuals
+            differ from q only at these dimensions
+        :param dataset: string, dataset identifier
+        :param suggest: function for nearest-neighbor search
+        :param get_data: function that fetches data vectors
+        """
+
+        self.q = q
+        self.support = support
+        self.dataset = dataset
+        self.suggest = suggest
+        self.get_data = get_data
+        self.ids = []
+        self.vectors = dict()
+        # inner products with q, squared norms, values on the support
+        self.q_dots = zeros(0)
+        self.sq_norms = zeros(0)
+        self.values = zeros((0, len(support)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, v, n):
+        """search for nearest neighbors and add them to the pool
+
+        :param v: csr vector, query for the search
+        :param n: integer, number of nearest neighbors
+        :return: integer, number of new candidates
+        """
+
+        hits, _ = self.suggest(v, self.dataset, n)
+        new_ids = [_ for _ in hits if _ not in self.vectors]
+        if len(new_ids) == 0:
+            return 0
+        rows = {_["id"]: _["data"] for _ in
+                self.get_data(self.dataset, ids=new_ids)}
+        new_ids = [_ for _ in new_ids if _ in rows]
+        if len(new_ids) == 0:
+            return 0
+        data = vstack([rows[_] for _ in new_ids], format="csr")
+        q_dots = array(data.dot(self.q.transpose()).todense()).ravel()
+        sq_norms = array(data.multiply(data).sum(axis=1)).ravel()
+        values = [dense_on_support(rows[_], self.support)[0]
+                  for _ in new_ids]
+        self.q_dots = concatenate([self.q_dots, q_dots])
+        self.sq_norms = concatenate([self.sq_norms, sq_norms])
+        self.values = concatenate([self.values, array(values)])
+        for id in new_ids:
+            self.ids.append(id)
+            self.vectors[id] = rows[id]
+        return len(new_ids)
+
+    def nearest(self, model):
+        """find the candidate nearest to a residual
+
+        :param model: array with values on the support, the residual is
+            q minus model
+        :return: string identifier, or None if the pool is empty
+        """
+
+        if len(self.ids) == 0:
+            return None
+        # squared distances, up to a constant (the norm of the residual)
+        residual_dots = self.q_dots - self.values.dot(model)
+        scores = self.sq_norms - 2 * residual_dots
+        return self.ids[argmin(scores)]
+
+    def exhausted(self, used):
+        """check whether all candidates have been used
+
+        :param used: list of string identifiers
+        :return: logical
+        """
+
+        used = set(used)
+        return all([_ in used for _ in self.ids])
+
+    def vector(self, id):
+        """get the data vector for a candidate"""
+
+        return self.vectors[id]
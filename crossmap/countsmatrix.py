@@ -0,0 +1,263 @@
+"""
+Matrices of counts in memory-mapped files
+
+A matrix with one row per feature is held in csr form, with its data,
+indices, and row pointers (indptr) in separate .npy files. Readers map
+the files into memory, so a row lookup is a slice of the mapped arrays
+and several processes share the same pages in the operating system's
+cache.
+
+Matrices are written once, from blocks of consecutive rows, and are
+replaced as a whole. The file with row pointers is written last, and
+readers check for replaced files before using the mapped arrays.
+
+Rows that change after a matrix is written are recorded in a separate,
+append-only file of row indexes. Readers skip those rows, so that the
+current content can be obtained from elsewhere (e.g. from a db).
+"""
+
+from os import remove, replace, stat
+from os.path import exists, getsize
+from threading import Lock
+from numpy import array, float64, frombuffer, int32, int64, load, memmap
+from numpy import save, zeros
+from numpy.lib.format import open_memmap
+
+
+# parts of a matrix, in the order they are written
+matrix_parts = dict(data=float64, indices=int32, indptr=int64)
+
+# number of elements copied at once when writing files
+copy_chunk_size = pow(2, 22)
+
+
+def counts_matrix_files(path):
+    """list files that hold a matrix
+
+    :param path: string, prefix for paths to files
+    :return: list of paths (some of these may not exist)
+    """
+
+    return [path + "-" + _ + ".npy" for _ in matrix_parts.keys()]
+
+
+def counts_updates_file(path):
+    """path to a file with indexes of rows updated after writing a matrix
+
+    :param path: string, prefix for paths to files
+    :return: string, path to file
+    """
+
+    return path + "-updated.raw"
+
+
+def record_counts_updates(path, idxs):
+    """record that some rows have changed since a matrix was written
+
+    (Indexes are appended to a file, so that several processes can
+    record updates without rewriting the file)
+
+    :param path: string, prefix for paths to files
+    :param idxs: list of integer row indexes
+    """
+
+    if len(idxs) == 0:
+        return
+    with open(counts_updates_file(path), "ab") as f:
+        f.write(array(idxs, dtype=int64).tobytes())
+
+
+def trim_counts_updates(path, n):
+    """discard the first records of updated rows
+
+    :param path: string, prefix for paths to files
+    :param n: integer, number of records to discard
+    """
+
+    updates_file = counts_updates_file(path)
+    if not exists(updates_file):
+        return
+    with open(updates_file, "rb") as f:
+        f.seek(8 * n)
+        content = f.read()
+    if len(content) == 0:
+        remove(updates_file)
+        return
+    tmp_file = updates_file + ".new"
+    with open(tmp_file, "wb") as f:
+        f.write(content[:8 * (len(content) // 8)])
+    replace(tmp_file, updates_file)
+
+
+def count_counts_updates(path):
+    """count records of updated rows
+
+    :param path: string, prefix for paths to files
+    :return: integer
+    """
+
+    updates_file = counts_updates_file(path)
+    return getsize(updates_file) // 8 if exists(updates_file) else 0
+
+
+def save_counts_matrix(path, blocks, n_rows):
+    """write a matrix into files, from blocks of consecutive rows
+
+    :param path: string, prefix for paths to files
+    :param blocks: iterable with csr matrices, blocks of consecutive rows
+    :param n_rows: integer, total number of rows
+    """
+
+    files = counts_matrix_files(path)
+    raw_files = [_[:-4] + "-tmp.raw" for _ in files]
+    indptr = zeros(n_rows + 1, dtype=int64)
+    row, offset = 0, 0
+    with open(raw_files[0], "wb") as f_data, \
+            open(raw_files[1], "wb") as f_indices:
+        for block in blocks:
+            n = block.shape[0]
+            f_data.write(block.data.astype(float64).tobytes())
+            f_indices.write(block.indices.astype(int32).tobytes())
+            indptr[row+1:row+n+1] = offset + block.indptr[1:]
+            row, offset = row + n, offset + block.nnz
+    if row != n_rows:
+        for f in raw_files[:2]:
+            remove(f)
+        raise Exception("incorrect number of rows in matrix: " + str(row))
+    # convert raw content into .npy files, then replace existing files
+    for part, raw_file, f in zip(["data", "indices"], raw_files, files):
+        dtype = matrix_parts[part]
+        tmp_file = f[:-4] + "-tmp.npy"
+        result = open_memmap(tmp_file, mode="w+", dtype=dtype,
+                             shape=(offset,))
+        if offset > 0:
+            content = memmap(raw_file, dtype=dtype, mode="r")
+            for start in range(0, offset, copy_chunk_size):
+                end = min(offset, start + copy_chunk_size)
+                result[start:end] = content[start:end]
+            del content
+        result.flush()
+        del result
+        remove(raw_file)
+        replace(tmp_file, f)
+    tmp_file = files[2][:-4] + "-tmp.npy"
+    save(tmp_file, indptr)
+    replace(tmp_file, files[2])
+
+
+def remove_counts_matrix(path):
+    """delete files that hold a matrix
+
+    :param path: string, prefix for paths to files
+    """
+
+    for f in counts_matrix_files(path) + [counts_updates_file(path)]:
+        if exists(f):
+            remove(f)
+
+
+class CrossmapCountsMatrix:
+    """Read-only access to a matrix of counts in memory-mapped files"""
+
+    def __init__(self, path):
+        """set up access to files, without reading them
+
+        :param path: string, prefix for paths to files
+        """
+
+        self.path = path
+        self.lock = Lock()
+        self.data, self.indices, self.indptr = None, None, None
+        self._stamp = None
+        # rows updated after the matrix was written
+        self.updated = set()
+        self.recent_updates = []
+        self._updates_stamp = None
+        self._updates_size = 0
+
+    def refresh(self):
+        """map files into memory if they are new or have been replaced
+
+        This also reads records of rows updated since the matrix was
+        written. Rows recorded since the previous refresh are listed in
+        attribute recent_updates.
+
+        :return: logical, True if the matrix is available
+        """
+
+        files = counts_matrix_files(self.path)
+        try:
+            stats = [stat(_) for _ in files]
+        except OSError:
+            self.data, self.indices, self.indptr = None, None, None
+            self._stamp = None
+            return False
+        self._refresh_updates()
+        stamp = tuple([(_.st_ino, _.st_mtime_ns, _.st_size) for _ in stats])
+        if stamp == self._stamp:
+            return self.indptr is not None
+        with self.lock:
+            try:
+                data, indices, indptr = [load(_, mmap_mode="r")
+                                         for _ in files]
+            except (OSError, ValueError):
+                return False
+            consistent = len(indptr) > 0 and len(data) == len(indices) \
+                and indptr[-1] == len(data)
+            if not consistent:
+                data, indices, indptr = None, None, None
+            self.data, self.indices, self.indptr = data, indices, indptr
+            self._stamp = stamp
+        return consistent
+
+    def _refresh_updates(self):
+        """read records of updated rows that are new since last time"""
+
+        try:
+            st = stat(counts_updates_file(self.path))
+            stamp, size = st.st_ino, st.st_size - st.st_size % 8
+        except OSError:
+            stamp, size = None, 0
+        self.recent_updates = []
+        if stamp == self._updates_stamp and size == self._updates_size:
+            return
+        with self.lock:
+            start = self._updates_size
+            if stamp != self._updates_stamp or size < start:
+                # a new file, all records are new
+                self.updated, start = set(), 0
+            content = b""
+            if size > start:
+                with open(counts_updates_file(self.path), "rb") as f:
+                    f.seek(start)
+                    content = f.read(size - start)
+            new_updates = [int(_) for _ in frombuffer(content, dtype=int64)]
+            self.updated.update(new_updates)
+            self.recent_updates = new_updates
+            self._updates_stamp = stamp
+            self._updates_size = start + len(content)
+
+    def __len__(self):
+        return 0 if self.indptr is None else len(self.indptr) - 1
+
+    def get(self, idxs):
+        """get rows as pairs of arrays
+
+        :param idxs: list of integer row indexes
+        :return: dict mapping indexes to arrays with data and indices;
+            the arrays share memory with the files and must not be
+            modified (indexes outside the matrix, and rows updated after
+            the matrix was written, are skipped)
+        """
+
+        data, indices, indptr = self.data, self.indices, self.indptr
+        if indptr is None:
+            return dict()
+        n = len(indptr) - 1
+        updated = self.updated
+        result = dict()
+        for i in idxs:
+            if 0 <= i < n and i not in updated:
+                a, b = indptr[i], indptr[i+1]
+                result[i] = (data[a:b], indices[a:b])
+        return result
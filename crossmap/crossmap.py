@@ -3,33 +3,54 @@ Crossmap class
 """
 
 from contextlib import suppress
+from itertools import islice
+from multiprocessing import Pool
 from yaml import dump
 from logging import info, warning, error
 from os import mkdir, remove
 from os.path import exists
 from shutil import rmtree
+from numpy import concatenate, unique, zeros
 from scipy.sparse import vstack
 from .settings import CrossmapSettings
 from .dbmongo import CrossmapMongoDB as CrossmapDB
 from .indexer import CrossmapIndexer
-from .diffuser import CrossmapDiffuser
-from .vectors import csr_residual
-from .vectors import vec_decomposition as vec_decomp
-from .csr import FastCsrMatrix, dimcollapse_csr
+from .shardedindex import index_files
+from .diffuser import CrossmapDiffuser, counts_chunk_size
+from .vectors import cholesky_append, gram_append, gram_decomposition
+from .vectors import normalize_vec, vec_norm
+from .csr import FastCsrMatrix, dense_on_support
+from .candidatepool import CrossmapCandidatePool
+from .cache import CrossmapResultCache
 from .tools import open_file, yaml_document, time
 
 
-def _search_result(ids, distances, name):
+# number of documents sent to a worker process at a time
+worker_batch_size = 256
+
+# number of documents from a file searched together in one process
+file_batch_size = 256
+
+# crossmap instance used within a worker process (see _init_worker)
+_worker_crossmap = None
+
+
+def _search_result(ids, distances, name, datasets=None):
     """structure an object describing a nearest-neighbor search
 
     :param ids: list of string identifiers
     :param distances: list of numeric values
     :param name: query name included in the output dictionary
+    :param datasets: list of dataset labels for each id, or None to
+      omit dataset labels from the output
     :return: dictionary, contain lists with ids and distances,
       ordered by distance from smallest to largerst
     """
 
-    return dict(query=name, targets=ids, distances=distances)
+    result = dict(query=name, targets=ids, distances=distances)
+    if datasets is not None:
+        result["datasets"] = datasets
+    return result
 
 
 def _decomposition_result(ids, weights, name):
@@ -84,6 +105,10 @@ class Crossmap:
         self.settings = settings
         self.indexer = None
         self.db = None
+        # cache for query results (used by the server)
+        cache_settings = settings.cache
+        self.result_cache = CrossmapResultCache(
+            cache_settings.results * pow(2, 20), cache_settings.results_ttl)
         if not settings.valid:
             return
         if not exists(settings.prefix):
@@ -118,9 +143,11 @@ class Crossmap:
             return
         self.indexer.build()
         self.db.index("data")
+        self.db.index("docs")
         self.diffuser = CrossmapDiffuser(self.settings, db=self.db)
         self.diffuser.build()
         self.db.index("counts")
+        self.db.index("diffusion")
         info("done")
 
     def load(self):
@@ -129,16 +156,29 @@ class Crossmap:
         self.indexer.load()
         self.diffuser = CrossmapDiffuser(self.settings, self.db)
 
+    def reload(self):
+        """load index files that have been replaced on disk
+
+        :return: list of dataset labels with new indexes
+        """
+
+        result = self.indexer.reload()
+        for dataset in result:
+            self.result_cache.invalidate(dataset)
+        return result
+
     def remove(self, dataset):
         """remove a dataset, or entire instance"""
 
         self.db.remove_dataset(dataset)
+        self.result_cache.invalidate(dataset)
         dataset_files = [self.settings.yaml_file(dataset),
-                         self.settings.index_file(dataset),
-                         self.settings.index_dat_file(dataset)]
+                         self.settings.ids_file(dataset)]
+        dataset_files += index_files(self.settings.index_file(dataset))
         for f in dataset_files:
             if exists(f):
                 remove(f)
+        self.indexer.remove_partitions(dataset)
         # reload the instance (updates indexer, diffuser)
         self.load()
 
@@ -149,10 +189,28 @@ class Crossmap:
         :param doc: dict with string data
         :param id: string, identifier for new item
         :param metadata: dict, a free element of additional information
-        :param rebuild: logical, set True to rebuild nearest-neighbor indexing
+        :param rebuild: logical, set True to make the item available for
+            nearest-neighbor search immediately
         :return: an integer signaling
         """
 
+        idx = self._add(dataset, doc, id, metadata, rebuild)
+        self.diffuser.update(dataset, [idx])
+        self.result_cache.invalidate(dataset)
+        return idx
+
+    def _add(self, dataset, doc, id, metadata=None, rebuild=True):
+        """add a new item into the db, without updating diffusion counts
+
+        :param dataset: string, name of dataset to append
+        :param doc: dict with string data
+        :param id: string, identifier for new item
+        :param metadata: dict, a free element of additional information
+        :param rebuild: logical, set True to make the item available for
+            nearest-neighbor search immediately
+        :return: integer index for the new item
+        """
+
         if dataset in self.settings.data.collections:
             raise Exception("cannot add to file-based datasets")
         label_status = self.db.validate_dataset_label(dataset)
@@ -162,9 +220,8 @@ class Crossmap:
             info("Registering dataset: " + str(dataset))
             self.db.register_dataset(dataset)
 
-        # update the db structures (indexing and diffusion)
+        # update the db structures (indexing)
         idx = self.indexer.update(dataset, doc, id, rebuild=rebuild)
-        self.diffuser.update(dataset, [idx])
 
         # record the item in a disk file
         # (preserve existing metadata fields, perhaps add new fields)
@@ -182,15 +239,28 @@ class Crossmap:
     def add_file(self, dataset, filepath):
         """transfer items from a data file into a new dataset in the db
 
+        Diffusion counts are updated for batches of items at once, and
+        are then written into a memory-mapped matrix.
+
         :param dataset:
         :param filepath:
         :return: list with the added ids
         """
 
-        result = []
+        result, pending = [], []
         with open_file(filepath, "rt") as f:
             for id, doc in yaml_document(f):
-                result.append(self.add(dataset, doc, id, rebuild=False))
+                idx = self._add(dataset, doc, id, rebuild=False)
+                result.append(idx)
+                pending.append(idx)
+                if len(pending) >= counts_chunk_size:
+                    self.diffuser.update(dataset, pending)
+                    pending = []
+        if len(pending) > 0:
+            self.diffuser.update(dataset, pending)
+        if len(result) > 0:
+            self.db.save_diffusion_matrix(dataset)
+        self.result_cache.invalidate(dataset)
         info("Added "+str(len(result)) + " entries")
         self.indexer.rebuild_index(dataset)
         return result
@@ -228,7 +298,8 @@ class Crossmap:
         data = [{"feature": v[2], "value": v[1]} for i, v in enumerate(data)]
         return dict(query=query_name, features=data)
 
-    def search(self, doc, dataset, n=3, diffusion=None, query_name="query",
+    def search(self, doc, dataset=None, n=3, diffusion=None,
+               query_name="query", datasets=None, metadata_filter=None,
                **kwargs):
         """identify targets that are close to the input query
 
@@ -237,21 +308,79 @@ class Crossmap:
         :param n: integer, number of target to report
         :param diffusion: dict, map assigning diffusion weights
         :param query_name: character, a name for the document
+        :param datasets: list of dataset identifiers, or "all", to look for
+            targets in several datasets at once (replaces dataset)
+        :param metadata_filter: dict mapping metadata fields to a value, or
+            to a list of values; targets must satisfy all the fields
         :param kwargs: other keyword arguments, ignored
             (This is included for consistency with search() and decompose())
         :return: a dictionary containing an id, and lists to target ids and
-            distances
+            distances. When datasets is set, the dictionary also holds the
+            dataset labels for the targets.
         """
 
-        raw, diffused = self._prep_vector(doc, diffusion)
-        if len(raw.data) == 0:
-            return _search_result([], [], query_name)
-        suggest = self.indexer.suggest
-        targets, distances = suggest(diffused, dataset, n)
-        return _search_result(targets, distances, query_name)
+        return self.search_batch([doc], dataset, n, diffusion,
+                                 query_names=[query_name],
+                                 datasets=datasets,
+                                 metadata_filter=metadata_filter)[0]
+
+    def search_batch(self, docs, dataset=None, n=3, diffusion=None,
+                     query_names=None, datasets=None, metadata_filter=None,
+                     **kwargs):
+        """identify targets that are close to several input queries
+
+        All the queries are diffused together and sent to the
+        nearest-neighbor index together, which avoids overheads
+        associated with many individual queries.
+
+        :param docs: list of dict-like objects with "data", "data_pos", etc.
+        :param dataset: string, identifier for dataset to look for targets
+        :param n: integer, number of target to report for each query
+        :param diffusion: dict, map assigning diffusion weights
+        :param query_names: list of names for the documents
+        :param datasets: list of dataset identifiers, or "all", to look for
+            targets in several datasets at once (replaces dataset)
+        :param metadata_filter: dict mapping metadata fields to a value, or
+            to a list of values; targets must satisfy all the fields
+        :param kwargs: other keyword arguments, ignored
+        :return: list of dictionaries, each as output by search()
+        """
+
+        if query_names is None:
+            query_names = ["query"] * len(docs)
+        if datasets == "all":
+            datasets = list(self.db.datasets.keys())
+        empty_labels = None if datasets is None else []
+        result = [_search_result([], [], _, empty_labels)
+                  for _ in query_names]
+        # prepare vectors, keeping track of non-empty queries
+        positions, vectors = [], []
+        for i, doc in enumerate(docs):
+            raw = self.encoder.document(doc)
+            if len(raw.data) == 0:
+                continue
+            positions.append(i)
+            vectors.append(raw)
+        if len(vectors) == 0:
+            return result
+        vectors = vstack(vectors, format="csr")
+        if diffusion is not None:
+            vectors = self.diffuser.diffuse_batch(vectors, diffusion)
+        if datasets is not None:
+            suggestions = self.indexer.suggest_datasets(vectors, datasets, n,
+                                                        metadata_filter)
+            for i, (targets, distances, labels) in zip(positions, suggestions):
+                result[i] = _search_result(targets, distances,
+                                           query_names[i], labels)
+            return result
+        suggestions = self.indexer.suggest_batch(vectors, dataset, n,
+                                                 metadata_filter)
+        for i, (targets, distances) in zip(positions, suggestions):
+            result[i] = _search_result(targets, distances, query_names[i])
+        return result
 
     def decompose(self, doc, dataset, n=3, diffusion=None,
-                  factors=None,
+                  factors=None, pool=None,
                   query_name="query"):
         """decompose of a query document in terms of targets
 
@@ -261,6 +390,9 @@ class Crossmap:
         :param diffusion: dict, strength of diffusion on primary data
         :param factors: list with item ids that must be included in the
             decomposition
+        :param pool: integer, number of candidates retrieved at once;
+            None uses the indexing setting 'decompose_pool', 0 performs
+            a new search for each component
         :param query_name:  character, a name for the document
         :return: dictionary containing an id, and list with target ids and
             decomposition coefficients
@@ -271,40 +403,79 @@ class Crossmap:
         get_data = self.indexer.db.get_data
         # representation of the query document, raw and diffused
         q_raw, q = self._prep_vector(doc, diffusion)
-        q_indexes = set(q_raw.indices)
-        q_dense = q.toarray()
+        # basis vectors are restricted to the features of the raw query,
+        # so all linear algebra takes place on that support
+        support = unique(q_raw.indices)
+        q_support, _ = dense_on_support(q, support)
         # loop for greedy decomposition
         factors = factors if factors is not None else []
         num_factors = len(factors)
-        ids, coefficients, components = [], [], []
-        q_residual = q
-        while len(components) < n and len(q_residual.data) > 0:
+        if num_factors > 0:
+            factor_data = {_["id"]: _["data"]
+                           for _ in get_data(dataset, ids=factors)}
+        if pool is None:
+            pool = self.settings.indexing.decompose_pool
+        candidates = None
+        if pool > 0:
+            candidates = CrossmapCandidatePool(q, support, dataset,
+                                               suggest, get_data)
+        ids, coefficients = [], []
+        basis = zeros((n, len(support)))
+        in_basis = zeros(len(support), dtype=bool)
+        # Gram matrix, its Cholesky factor, projections of q onto the basis
+        gram, factor, projections = zeros((0, 0)), zeros((0, 0)), zeros((0, 1))
+        q_residual, model = q, zeros(len(support))
+        while len(ids) < n and len(q_residual.data) > 0:
             # use a suggested factors, or find a new factor via search
-            if len(components) < num_factors:
-                target = [factors[len(components)]]
+            if len(ids) < num_factors:
+                target = [factors[len(ids)]]
+                target_vec = factor_data[target[0]]
+            elif candidates is not None:
+                # search again only when all candidates have been used
+                if candidates.exhausted(ids):
+                    candidates.add(q_residual, pool + len(ids))
+                target = [candidates.nearest(model)]
+                if target[0] is None:
+                    break
+                target_vec = candidates.vector(target[0])
             else:
                 target, _ = suggest(q_residual, dataset, 1)
+                if len(target) > 0:
+                    target_vec = get_data(dataset, ids=target)[0]["data"]
             # residual mapped back onto an existing hit? quit early
             if len(target) == 0 or target[0] in ids:
                 break
-            target_data = get_data(dataset, ids=target)
+            k = len(ids)
             ids.append(target[0])
-            target_vec = target_data[0]["data"]
-            components.append(dimcollapse_csr(target_vec, q_indexes))
-            basis = vstack(components)
-            q_modeled = q_dense
-            if set(basis.indices) is not q_indexes:
-                q_modeled = dimcollapse_csr(q, set(basis.indices)).toarray()
-            coefficients = vec_decomp(q_modeled, basis.toarray())
+            component, present = dense_on_support(target_vec, support)
+            component = normalize_vec(component)
+            basis[k] = component
+            in_basis |= present
+            # extend the Gram matrix and its factorization by one vector
+            g = basis[:k].dot(component)
+            gamma = component.dot(component)
+            gram = gram_append(gram, g, gamma)
+            if factor is not None:
+                factor = cholesky_append(factor, g, gamma)
+            projections = concatenate([projections,
+                                       [[component.dot(q_support)]]])
+            # coefficients for q restricted to features covered by the basis
+            q_norm = vec_norm(q_support[in_basis])
+            if q_norm > 0:
+                coefficients = gram_decomposition(factor, gram,
+                                                  projections / q_norm)
+            else:
+                coefficients = zeros((k+1, 1))
             if coefficients[-1] == 0:
                 break
-            weights = FastCsrMatrix(coefficients)
-            q_residual = csr_residual(q, basis, weights)
+            model = coefficients[:, 0].dot(basis[:k+1])
+            q_residual = q - FastCsrMatrix((model, support,
+                                            [0, len(support)]), shape=q.shape)
 
         # order the coefficients (decreasing size, most important first)
         if len(coefficients) > 0:
             # re-do decomposition using the entire q vector
-            coefficients = vec_decomp(q_dense, basis.toarray())
+            coefficients = gram_decomposition(factor, gram, projections)
             first_id = ids[0]
             coefficients, ids = _ranked_decomposition(coefficients, ids)
             if len(ids) == 0:
@@ -312,7 +483,7 @@ class Crossmap:
 
         return _decomposition_result(ids, coefficients, query_name)
 
-    def search_file(self, filepath, dataset, n, diffusion=None,
+    def search_file(self, filepath, dataset, n, diffusion=None, workers=1,
                     **kwargs):
         """find nearest targets for all documents in a file
 
@@ -320,16 +491,42 @@ class Crossmap:
         :param dataset: string, identifier for target dataset
         :param n: integer, number of target to report for each input
         :param diffusion: dict, map with diffusion strengths
+        :param workers: integer, number of worker processes
         :param kwargs: other keyword arguments, ignored
             (This is included for consistency with decompose_file())
         :return: list with dicts, each as output by search()
         """
 
-        return _action_file(self.search, filepath, dataset=dataset,
-                            n=n, diffusion=diffusion)
+        return list(self.search_file_iter(filepath, dataset, n,
+                                          diffusion=diffusion,
+                                          workers=workers))
+
+    def search_file_iter(self, filepath, dataset, n, diffusion=None,
+                         workers=1, **kwargs):
+        """generator for nearest targets for documents in a file
+
+        (This is similar to search_file, but yields results one at a time
+        so that memory use does not grow with the size of the file)
+
+        :param filepath: string, path to a file with documents
+        :param dataset: string, identifier for target dataset
+        :param n: integer, number of target to report for each input
+        :param diffusion: dict, map with diffusion strengths
+        :param workers: integer, number of worker processes
+        :param kwargs: other keyword arguments, ignored
+        :return: dicts, each as output by search()
+        """
+
+        if workers > 1:
+            return _parallel_action_file(self.settings, "search", filepath,
+                                         workers, dataset=dataset,
+                                         n=n, diffusion=diffusion)
+        return _batch_action_file(self.search_batch, filepath,
+                                  file_batch_size,
+                                  dataset=dataset, n=n, diffusion=diffusion)
 
     def decompose_file(self, filepath, dataset, n=3, diffusion=None,
-                       factors=None):
+                       factors=None, workers=1):
         """perform decomposition for documents defined in a file
 
         :param filepath: string, path to a file with documents
@@ -338,9 +535,36 @@ class Crossmap:
         :param diffusion: dict, map with diffusion strengths
         :param factors: list with item ids that must be included in the
             decomposition
+        :param workers: integer, number of worker processes
         :return: list with dicts, each as output by decompose()
         """
 
+        return list(self.decompose_file_iter(filepath, dataset, n,
+                                             diffusion=diffusion,
+                                             factors=factors,
+                                             workers=workers))
+
+    def decompose_file_iter(self, filepath, dataset, n=3, diffusion=None,
+                            factors=None, workers=1):
+        """generator for decompositions of documents defined in a file
+
+        (This is similar to decompose_file, but yields results one at a time
+        so that memory use does not grow with the size of the file)
+
+        :param filepath: string, path to a file with documents
+        :param dataset: string, identifier for target dataset
+        :param n: integer, number of target to report for each input
+        :param diffusion: dict, map with diffusion strengths
+        :param factors: list with item ids that must be included in the
+            decomposition
+        :param workers: integer, number of worker processes
+        :return: dicts, each as output by decompose()
+        """
+
+        if workers > 1:
+            return _parallel_action_file(self.settings, "decompose", filepath,
+                                         workers, dataset=dataset, n=n,
+                                         diffusion=diffusion, factors=factors)
         return _action_file(self.decompose, filepath, dataset=dataset,
                             n=n, diffusion=diffusion, factors=factors)
 
@@ -366,23 +590,122 @@ def validate_dataset_label(crossmap, label=None, log=True):
     return label
 
 
-def _action_file(action, filepath, **kw):
-    """applies an action function to contents of a file
+def _file_documents(filepath):
+    """generator for documents in a file, stops at an invalid document
 
-    :param action: function
     :param filepath: string, path to a file with yaml documents
-    :param kw: keyword arguments, all passed on to action
-    :return: list with result of action function on the documents in the file
+    :return: pairs with an id and a document
     """
 
-    result = []
     if filepath is None:
-        return result
+        return
     with open_file(filepath, "rt") as f:
         for id, doc in yaml_document(f):
             if type(doc) is not dict:
                 error("invalid document type: "+str(id))
                 break
-            result.append(action(doc, **kw, query_name=id))
-    return result
+            yield id, doc
+
+
+def _action_file(action, filepath, **kw):
+    """generator applying an action function to contents of a file
+
+    :param action: function
+    :param filepath: string, path to a file with yaml documents
+    :param kw: keyword arguments, all passed on to action
+    :return: results of action function on the documents in the file
+    """
+
+    for id, doc in _file_documents(filepath):
+        yield action(doc, **kw, query_name=id)
+
+
+def _document_batches(filepath, batch_size):
+    """generator for chunks of documents in a file
+
+    :param filepath: string, path to a file with yaml documents
+    :param batch_size: integer, maximal number of documents in a chunk
+    :return: pairs with a list of ids and a list of documents
+    """
+
+    ids, docs = [], []
+    for id, doc in _file_documents(filepath):
+        ids.append(id)
+        docs.append(doc)
+        if len(docs) >= batch_size:
+            yield ids, docs
+            ids, docs = [], []
+    if len(docs) > 0:
+        yield ids, docs
 
+
+def _batch_action_file(action, filepath, batch_size, **kw):
+    """generator applying a batch action function to chunks of documents
+
+    :param action: function accepting a list of documents and query_names
+    :param filepath: string, path to a file with yaml documents
+    :param batch_size: integer, number of documents to process at once
+    :param kw: keyword arguments, all passed on to action
+    :return: results of action function on the documents in the file
+    """
+
+    for ids, docs in _document_batches(filepath, batch_size):
+        yield from action(docs, **kw, query_names=ids)
+
+
+def _init_worker(settings):
+    """prepare a crossmap instance within a worker process
+
+    :param settings: CrossmapSettings object
+    """
+
+    global _worker_crossmap
+    crossmap = Crossmap(settings)
+    crossmap.load()
+    # parallelism is handled by processes, so avoid oversubscribing cores
+    crossmap.indexer.threads = 1
+    _worker_crossmap = crossmap
+
+
+def _worker_action(task):
+    """apply an action on a chunk of documents within a worker process
+
+    :param task: tuple with an action name, list of ids, list of documents,
+        and a dict with keyword arguments
+    :return: list with results for each document in the chunk
+    """
+
+    action, ids, docs, kw = task
+    crossmap = _worker_crossmap
+    if action == "search":
+        return crossmap.search_batch(docs, **kw, query_names=ids)
+    return [crossmap.decompose(doc, **kw, query_name=id)
+            for id, doc in zip(ids, docs)]
+
+
+def _parallel_action_file(settings, action, filepath, workers, **kw):
+    """generator applying an action to contents of a file using workers
+
+    Documents are sent to the worker pool in windows of a few chunks per
+    worker, so that memory use does not grow with the size of the file.
+
+    :param settings: CrossmapSettings object, used to set up the workers
+    :param action: string, name of action, 'search' or 'decompose'
+    :param filepath: string, path to a file with yaml documents
+    :param workers: integer, number of worker processes
+    :param kw: keyword arguments, all passed on to action
+    :return: results of action function on the documents in the file,
+        in the same order as the documents
+    """
+
+    window_size = 4 * workers
+    batches = _document_batches(filepath, worker_batch_size)
+    with Pool(workers, initializer=_init_worker,
+              initargs=(settings,)) as pool:
+        while True:
+            tasks = [(action, ids, docs, kw) for ids, docs
+                     in islice(batches, window_size)]
+            if len(tasks) == 0:
+                break
+            for chunk_result in pool.imap(_worker_action, tasks):
+                yield from chunk_result
@@ -3,7 +3,8 @@ Handling csr vectors
 """
 
 import numba
-from numpy import array, int32, float64
+from numpy import abs as np_abs, array, int32, float64, minimum
+from numpy import searchsorted, sort, zeros
 from pickle import loads, dumps
 from scipy.sparse import csr_matrix
 from .vectors import normalize_vec
@@ -135,6 +136,26 @@ def dimcollapse_csr(v, indexes=(), normalize=True):
     return result
 
 
+def dense_on_support(v, support):
+    """extract values of a sparse vector at selected dimensions
+
+    :param v: csr vector
+    :param support: sorted array of dimensional indexes
+    :return: two arrays with one element for each item in support;
+        values of v, and a boolean indicator of whether v has an entry
+    """
+
+    values = zeros(len(support), dtype=float64)
+    present = zeros(len(support), dtype=bool)
+    if len(support) == 0 or len(v.indices) == 0:
+        return values, present
+    positions = minimum(searchsorted(support, v.indices), len(support)-1)
+    hits = support[positions] == v.indices
+    values[positions[hits]] = v.data[hits]
+    present[positions[hits]] = True
+    return values, present
+
+
 @numba.jit
 def get_value_csr(data, indices, index):
     """get one value from a sparse vector"""
@@ -248,3 +269,111 @@ def csr_data_indices(arr):
             indices.append(i)
     return data, indices
 
+
+@numba.jit
+def diffuse_csr_rows(v_data, v_indices, v_indptr, rows, c_data, c_indices,
+                     c_indptr, strengths, pass_weights, n_features):
+    """diffuse several sparse vectors using the same connection rows
+
+    :param v_data: array of floats, data for vectors (csr format)
+    :param v_indices: array of integers, indices for vectors (csr format)
+    :param v_indptr: array of integers, row pointers for vectors
+    :param rows: sorted array of feature indexes with connection rows;
+        connections for dataset d and feature rows[u] are in row
+        d*len(rows) + u of the connection arrays
+    :param c_data: array of floats, connection magnitudes (csr format)
+    :param c_indices: array of integers, connection destinations
+    :param c_indptr: array of integers, row pointers for connections
+    :param strengths: array of floats, diffusion strength for each dataset
+    :param pass_weights: array of floats, weight for each diffusion pass
+    :param n_features: integer, number of features
+    :return: arrays with data, indices, and row pointers for the diffused
+        vectors (normalized, and without features with very low weights)
+    """
+
+    n_rows = len(rows)
+    n_vectors = len(v_indptr) - 1
+    # position of each feature within the support of one vector
+    position = zeros(n_features, dtype=int32) - 1
+    # row in the connection arrays for each element in the vectors
+    v_rows = searchsorted(rows, v_indices)
+    # upper bound on the size of the output
+    total = 0
+    for j in range(len(v_indices)):
+        total += 1
+        for d in range(len(strengths)):
+            r = d * n_rows + v_rows[j]
+            total += c_indptr[r+1] - c_indptr[r]
+    out_data = zeros(total, dtype=float64)
+    out_indices = zeros(total, dtype=int32)
+    out_indptr = zeros(n_vectors + 1, dtype=int32)
+    n_out = 0
+    for q in range(n_vectors):
+        start, end = v_indptr[q], v_indptr[q+1]
+        # collect the support, features in the vector come first
+        support_size = 0
+        for j in range(start, end):
+            support_size += 1
+            for d in range(len(strengths)):
+                r = d * n_rows + v_rows[j]
+                support_size += c_indptr[r+1] - c_indptr[r]
+        support = zeros(support_size, dtype=int32)
+        result = zeros(support_size, dtype=float64)
+        n = 0
+        for j in range(start, end):
+            index = v_indices[j]
+            if position[index] < 0:
+                position[index] = n
+                support[n] = index
+                n += 1
+            result[position[index]] += v_data[j]
+        for j in range(start, end):
+            for d in range(len(strengths)):
+                r = d * n_rows + v_rows[j]
+                for k in range(c_indptr[r], c_indptr[r+1]):
+                    index = c_indices[k]
+                    if position[index] < 0:
+                        position[index] = n
+                        support[n] = index
+                        n += 1
+        # diffusion passes, as in diffuse_sparse
+        for pass_w in pass_weights:
+            last_result = result[:n].copy()
+            for d in range(len(strengths)):
+                corpus_w = strengths[d]
+                for j in range(start, end):
+                    r = d * n_rows + v_rows[j]
+                    c0 = last_result[position[v_indices[j]]]
+                    for k in range(c_indptr[r], c_indptr[r+1]):
+                        p = position[c_indices[k]]
+                        diff = c0 - last_result[p]
+                        if c0 > 0 and diff > 0:
+                            result[p] += c_data[k] * pass_w * corpus_w * diff
+                            result[p] = min(c0, result[p])
+                        elif c0 <= 0 and diff < 0:
+                            result[p] += c_data[k] * pass_w * corpus_w * diff
+                            result[p] = max(c0, result[p])
+        # transfer nonzero values into output, ordered by feature index
+        first = n_out
+        for i in sort(support[:n]):
+            value = result[position[i]]
+            if value != 0.0:
+                out_data[n_out] = value
+                out_indices[n_out] = i
+                n_out += 1
+        # normalize, cut features with very low weights, normalize again
+        if end > start:
+            normalize_vec(out_data[first:n_out])
+            threshold = np_abs(v_data[start:end]).min() / 50
+            n_kept = first
+            for k in range(first, n_out):
+                if abs(out_data[k]) > threshold:
+                    out_data[n_kept] = out_data[k]
+                    out_indices[n_kept] = out_indices[k]
+                    n_kept += 1
+            n_out = n_kept
+            normalize_vec(out_data[first:n_out])
+        out_indptr[q+1] = n_out
+        for i in range(n):
+            position[support[i]] = -1
+    return out_data[:n_out], out_indices[:n_out], out_indptr
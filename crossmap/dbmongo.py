@@ -2,17 +2,27 @@
 Interface to a specialized db (implemented as monogodb)
 """
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from functools import wraps
 from logging import warning, error
+from os.path import exists
+from os import remove
+from threading import Lock
+from numpy import concatenate, cumsum, float64, int32, int64, zeros
 from .csr import FastCsrMatrix
 from .csr import csr_to_bytes, bytes_to_csr, bytes_to_arrays
 from .cache import CrossmapCache
 from .subsettings import CrossmapCacheSettings
+from .vectorstore import CrossmapVectorStore, vector_store_files
+from .countsmatrix import CrossmapCountsMatrix, save_counts_matrix
+from .countsmatrix import remove_counts_matrix, record_counts_updates
+from .countsmatrix import count_counts_updates, trim_counts_updates
+from .countsmatrix import counts_matrix_files
 
 
 # collections used in each CrossmapMongoDB instance
-crossmap_collection_types = {"features", "datasets", "docs", "data", "counts"}
+crossmap_collection_types = {"features", "datasets", "docs", "data", "counts",
+                             "diffusion"}
 
 
 class InvalidDatasetLabel(Exception):
@@ -47,6 +57,7 @@ class CrossmapMongoDB:
     """Management of a DB for features and data vectors"""
 
     counts_cache = None
+    diffusion_cache = None
     titles_cache = None
     data_cache = None
 
@@ -54,6 +65,7 @@ class CrossmapMongoDB:
         """sets up a connection to a db and defines settings"""
 
         self.db_name = settings.name
+        self.settings = settings
         client = MongoClient(host=settings.server.db_host,
                              port=settings.server.db_port,
                              username="crossmap",
@@ -65,7 +77,13 @@ class CrossmapMongoDB:
         self._datasets = self._db["datasets"]
         self._data = self._db["data"]
         self._counts = self._db["counts"]
+        self._diffusion = self._db["diffusion"]
         self.feature_map = None
+        # local stores for data vectors, one per dataset
+        self.vectors = dict()
+        self._vectors_lock = Lock()
+        # local matrices with rows prepared for diffusion, one per dataset
+        self.diffusion_matrices = dict()
 
         # set up cache objects (uses sloppy cache by default)
         self.n_features = self._features.count_documents({})
@@ -90,6 +108,7 @@ class CrossmapMongoDB:
         """resets cache objects"""
         cache_settings = self.cache_settings
         self.counts_cache = CrossmapCache(cache_settings.counts)
+        self.diffusion_cache = CrossmapCache(cache_settings.counts)
         self.titles_cache = CrossmapCache(cache_settings.titles)
         self.data_cache = CrossmapCache(cache_settings.data)
 
@@ -98,7 +117,7 @@ class CrossmapMongoDB:
         """remove all content from a table
 
         :param dataset: string, dataset identifier
-        :param collection: string, name of table, use "data" or "counts"
+        :param collection: string, name of table, e.g. "data" or "counts"
         """
 
         if collection not in crossmap_collection_types:
@@ -122,16 +141,21 @@ class CrossmapMongoDB:
         """empty the contents of the database tables"""
 
         warning("Removing existing database")
+        self._remove_vector_stores(self._dataset_labels())
+        self._remove_diffusion_matrices(self._dataset_labels())
         for collection in crossmap_collection_types:
             self._db[collection].delete_many({})
 
     def remove(self):
         """remove database"""
+        self._remove_vector_stores(self._dataset_labels())
+        self._remove_diffusion_matrices(self._dataset_labels())
         self._db.client.drop_database(self.db_name)
         self._docs = None
         self._data = None
         self._features = None
         self._counts = None
+        self._diffusion = None
         self._datasets = None
 
     def validate_dataset_label(self, label):
@@ -178,6 +202,9 @@ class CrossmapMongoDB:
 
         for collection in crossmap_collection_types:
             self._db[collection].delete_many({"dataset": dataset})
+        labels = {v: k for k, v in self.datasets.items()}
+        self._remove_vector_stores({labels[dataset]: dataset})
+        self._remove_diffusion_matrices({labels[dataset]: dataset})
         self.datasets = self._dataset_labels()
 
     @valid_dataset
@@ -190,6 +217,101 @@ class CrossmapMongoDB:
 
         return self._data.count_documents({"dataset": dataset})
 
+    def _vector_store(self, dataset, create=False):
+        """get a local store with data vectors for a dataset
+
+        Stores are created and filled only when adding data, so that a
+        single process writes the files. Other uses open existing files.
+
+        :param dataset: int, dataset identifier
+        :param create: logical, True to create a store if it does not
+            exist, and to fill it with data vectors present in the db
+        :return: CrossmapVectorStore, or None if the store does not exist
+            or the instance does not have a data directory
+        """
+
+        if dataset in self.vectors:
+            return self.vectors[dataset]
+        labels = {v: k for k, v in self.datasets.items()}
+        if dataset not in labels or not exists(self.settings.prefix):
+            return None
+        path = self.settings.vectors_file(labels[dataset])
+        if not create and not exists(path + ".indptr"):
+            return None
+        with self._vectors_lock:
+            if dataset in self.vectors:
+                return self.vectors[dataset]
+            store = CrossmapVectorStore(path)
+            if create:
+                if len(store) > self.dataset_size(dataset):
+                    warning("Discarding outdated vector store: " + path)
+                    store.remove()
+                    store = CrossmapVectorStore(path)
+                self._sync_vector_store(dataset, store)
+            self.vectors[dataset] = store
+        return store
+
+    def _sync_vector_store(self, dataset, store):
+        """append data vectors from the db that are missing in a store
+
+        :param dataset: int, dataset identifier
+        :param store: CrossmapVectorStore
+        """
+
+        n_features = self.n_features
+        vectors, ids = [], []
+        for row in self._data.find({"dataset": dataset,
+                                    "idx": {"$gte": len(store)}},
+                                   {"_id": 0}).sort("idx", 1):
+            if row["idx"] != len(store) + len(ids):
+                break
+            vectors.append(bytes_to_csr(row["data"], n_features))
+            ids.append(row["id"])
+            if len(ids) >= 10000:
+                store.append(vectors, ids)
+                vectors, ids = [], []
+        store.append(vectors, ids)
+
+    def _remove_vector_stores(self, labels):
+        """delete files with data vectors
+
+        :param labels: dict mapping dataset labels to integer identifiers
+        """
+
+        for label, dataset in labels.items():
+            self.vectors.pop(dataset, None)
+            for f in vector_store_files(self.settings.vectors_file(label)):
+                if exists(f):
+                    remove(f)
+
+    def _diffusion_matrix(self, dataset):
+        """get access to a local matrix with rows prepared for diffusion
+
+        :param dataset: int, dataset identifier
+        :return: CrossmapCountsMatrix, or None if the instance does not
+            have a data directory
+        """
+
+        if dataset in self.diffusion_matrices:
+            return self.diffusion_matrices[dataset]
+        labels = {v: k for k, v in self.datasets.items()}
+        if dataset not in labels or not exists(self.settings.prefix):
+            return None
+        path = self.settings.diffusion_file(labels[dataset])
+        matrix = CrossmapCountsMatrix(path)
+        self.diffusion_matrices[dataset] = matrix
+        return matrix
+
+    def _remove_diffusion_matrices(self, labels):
+        """delete files with matrices prepared for diffusion
+
+        :param labels: dict mapping dataset labels to integer identifiers
+        """
+
+        for label, dataset in labels.items():
+            self.diffusion_matrices.pop(dataset, None)
+            remove_counts_matrix(self.settings.diffusion_file(label))
+
     def _index(self, collection="data", types=("id", "idx")):
         """create indexes one db collection"""
 
@@ -204,6 +326,10 @@ class CrossmapMongoDB:
             self._data.create_index([("dataset", 1), ("idx", 1)])
         elif collection == "counts":
             self._counts.create_index([("dataset", 1), ("idx", 1)])
+        elif collection == "diffusion":
+            self._diffusion.create_index([("dataset", 1), ("idx", 1)])
+        elif collection == "docs":
+            self._docs.create_index([("dataset", 1), ("idx", 1)])
 
     def get_feature_map(self):
         """construct a feature map"""
@@ -232,21 +358,69 @@ class CrossmapMongoDB:
     def set_counts(self, dataset, data):
         """insert rows into the counts table.
 
-        (This will remove existing counts rows associated with a dataset
-        and set the new data instead)
+        (This will remove existing counts and diffusion rows associated
+        with a dataset and set the new counts data instead)
 
         :param dataset: string or int, identifier for a dataset
         :param data: list with rows to insert
         """
 
         self.counts_cache.clear()
+        self.diffusion_cache.clear()
         self._clear_table(dataset, "counts")
+        self._clear_table(dataset, "diffusion")
+        self._remove_diffusion_matrix(dataset)
+        self.add_counts(dataset, data)
+
+    def _add_rows(self, collection, dataset, data, start):
+        """insert csr rows with consecutive indexes into a table"""
+
         n = len(data)
+        if n == 0:
+            return
         data_array = [None]*n
         for i in range(n):
-            data_array[i] = {"dataset": dataset, "idx": i,
+            data_array[i] = {"dataset": dataset, "idx": start + i,
                              "data": csr_to_bytes(data[i])}
-        self._counts.insert_many(data_array)
+        self._db[collection].insert_many(data_array)
+
+    def _update_rows(self, collection, dataset, data, upsert=False):
+        """change existing csr rows in a table, using one bulk write"""
+
+        if len(data) == 0:
+            return
+        requests = [UpdateOne({"dataset": dataset, "idx": i},
+                              {"$set": {"data": csr_to_bytes(v)}},
+                              upsert=upsert)
+                    for i, v in data.items()]
+        self._db[collection].bulk_write(requests, ordered=False)
+
+    def _get_rows_arrays(self, collection, cache, dataset, idxs, copy=True):
+        """retrieve csr rows from a table, using a cache"""
+
+        result, missing = cache.get(dataset, idxs, copy=copy)
+        if len(missing) == 0:
+            return result
+        find = self._db[collection].find
+        for row in find({"dataset": dataset, "idx": {"$in": missing}},
+                        {"_id": 0, "idx": 1, "data": 1}):
+            row_data = bytes_to_arrays(row["data"])
+            idx = row["idx"]
+            result[idx] = row_data
+            cache.set(dataset, idx, row_data, copy=copy)
+        return result
+
+    @valid_dataset
+    def add_counts(self, dataset, data, start=0):
+        """insert rows into the counts table, without removing other rows
+
+        :param dataset: string or int, identifier for a dataset
+        :param data: list with rows to insert
+        :param start: integer, index for the first row
+        """
+
+        self.counts_cache.clear()
+        self._add_rows("counts", dataset, data, start)
 
     @valid_dataset
     def update_counts(self, dataset, data):
@@ -256,11 +430,86 @@ class CrossmapMongoDB:
         :param data: dict mapping indexes to csr_matrices
         """
 
-        self.counts_cache.clear()
-        for i, v in data.items():
-            i_bytes = csr_to_bytes(v)
-            self._counts.update_one({"dataset": dataset, "idx": i},
-                                    {"$set": {"data": i_bytes}})
+        self.counts_cache.remove(dataset, list(data.keys()))
+        self._update_rows("counts", dataset, data)
+
+    @valid_dataset
+    def add_diffusion(self, dataset, data, start=0):
+        """insert rows into the diffusion table
+
+        :param dataset: string or int, identifier for a dataset
+        :param data: list with rows to insert, counts prepared for diffusion
+        :param start: integer, index for the first row
+        """
+
+        self.diffusion_cache.clear()
+        self._remove_diffusion_matrix(dataset)
+        self._add_rows("diffusion", dataset, data, start)
+
+    @valid_dataset
+    def update_diffusion(self, dataset, data):
+        """change existing rows in the diffusion table, or add new rows
+
+        :param dataset: string or int, identifier for a dataset
+        :param data: dict mapping indexes to csr_matrices
+        """
+
+        self.diffusion_cache.remove(dataset, list(data.keys()))
+        self._update_rows("diffusion", dataset, data, upsert=True)
+        # rows in a local matrix are now outdated, readers use the db
+        matrix = self._diffusion_matrix(dataset)
+        if matrix is not None and exists(counts_matrix_files(matrix.path)[-1]):
+            record_counts_updates(matrix.path, list(data.keys()))
+
+    def _remove_diffusion_matrix(self, dataset):
+        """delete a local matrix that no longer matches the diffusion table
+
+        :param dataset: int, dataset identifier
+        """
+
+        labels = {v: k for k, v in self.datasets.items()}
+        self._remove_diffusion_matrices({labels[dataset]: dataset})
+
+    @valid_dataset
+    def save_diffusion_matrix(self, dataset, block_size=10000):
+        """write rows of the diffusion table into a local matrix
+
+        :param dataset: string or int, identifier for a dataset
+        :param block_size: integer, number of rows read from db at once
+        """
+
+        matrix = self._diffusion_matrix(dataset)
+        if matrix is None:
+            return
+        n_features = self.n_features
+        # updates recorded until now are captured in the new matrix
+        n_updates = count_counts_updates(matrix.path)
+        blocks = (self._diffusion_block(dataset, first,
+                                        min(n_features, first + block_size))
+                  for first in range(0, n_features, block_size))
+        save_counts_matrix(matrix.path, blocks, n_features)
+        trim_counts_updates(matrix.path, n_updates)
+
+    def _diffusion_block(self, dataset, first, last):
+        """read consecutive rows from the diffusion table
+
+        :param dataset: int, dataset identifier
+        :param first: integer, first row
+        :param last: integer, row after the last row
+        :return: csr matrix (rows missing in the table are empty)
+        """
+
+        rows = [(zeros(0, dtype=float64), zeros(0, dtype=int32))] * \
+            (last - first)
+        for row in self._diffusion.find({"dataset": dataset,
+                                         "idx": {"$gte": first, "$lt": last}},
+                                        {"_id": 0, "idx": 1, "data": 1}):
+            rows[row["idx"] - first] = bytes_to_arrays(row["data"])
+        indptr = concatenate([[0], cumsum([len(_[1]) for _ in rows])])
+        return FastCsrMatrix((concatenate([_[0] for _ in rows]),
+                              concatenate([_[1] for _ in rows]),
+                              indptr.astype(int64)),
+                             shape=(last - first, self.n_features))
 
     @valid_dataset
     def add_data(self, dataset, data, ids, idxs=None):
@@ -286,6 +535,13 @@ class CrossmapMongoDB:
                              "idx": idxs[i],
                              "data": csr_to_bytes(data[i])}
         self._data.insert_many(data_array)
+        store = self._vector_store(dataset, create=True)
+        if store is None:
+            return idxs
+        if list(idxs) == list(range(len(store), len(store) + n)):
+            store.append(data, ids)
+        else:
+            self._sync_vector_store(dataset, store)
         return idxs
 
     @valid_dataset
@@ -319,17 +575,37 @@ class CrossmapMongoDB:
             sparse indices, and a row sum
         """
 
-        result, missing = self.counts_cache.get(dataset, idxs)
-        if len(missing) == 0:
-            return result
-        find = self._counts.find
-        counts_cache = self.counts_cache
-        for row in find({"dataset": dataset, "idx": {"$in": missing}},
-                        {"_id": 0, "idx": 1, "data": 1}):
-            row_data = bytes_to_arrays(row["data"])
-            idx = row["idx"]
-            result[idx] = row_data
-            counts_cache.set(dataset, idx, row_data)
+        return self._get_rows_arrays("counts", self.counts_cache,
+                                     dataset, idxs)
+
+    @valid_dataset
+    def get_diffusion_arrays(self, dataset, idxs):
+        """retrieve rows prepared for diffusion
+
+        Uses a memory-mapped matrix when available, and the cache and
+        the db for other rows, including rows updated after the matrix
+        was written. The output arrays are shared with the matrix or
+        with the cache and must not be modified.
+
+        :param dataset: string or int, dataset identifier
+        :param idxs: list of integers
+        :return: dictionary mapping indexes to arrays with sparse data,
+            sparse indices, and a row sum
+        """
+
+        matrix = self._diffusion_matrix(dataset)
+        if matrix is None or not matrix.refresh():
+            return self._get_rows_arrays("diffusion", self.diffusion_cache,
+                                         dataset, idxs, copy=False)
+        # rows updated after the matrix was written are read from the db
+        # (possibly by another process, so cached copies are outdated)
+        self.diffusion_cache.remove(dataset, matrix.recent_updates)
+        result = matrix.get(idxs)
+        missing = [_ for _ in idxs if _ not in result]
+        if len(missing) > 0:
+            result.update(self._get_rows_arrays("diffusion",
+                                                self.diffusion_cache,
+                                                dataset, missing, copy=False))
         return result
 
     @valid_dataset
@@ -374,7 +650,10 @@ class CrossmapMongoDB:
 
     @valid_dataset
     def get_data(self, dataset, idxs=None, ids=None):
-        """retrieve objects from db
+        """retrieve data vectors
+
+        Vectors are read from the local vector store, with a fallback
+        onto the db for items not present in the store.
 
         Note: one of ids or idx must be specified other than None
 
@@ -394,6 +673,35 @@ class CrossmapMongoDB:
             queries, column = ids, "id"
         if queries is None or len(queries) == 0:
             return []
+        queries = list(dict.fromkeys(queries))
+        store = self._vector_store(dataset)
+        if store is None:
+            return self._get_data_db(dataset, queries, column)
+        if column == "id":
+            idxs = self.idxs(dataset, queries)
+            queries = [idxs[_] for _ in queries if _ in idxs]
+            if len(queries) == 0:
+                return []
+        # pick up rows appended by other processes
+        if max(queries) >= len(store):
+            store.refresh()
+        result = store.get(queries, n_features)
+        if len(result) == len(queries):
+            return result
+        found = set([_["idx"] for _ in result])
+        missing = [_ for _ in queries if _ not in found]
+        return result + self._get_data_db(dataset, missing, "idx")
+
+    def _get_data_db(self, dataset, queries, column):
+        """retrieve data vectors from db
+
+        :param dataset: int, dataset identifier
+        :param queries: list of string ids or integer indexes
+        :param column: string, "id" or "idx"
+        :return: list of dicts with id, idx, and data
+        """
+
+        n_features = self.n_features
         # attempt to get results from cache
         data_cache = self.data_cache
         result, missing = data_cache.get(dataset, queries)
@@ -419,10 +727,58 @@ class CrossmapMongoDB:
         """
 
         n_features = self.n_features
+        store = self._vector_store(dataset)
+        if store is not None:
+            store.refresh()
+            if len(store) == self.dataset_size(dataset):
+                yield from store.scan(n_features)
+                return
         for row in self._data.find({"dataset": dataset}, {"_id": 0}):
             yield dict(id=row["id"], idx=row["idx"],
                        data=bytes_to_csr(row["data"], n_features))
 
+    @valid_dataset
+    def filter_idxs(self, dataset, conditions, idxs=None):
+        """find items with metadata that satisfy a set of conditions
+
+        :param dataset: string or int, dataset identifier
+        :param conditions: dict mapping metadata fields to a value, or to
+            a list of acceptable values. (Metadata read from data files are
+            strings, so values also match their string representations)
+        :param idxs: list of integer indexes to check, or None to check all
+            items in the dataset
+        :return: set of integer indexes for items satisfying all conditions
+        """
+
+        query = {"dataset": dataset}
+        for k, v in conditions.items():
+            values = v if isinstance(v, list) else [v]
+            values = values + [str(_) for _ in values]
+            query["doc.metadata." + str(k)] = {"$in": values}
+        if idxs is not None:
+            query["idx"] = {"$in": list(idxs)}
+        return set([row["idx"] for row in
+                    self._docs.find(query, {"_id": 0, "idx": 1})])
+
+    @valid_dataset
+    def metadata_groups(self, dataset, field):
+        """group items in a dataset by the value of a metadata field
+
+        :param dataset: string or int, dataset identifier
+        :param field: string, name of a metadata field
+        :return: dict mapping metadata values to lists of integer indexes
+            (items with missing or non-scalar values are omitted)
+        """
+
+        key = "doc.metadata." + str(field)
+        result = dict()
+        query = {"dataset": dataset, key: {"$exists": True}}
+        for row in self._docs.find(query, {"_id": 0, "idx": 1, key: 1}):
+            value = row["doc"]["metadata"][field]
+            if isinstance(value, (str, int, float, bool)):
+                result.setdefault(value, []).append(row["idx"])
+        return result
+
     @valid_dataset
     def get_titles(self, dataset, idxs=None, ids=None):
         """retrieve information from db from targets or documents
@@ -469,6 +825,23 @@ class CrossmapMongoDB:
             result[row["idx"]] = row["id"]
         return result
 
+    @valid_dataset
+    def idxs(self, dataset, ids):
+        """convert string ids to integer indexes
+
+        :param dataset: string or int, identifier for a table
+        :param ids: iterable with string ids
+        :return: dict mapping elements of ids into integer indexes
+        """
+
+        if len(ids) == 0:
+            return dict()
+        result = dict()
+        for row in self._data.find({"dataset": dataset, "id": {"$in": ids}},
+                                   {"_id": 0, "id": 1, "idx": 1}):
+            result[row["id"]] = row["idx"]
+        return result
+
     @valid_dataset
     def has_id(self, dataset, id):
         """check if database has an item with specified string identifier
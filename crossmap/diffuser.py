@@ -6,14 +6,131 @@ values for certain features into other features. The way in which
 the diffusion spreads is controlled via connections stored in a db.
 """
 
+from glob import glob
 from logging import info, warning, error
-from math import sqrt
-from numpy import array
+from math import ceil, sqrt
+from multiprocessing import Pool
+from os import remove
+from numpy import abs as np_abs, arange, array, bincount, concatenate
+from numpy import cumsum, float64, int32, int64, maximum, repeat, where, zeros
+from numpy import diff, load, save, searchsorted, unique
+from scipy.sparse import csr_matrix, vstack
 from .dbmongo import CrossmapMongoDB as CrossmapDB
-from .csr import FastCsrMatrix, normalize_csr, threshold_csr
-from .csr import harmonic_multiply_sparse, diffuse_sparse, get_value_csr
-from .sparsevector import Sparsevector
-from .vectors import sparse_to_dense, sign_norm_vec, cap_vec
+from .csr import FastCsrMatrix, diffuse_csr_rows
+from .csr import harmonic_multiply_sparse, get_value_csr
+from .vectors import cap_vec
+
+
+# number of data vectors combined into one matrix product for counts
+counts_chunk_size = 8192
+
+# approximate memory for one nonzero element in counts matrices, in bytes
+# (value, column index, and temporary copies made during summation)
+counts_entry_bytes = 32
+
+
+def counts_product(vectors, nf, threshold=0.0):
+    """compute co-occurrence counts for a batch of data vectors
+
+    Each data vector is sign-normalized, i.e. positive values are replaced
+    by 1/(number of positive values) and negative values by
+    -1/(number of negative values). For each feature in a data vector,
+    the sign-normalized vector is added to the counts for that feature
+    (subtracted for features with non-positive values).
+
+    :param vectors: list of csr vectors
+    :param nf: integer, number of features
+    :param threshold: numeric, values in data vectors that are not greater
+        than this level (in absolute value) are ignored
+    :return: csr matrix (nf x nf), one row of counts per feature
+    """
+
+    shape = (len(vectors), nf)
+    if len(vectors) == 0:
+        return csr_matrix((nf, nf), dtype=float64)
+    data = concatenate([_.data for _ in vectors]).astype(float64)
+    indices = concatenate([_.indices for _ in vectors]).astype(int32)
+    rows = repeat(arange(len(vectors)), [len(_.data) for _ in vectors])
+    if threshold > 0:
+        keep = np_abs(data) > threshold
+        data, indices, rows = data[keep], indices[keep], rows[keep]
+    pos, neg = data > 0, data < 0
+    n_pos = bincount(rows[pos], minlength=len(vectors))
+    n_neg = bincount(rows[neg], minlength=len(vectors))
+    values = zeros(len(data), dtype=float64)
+    values[pos] = 1.0 / n_pos[rows[pos]]
+    values[neg] = -1.0 / n_neg[rows[neg]]
+    signs = where(pos, 1.0, -1.0)
+    s = csr_matrix((signs, (rows, indices)), shape=shape)
+    w = csr_matrix((values, (rows, indices)), shape=shape)
+    return csr_matrix(s.transpose().dot(w))
+
+
+def counts_rows(counts, threshold=0.0):
+    """split a matrix of counts into row vectors, with relative thresholds
+
+    :param counts: csr matrix (nf x nf)
+    :param threshold: numeric, entries are preserved only if they are
+        greater in absolute value than the threshold times the largest
+        value in the row
+    :return: list of csr vectors
+    """
+
+    nf = counts.shape[1]
+    data, indices = counts.data, counts.indices
+    indptr = counts.indptr.astype(int64)
+    if threshold != 0.0 and len(data) > 0:
+        lengths = indptr[1:] - indptr[:-1]
+        nonempty = (lengths > 0).nonzero()[0]
+        row_max = zeros(counts.shape[0], dtype=float64)
+        row_max[nonempty] = maximum.reduceat(data, indptr[nonempty])
+        keep = np_abs(data) > threshold * repeat(row_max, lengths)
+        data, indices = data[keep], indices[keep]
+        indptr = concatenate([[0], cumsum(keep)])[indptr]
+    return [FastCsrMatrix((data[indptr[i]:indptr[i+1]],
+                           indices[indptr[i]:indptr[i+1]],
+                           [0, indptr[i+1] - indptr[i]]), shape=(1, nf))
+            for i in range(counts.shape[0])]
+
+
+def diffusion_row(data, indices, index, weights):
+    """prepare one row of counts for use in diffusion
+
+    :param data: array of floats with counts (modified in-place)
+    :param indices: array of integers
+    :param index: integer, feature index for the row
+    :param weights: array with feature weights
+    :return: array of floats with counts scaled by the self-count, capped,
+        and adjusted by feature weights, or None if the self-count is zero
+    """
+
+    norm = sqrt(get_value_csr(data, indices, index))
+    if norm == 0.0:
+        return None
+    adjusted = cap_vec(data, norm) / norm
+    return harmonic_multiply_sparse(weights, adjusted, indices,
+                                    weights[index])
+
+
+def diffusion_rows(counts, first, weights):
+    """prepare consecutive rows of counts for use in diffusion
+
+    :param counts: list of csr vectors with counts
+    :param first: integer, feature index for the first row
+    :param weights: array with feature weights
+    :return: list of csr vectors (empty when the self-count is zero)
+    """
+
+    result = []
+    for i, v in enumerate(counts, first):
+        adjusted = diffusion_row(v.data.copy(), v.indices, i, weights)
+        if adjusted is None:
+            adjusted, indices = zeros(0), zeros(0, dtype=int32)
+        else:
+            indices = v.indices
+        result.append(FastCsrMatrix((adjusted, indices, [0, len(indices)]),
+                                    shape=(1, v.shape[1])))
+    return result
 
 
 def weights_arr(feature_map):
@@ -57,6 +174,7 @@ class CrossmapDiffuser:
         empty = FastCsrMatrix(([], [], [0, 0]), shape=(1, nf))
         result = [empty for _ in range(nf)]
         self.db.set_counts(dataset, result)
+        self.db.add_diffusion(dataset, result)
 
     def _build_counts(self, dataset):
         """construct co-occurrence records for one dataset
@@ -70,29 +188,28 @@ class CrossmapDiffuser:
             warning(msg + " - already exists")
             return
         info("Building diffusion index: " + dataset)
-        threshold = self.threshold
-        progress, total = self.settings.logging.progress, 0
-        fm = self.feature_map
-        nf = len(fm)
-        result = [Sparsevector() for _ in range(nf)]
-        for row in self.db.all_data(dataset):
-            total += 1
-            v = row["data"]
-            if threshold > 0:
-                v = threshold_csr(v, threshold)
-            v_pos, v_indices = sign_norm_vec(v.data), v.indices
-            v_neg = -v_pos
-            for i, d in zip(v_indices, v_pos):
-                if d > 0:
-                    result[i].add(v_indices, v_pos)
-                else:
-                    result[i].add(v_indices, v_neg)
-            if total % progress == 0:
-                info("Progress: " + str(total))
-        # replace dictionaries by csr_matrix (in place to save memory)
-        for _ in range(nf):
-            result[_] = result[_].to_csr(nf, threshold / 10)
-        self.db.set_counts(dataset, result)
+        settings = self.settings
+        nf = len(self.feature_map)
+        size = self.db.dataset_size(dataset)
+        workers = max(1, settings.build.workers)
+        budget = settings.build.counts_memory * pow(2, 20) // workers
+        tmp_prefix = settings.counts_tmp_file(dataset)
+        # compute partial counts for ranges of data rows
+        step = max(1, ceil(size / workers))
+        tasks = [(settings, dataset, nf, start, min(size, start + step),
+                  tmp_prefix + "-" + str(i), budget)
+                 for i, start in enumerate(range(0, size, step))]
+        parts = sum(_map_tasks(_counts_task, tasks, workers), [])
+        # merge partial counts for ranges of features
+        self.db.set_counts(dataset, [])
+        ranges = _counts_ranges(parts, nf, budget)
+        info("Merging diffusion counts in " + str(len(ranges)) + " blocks")
+        tasks = [(settings, dataset, nf, first, last, parts)
+                 for first, last in ranges]
+        _map_tasks(_merge_task, tasks, workers)
+        for f in glob(tmp_prefix + "-*"):
+            remove(f)
+        self.db.save_diffusion_matrix(dataset)
 
     def build(self):
         """populate count tables based on all data files"""
@@ -105,6 +222,9 @@ class CrossmapDiffuser:
     def update(self, dataset, data_idxs=()):
         """augment counts based on vectors from the data table
 
+        Changes due to all the data vectors are combined in memory, and
+        affected rows of counts are then written into the db together.
+
         :param dataset: string, dataset identifier
         :param data_idxs: list of integer indexes in the data table
         """
@@ -114,19 +234,60 @@ class CrossmapDiffuser:
         if num_rows == 0:
             self._set_empty_counts(dataset)
 
-        for row in self.db.get_data(dataset, idxs=data_idxs):
-            v = row["data"]
-            if len(v.indices) == 0:
-                continue
-            v.data = sign_norm_vec(v.data)
-            v_indices = [int(_) for _ in v.indices]
-            counts = self.db.get_counts(dataset, v_indices)
-            for i, d in zip(v_indices, v.data):
-                if d > 0:
-                    counts[i] += v
-                else:
-                    counts[i] -= v
-            self.db.update_counts(dataset, counts)
+        # accumulate changes for all data rows, in chunks
+        nf = len(self.feature_map)
+        data_idxs = list(data_idxs)
+        delta = csr_matrix((nf, nf), dtype=float64)
+        for first in range(0, len(data_idxs), counts_chunk_size):
+            chunk = data_idxs[first:first + counts_chunk_size]
+            rows = self.db.get_data(dataset, idxs=chunk)
+            delta = delta + counts_product([_["data"] for _ in rows], nf)
+        touched = (diff(delta.indptr) > 0).nonzero()[0]
+        if len(touched) == 0:
+            return
+        touched = [int(_) for _ in touched]
+        # merge changes with existing counts, and write all rows at once
+        current = self.db.get_counts(dataset, touched)
+        empty = FastCsrMatrix(([], [], [0, 0]), shape=(1, nf))
+        current = vstack([current.get(_, empty) for _ in touched],
+                         format="csr")
+        updated = counts_rows(current + delta[touched])
+        counts = dict(zip(touched, updated))
+        self.db.update_counts(dataset, counts)
+        self.db.update_diffusion(dataset, self._diffusion_update(counts))
+
+    def _diffusion_update(self, counts):
+        """prepare rows of counts for use in diffusion
+
+        :param counts: dict mapping feature indexes to csr vectors
+        :return: dict mapping feature indexes to csr vectors
+        """
+
+        weights = self.feature_weights
+        return {i: diffusion_rows([v], i, weights)[0]
+                for i, v in counts.items()}
+
+    def _diffusion_arrays(self, dataset, idxs):
+        """fetch rows of counts prepared for use in diffusion
+
+        (Rows that are not available in the diffusion table, e.g. in dbs
+        built by older versions, are prepared from raw counts)
+
+        :param dataset: string, dataset identifier
+        :param idxs: list of integer feature indexes
+        :return: dict mapping indexes to arrays with data and indices
+        """
+
+        result = self.db.get_diffusion_arrays(dataset, idxs)
+        missing = [_ for _ in idxs if _ not in result]
+        if len(missing) == 0:
+            return result
+        weights = self.feature_weights
+        for i, data in self.db.get_counts_arrays(dataset, missing).items():
+            adjusted = diffusion_row(data[0], data[1], i, weights)
+            if adjusted is not None:
+                result[i] = (adjusted, data[1])
+        return result
 
     def diffuse(self, v, strength):
         """create a new vector by diffusing values
@@ -138,42 +299,48 @@ class CrossmapDiffuser:
 
         if len(v.data) == 0:
             return v
+        return self.diffuse_batch(v, strength)
+
+    def diffuse_batch(self, vectors, strength):
+        """create new vectors by diffusing values, for several vectors at once
+
+        Counts rows are fetched from the db once for all the vectors,
+        and diffusion passes for all vectors run in one compiled loop.
+
+        :param vectors: csr matrix, one vector per row
+        :param strength: dict, diffusion strength from each dataset
+        :return: csr matrix with diffused vectors
+        """
 
-        num_passes = self.num_passes
-        weights = self.feature_weights
         strength = _nonzero_strength(strength)
-        if len(strength) == 0:
-            return v
-        result = sparse_to_dense(v)
+        if len(vectors.data) == 0 or len(strength) == 0:
+            return vectors
 
-        # fetch counts data from db, then re-use in multiple passes
-        v_indexes = [int(_) for _ in v.indices]
-        counts = dict()
-        hms = harmonic_multiply_sparse
+        # fetch prepared counts data from db once for all vectors
+        rows = unique(vectors.indices)
+        row_indexes = [int(_) for _ in rows]
+        c_data, c_indices, c_lengths = [], [], []
         for dataset in strength.keys():
-            temp = self.db.get_counts_arrays(dataset, v_indexes)
-            dataset_counts = dict()
-            for i, data in temp.items():
-                norm = sqrt(get_value_csr(data[0], data[1], i))
-                if norm == 0.0:
+            temp = self._diffusion_arrays(dataset, row_indexes)
+            for i in row_indexes:
+                data = temp.get(i, None)
+                if data is None:
+                    c_lengths.append(0)
                     continue
-                adjusted = cap_vec(data[0], norm) / norm
-                adjusted = hms(weights, adjusted, data[1], weights[i])
-                dataset_counts[i] = (adjusted, data[1])
-            counts[dataset] = dataset_counts
-
-        for pass_w in _pass_weights(num_passes):
-            last_result = result.copy()
-            for dataset, corpus_w in strength.items():
-                for i, data in counts[dataset].items():
-                    diffuse_sparse(result, last_result, i,
-                                   data[0] * pass_w * corpus_w,
-                                   data[1])
-
-        # cut feature with very low weights
-        val_min = min(abs(v.data))
-        result = normalize_csr(FastCsrMatrix(result))
-        return normalize_csr(threshold_csr(result, val_min/50))
+                c_data.append(data[0])
+                c_indices.append(data[1])
+                c_lengths.append(len(data[1]))
+        c_indptr = concatenate([[0], cumsum(c_lengths)]).astype(int64)
+        c_data = concatenate([zeros(0)] + c_data).astype(float64)
+        c_indices = concatenate([zeros(0)] + c_indices).astype(int32)
+
+        strengths = array(list(strength.values()), dtype=float64)
+        pass_weights = array(_pass_weights(self.num_passes), dtype=float64)
+        result = diffuse_csr_rows(vectors.data.astype(float64),
+                                  vectors.indices, vectors.indptr,
+                                  rows, c_data, c_indices, c_indptr,
+                                  strengths, pass_weights, vectors.shape[1])
+        return FastCsrMatrix(result, shape=vectors.shape)
 
 
 def _pass_weights(tot):
@@ -198,3 +365,113 @@ def _nonzero_strength(x):
             x.pop(k)
     return x
 
+
+def _map_tasks(f, tasks, workers):
+    """apply a function to several tasks, using several processes"""
+
+    workers = min(workers, len(tasks))
+    if workers < 2:
+        return [f(_) for _ in tasks]
+    with Pool(workers) as pool:
+        return pool.map(f, tasks)
+
+
+def _counts_task(task):
+    """compute counts for a range of data rows (in a process)
+
+    Counts are accumulated in memory and written into files whenever their
+    size exceeds a budget.
+
+    :param task: tuple with a CrossmapSettings object, a dataset label,
+        number of features, first and last data row, a prefix for
+        output files, and a memory budget in bytes
+    :return: list of prefixes for files with partial counts
+    """
+
+    settings, dataset, nf, start, end, prefix, budget = task
+    db = CrossmapDB(settings)
+    threshold = settings.diffusion.threshold
+    progress = settings.logging.progress
+    counts, parts = csr_matrix((nf, nf), dtype=float64), []
+    for first in range(start, end, counts_chunk_size):
+        last = min(end, first + counts_chunk_size)
+        rows = db.get_data(dataset, idxs=list(range(first, last)))
+        counts = counts + counts_product([_["data"] for _ in rows], nf,
+                                         threshold)
+        if counts.nnz * counts_entry_bytes > budget or last == end:
+            parts.append(prefix + "-" + str(len(parts)))
+            _save_counts(counts, parts[-1])
+            counts = csr_matrix((nf, nf), dtype=float64)
+        if (last - start) // progress > (first - start) // progress:
+            info("Progress: " + str(last - start) + " in " + prefix)
+    return parts
+
+
+def _save_counts(counts, prefix):
+    """write a matrix with partial counts into files"""
+
+    save(prefix + "-indptr.npy", counts.indptr.astype(int64))
+    save(prefix + "-indices.npy", counts.indices.astype(int32))
+    save(prefix + "-data.npy", counts.data.astype(float64))
+
+
+def _load_counts(prefix, first, last, nf):
+    """read a block of rows from partial counts written by _save_counts
+
+    :param prefix: string, prefix for files with partial counts
+    :param first: integer, first row
+    :param last: integer, row after the last row
+    :param nf: integer, number of features
+    :return: csr matrix
+    """
+
+    indptr = load(prefix + "-indptr.npy", mmap_mode="r")
+    a, b = indptr[first], indptr[last]
+    data = array(load(prefix + "-data.npy", mmap_mode="r")[a:b])
+    indices = array(load(prefix + "-indices.npy", mmap_mode="r")[a:b])
+    return csr_matrix((data, indices, array(indptr[first:last+1]) - a),
+                      shape=(last - first, nf))
+
+
+def _counts_ranges(parts, nf, budget):
+    """split features into ranges, each with bounded size of counts
+
+    :param parts: list of prefixes for files with partial counts
+    :param nf: integer, number of features
+    :param budget: integer, memory budget in bytes
+    :return: list of tuples with first and last (exclusive) features
+    """
+
+    nnz = zeros(nf, dtype=int64)
+    for prefix in parts:
+        nnz += diff(load(prefix + "-indptr.npy", mmap_mode="r"))
+    cumulative = cumsum(nnz)
+    limit = max(1, budget // counts_entry_bytes)
+    result, first = [], 0
+    while first < nf:
+        before = cumulative[first - 1] if first > 0 else 0
+        last = int(searchsorted(cumulative, before + limit, side="right"))
+        last = min(nf, max(first + 1, last))
+        result.append((first, last))
+        first = last
+    return result
+
+
+def _merge_task(task):
+    """sum partial counts for a range of features, store in db (in a process)
+
+    :param task: tuple with a CrossmapSettings object, a dataset label,
+        number of features, first and last feature, and a list of
+        prefixes for files with partial counts
+    """
+
+    settings, dataset, nf, first, last, parts = task
+    db = CrossmapDB(settings)
+    counts = csr_matrix((last - first, nf), dtype=float64)
+    for prefix in parts:
+        counts = counts + _load_counts(prefix, first, last, nf)
+    threshold = settings.diffusion.threshold / 10
+    rows = counts_rows(counts, threshold)
+    db.add_counts(dataset, rows, first)
+    weights = weights_arr(db.get_feature_map())
+    db.add_diffusion(dataset, diffusion_rows(rows, first, weights), first)
@@ -4,6 +4,8 @@ Distance calculations
 
 import numba
 from math import sqrt
+from numpy import array, maximum, zeros
+from numpy import sqrt as np_sqrt
 from .vectors import vec_norm, sparse_to_dense
 
 
@@ -36,3 +38,58 @@ def sparse_euc_distance(a, b):
     """compute distance between two sparse vectors items"""
 
     return euc_dist(sparse_to_dense(a), sparse_to_dense(b))
+
+
+def sparse_euc_distances(a, b):
+    """compute distances between all rows of two sparse matrices
+
+    :param a: csr matrix with m rows
+    :param b: csr matrix with n rows
+    :return: dense array of shape (m, n) with euclidean distances
+    """
+
+    products = a.dot(b.transpose()).toarray()
+    a_norms = array(a.multiply(a).sum(axis=1))
+    b_norms = array(b.multiply(b).sum(axis=1)).transpose()
+    return np_sqrt(maximum(a_norms + b_norms - 2*products, 0.0))
+
+
+@numba.njit
+def sparse_row_distances(q_indices, q_data, indptr, indices, data):
+    """compute distances between a sparse vector and rows of a csr matrix
+
+    (Indices for the vector and within each row must be sorted)
+
+    :param q_indices: array of integers, feature indexes for the vector
+    :param q_data: array of floats, values for the vector
+    :param indptr: array of integers, row pointers for the csr matrix
+    :param indices: array of integers, column indexes for the csr matrix
+    :param data: array of floats, values for the csr matrix
+    :return: array with one euclidean distance per row
+    """
+
+    n = len(indptr) - 1
+    q_n = len(q_indices)
+    result = zeros(n)
+    for r in range(n):
+        i, j, end = 0, indptr[r], indptr[r+1]
+        dist2 = 0.0
+        while i < q_n and j < end:
+            if q_indices[i] == indices[j]:
+                diff = q_data[i] - data[j]
+                dist2 += diff*diff
+                i += 1
+                j += 1
+            elif q_indices[i] < indices[j]:
+                dist2 += q_data[i]*q_data[i]
+                i += 1
+            else:
+                dist2 += data[j]*data[j]
+                j += 1
+        for ii in range(i, q_n):
+            dist2 += q_data[ii]*q_data[ii]
+        for jj in range(j, end):
+            dist2 += data[jj]*data[jj]
+        result[r] = sqrt(dist2)
+    return result
+
@@ -0,0 +1,67 @@
+"""
+Compact table of string identifiers stored in a memory-mapped file
+
+The file holds a count of items, an array of offsets, and a blob with
+all the identifiers encoded in utf-8. Identifiers are decoded one at a
+time on access, so a loaded table does not hold python strings for all
+the items in a dataset.
+"""
+
+from os import replace
+from numpy import array, cumsum, int64, memmap, uint8, zeros
+
+
+def write_id_table(path, ids):
+    """write a list of string identifiers into a file
+
+    (The file is replaced atomically, so tables mapped from an earlier
+    version of the file remain readable)
+
+    :param path: string, path to output file
+    :param ids: list of strings, identifiers ordered by integer index
+    """
+
+    encoded = [str(_).encode("utf-8") for _ in ids]
+    offsets = zeros(len(encoded) + 1, dtype=int64)
+    offsets[1:] = cumsum([len(_) for _ in encoded])
+    with open(path + ".tmp", "wb") as f:
+        f.write(array([len(encoded)], dtype=int64).tobytes())
+        f.write(offsets.tobytes())
+        f.write(b"".join(encoded))
+    replace(path + ".tmp", path)
+
+
+class IdTable:
+    """Read-only view of identifiers in a file, with optional extra items"""
+
+    def __init__(self, path):
+        """map a file created with write_id_table into memory
+
+        :param path: string, path to a file
+        """
+
+        raw = memmap(path, dtype=uint8, mode="r")
+        n = int(raw[:8].view(int64)[0])
+        start = 8 * (n + 2)
+        self.offsets = raw[8:start].view(int64)
+        self.blob = raw[start:]
+        self.size = n
+        # identifiers added after the file was written
+        self.extra = []
+
+    def __len__(self):
+        return self.size + len(self.extra)
+
+    def __getitem__(self, i):
+        if i >= self.size:
+            return self.extra[i - self.size]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+    def extend(self, ids):
+        """append identifiers (these are held in memory, not in the file)
+
+        :param ids: list of strings
+        """
+
+        self.extra.extend(ids)
@@ -4,18 +4,28 @@ Indexer of crossmap data for nearest-neighbor search
 
 import logging
 import nmslib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from json import dump, load
 from math import sqrt
-from os import remove
-from os.path import exists
+from multiprocessing import Pool
+from numpy import argsort
+from os import remove, replace, stat
+from os.path import exists, getsize
+from threading import RLock, Thread
 from logging import info, warning, error
-from scipy.sparse import vstack
+from scipy.sparse import csr_matrix, vstack
 from .dbmongo import CrossmapMongoDB as CrossmapDB
 from .tokenizer import CrossmapTokenizer
 from .encoder import CrossmapEncoder
 from .features import CrossmapFeatures
 from .csr import FastCsrMatrix
+from .invertedindex import InvertedIndex
+from .projectionindex import ProjectionIndex
+from .shardedindex import ShardedIndex, index_files, sharded_layout
+from .idtable import IdTable, write_id_table
 from .vectors import sparse_to_dense
-from .distance import euc_dist
+from .distance import euc_dist, sparse_euc_distances, sparse_row_distances
 
 
 # this removes the INFO messages from nmslib
@@ -27,6 +37,9 @@ sqrt2 = sqrt(2.0)
 # maximal distance to report
 max_distance = 1 - (1e-6)
 
+# initial over-fetch factor for search restricted by metadata
+filter_overfetch = 4
+
 
 class CrossmapIndexer:
     """Indexing data for crossmap"""
@@ -37,6 +50,16 @@ class CrossmapIndexer:
     indexes = dict()
     # identifiers for data items in the indexes
     item_ids = dict()
+    # data items not yet included in nmslib indexes
+    buffers = dict()
+    # order of recent use and estimated sizes of loaded indexes
+    index_usage = OrderedDict()
+    # descriptions of sub-indexes, and loaded sub-indexes
+    partitions = dict()
+    sub_indexes = dict()
+    # identities of loaded index files, and threads rebuilding indexes
+    index_stamps = dict()
+    rebuilds = dict()
 
     def __init__(self, settings, db=None):
         """initialize indexes and their links with the crossmap db
@@ -52,12 +75,26 @@ class CrossmapIndexer:
         feature_map = self.db.get_feature_map()
         self.encoder = CrossmapEncoder(feature_map, tokenizer)
         self.trim_search = self.settings.indexing.trim_search
+        self.threads = self.settings.indexing.threads
+        self.buffer_size = self.settings.indexing.buffer_size
+        self.rerank_factor = self.settings.indexing.rerank_factor
+        self.background_rebuild = self.settings.indexing.background_rebuild
+        self.lazy_load = self.settings.indexing.lazy_load
+        self.memory_budget = self.settings.indexing.memory_budget * pow(2, 20)
+        self.lock = RLock()
+        self.rebuilds = dict()
         self.clear()
 
     def clear(self):
         self.indexes = dict()
         self.index_files = dict()
         self.item_ids = dict()
+        self.buffers = dict()
+        self.index_usage = OrderedDict()
+        self.load_locks = dict()
+        self.partitions = dict()
+        self.sub_indexes = dict()
+        self.index_stamps = dict()
 
     def update(self, dataset, doc, id, rebuild=True):
         """augment an existing dataset with a new item
@@ -65,7 +102,8 @@ class CrossmapIndexer:
         :param dataset: string, dataset identifier
         :param doc: dict with item data_pos, data_neg, etc
         :param id: string, identifier for the new item
-        :param rebuild: boolean, True to rebuild index structures, False to skip
+        :param rebuild: boolean, True to make the new item (and any other
+            items not yet indexed) available for search, False to skip
         :return: integer index for the new data item
         """
 
@@ -77,9 +115,131 @@ class CrossmapIndexer:
         idxs = self.db.add_data(dataset, [v], [id], idxs=[size])
         self.db.add_docs(dataset, [doc], [id], idxs=[size])
         if rebuild:
-            self.rebuild_index(dataset)
+            self._sync_buffer(dataset)
         return idxs[0]
 
+    def _indexed_size(self, dataset):
+        """count data items available for search via index or buffer"""
+
+        result = 0
+        index = self._get_index(dataset)
+        if index is not None:
+            result += len(index)
+        if dataset in self.buffers:
+            result += len(self.buffers[dataset]["idxs"])
+        return result
+
+    def _sync_buffer(self, dataset):
+        """transfer data items that are not yet indexed into a buffer
+
+        Items in the buffer are searched by brute force. When the buffer
+        grows beyond a threshold, the items are merged into the index.
+
+        :param dataset: string, name of dataset
+        """
+
+        size = self.db.dataset_size(dataset)
+        start = self._indexed_size(dataset)
+        if start >= size:
+            return
+        index = self._get_index(dataset)
+        buffered = len(self.buffers.get(dataset, dict(idxs=[]))["idxs"])
+        compact = buffered + size - start > self.buffer_size
+        # nmslib hnsw indexes cannot be extended, so must be rebuilt
+        # (in the background, new items are buffered in the meantime)
+        if compact and not isinstance(index, InvertedIndex):
+            self.rebuild_index(dataset, wait=not self.background_rebuild)
+        elif compact:
+            self._compact_index(dataset, size)
+        with self.lock:
+            self._extend_buffer(dataset, size)
+
+    def _compact_index(self, dataset, size):
+        """merge items that are not yet indexed into an exact index
+
+        A new index is built from the posting lists of the existing index
+        and the new items, and is then installed in place of the existing
+        index (searches use the existing index until the swap).
+
+        :param dataset: string, name of dataset
+        :param size: integer, number of items in the dataset
+        """
+
+        index = self._get_index(dataset)
+        start = len(index)
+        rows = self.db.get_data(dataset, idxs=list(range(start, size)))
+        rows = sorted(rows, key=lambda x: x["idx"])
+        info("Compacting search index: " + dataset)
+        result = InvertedIndex()
+        if len(index.ids) > 0:
+            result.addDataPointBatch(index.postings.tocsr(), index.ids)
+        if len(rows) > 0:
+            result.addDataPointBatch(vstack([_["data"] for _ in rows],
+                                            format="csr"),
+                                     [_["idx"] for _ in rows])
+        result.createIndex()
+        item_ids = self._load_item_ids(dataset)
+        ids = [item_ids[_] for _ in range(start + len(rows))]
+        self._install_index(dataset, result, ids)
+
+    def _extend_buffer(self, dataset, size):
+        """append data items that are not yet indexed to a buffer
+
+        :param dataset: string, name of dataset
+        :param size: integer, number of items in the dataset
+        """
+
+        start = self._indexed_size(dataset)
+        if start >= size:
+            return
+        buffer = self.buffers.get(dataset, dict(idxs=[], data=None))
+        rows = self.db.get_data(dataset, idxs=list(range(start, size)))
+        rows = sorted(rows, key=lambda x: x["idx"])
+        self.buffers[dataset] = buffer
+        new_data = [_["data"] for _ in rows]
+        if buffer["data"] is not None:
+            new_data = [buffer["data"]] + new_data
+        buffer["data"] = vstack(new_data, format="csr")
+        buffer["idxs"].extend([_["idx"] for _ in rows])
+        if dataset in self.item_ids:
+            self.item_ids[dataset].extend([_["id"] for _ in rows])
+
+    def _new_index(self, dataset, shards=None):
+        """create an empty index object for a dataset
+
+        :param dataset: string, name of dataset
+        :param shards: integer, number of shards; when None, the number of
+            shards is determined by the settings
+        :return: an nmslib index, or an object with a compatible interface
+        """
+
+        indexing = self.settings.indexing
+        method = indexing.methods.get(dataset, "hnsw")
+        if shards is None:
+            shards = indexing.shards.get(dataset, 1)
+        if shards > 1:
+            return ShardedIndex(lambda: self._method_index(method),
+                                shards=shards, method=method)
+        return self._method_index(method)
+
+    def _method_index(self, method):
+        """create an empty index object using a specific indexing method
+
+        :param method: string, indexing method
+        :return: an nmslib index, or an object with a compatible interface
+        """
+
+        if method == "hnsw":
+            return nmslib.init(method="hnsw", space="l2_sparse",
+                               data_type=nmslib.DataType.SPARSE_VECTOR)
+        if method == "exact":
+            return InvertedIndex()
+        if method == "projection":
+            indexing = self.settings.indexing
+            return ProjectionIndex(dims=indexing.projection_dims,
+                                   candidates=indexing.projection_candidates)
+        raise Exception("invalid indexing method: " + str(method))
+
     def _build_data(self, files, dataset):
         """transfer data from files into a db table
 
@@ -128,23 +288,31 @@ class CrossmapIndexer:
         summary_fun = warning if offset == 0 else info
         summary_fun("Number of items: " + str(offset))
 
-    def _build_index(self, dataset):
-        """builds an Annoy index using data from documents on disk"""
+    def _build_index(self, dataset, rebuild=False):
+        """builds a search index using data from documents on disk
+
+        :param dataset: string, name of dataset
+        :param rebuild: logical, set True to replace an existing index
+        """
 
         index_file = self.settings.index_file(dataset)
-        if exists(index_file):
+        if exists(index_file) and not rebuild:
             warning("Skipping search index build: " + dataset)
             self._load_index(dataset)
             return
 
         info("Building search index: " + dataset)
         batch_size = self.settings.logging.progress
-        result = nmslib.init(method="hnsw", space="l2_sparse",
-                             data_type=nmslib.DataType.SPARSE_VECTOR)
+        result = self._new_index(dataset)
         items, idxs, num_items = [], [], 0
+        # (items added while the index is built are left for later)
+        ids = [None] * self.db.dataset_size(dataset)
         for row in self.db.all_data(dataset):
+            if row["idx"] >= len(ids):
+                continue
             items.append(row["data"])
             idxs.append(row["idx"])
+            ids[row["idx"]] = row["id"]
             if len(items) >= batch_size:
                 num_items += batch_size
                 info("Progress: " + str(num_items))
@@ -153,74 +321,539 @@ class CrossmapIndexer:
         if len(items) > 0:
             result.addDataPointBatch(vstack(items), idxs)
 
-        build_quality = self.settings.indexing.build_quality
-        result.createIndex(index_params={"efConstruction": build_quality},
+        result.createIndex(index_params=self._index_params(),
                            print_progress=False)
-        self.indexes[dataset] = result
-        self.index_files[dataset] = index_file
-        result.saveIndex(index_file, save_data=True)
+        self._install_index(dataset, result, ids)
+        self._build_partitions(dataset)
 
-    def rebuild_index(self, dataset):
-        """delete an existing index and force a rebuild
+    def _install_index(self, dataset, index, ids):
+        """save an index to disk and swap it in place of an existing index
 
-        :param dataset: string, name of dataset to rebuild
+        Files are written under temporary names and then renamed, so that
+        an index that is in use remains valid until the swap.
+
+        :param dataset: string, name of dataset
+        :param index: index object
+        :param ids: list of string identifiers for the indexed items
         """
 
         index_file = self.settings.index_file(dataset)
-        if exists(index_file):
-            remove(index_file)
-        self._build_index(dataset)
+        temp_file = index_file + ".new"
+        index.saveIndex(temp_file, save_data=True)
+        write_id_table(self.settings.ids_file(dataset), ids)
+        old_files = index_files(index_file)
+        new_files = index_files(temp_file)
+        # the main file is renamed last, it signals a complete index
+        for f in new_files[1:] + new_files[:1]:
+            if exists(f):
+                replace(f, index_file + f[len(temp_file):])
+        current = set(index_files(index_file))
+        for f in old_files:
+            if f not in current and exists(f):
+                remove(f)
+        with self.lock:
+            self._register_index(dataset, index, index_file)
+            self.item_ids.pop(dataset, None)
+            # items indexed by the new index are no longer buffered
+            buffer = self.buffers.pop(dataset, None)
+            if buffer is None:
+                return
+            keep = [i for i, idx in enumerate(buffer["idxs"])
+                    if idx >= len(ids)]
+            if len(keep) > 0:
+                self.buffers[dataset] = dict(
+                    idxs=[buffer["idxs"][_] for _ in keep],
+                    data=buffer["data"][keep])
+
+    def _index_params(self):
+        """parameters for constructing nmslib indexes"""
+
+        result = {"efConstruction": self.settings.indexing.build_quality}
+        # nmslib uses all available cores when indexThreadQty is absent
+        if self.threads > 0:
+            result["indexThreadQty"] = self.threads
+        return result
+
+    def _build_partitions(self, dataset):
+        """build sub-indexes holding items with specific metadata values
+
+        :param dataset: string, name of dataset
+        """
+
+        self.remove_partitions(dataset)
+        fields = self.settings.indexing.partitions.get(dataset, [])
+        if len(fields) == 0:
+            return
+        info("Building sub-indexes: " + dataset)
+        manifest = dict(size=len(self._get_index(dataset)), fields=[])
+        for j, field in enumerate(fields):
+            values = []
+            groups = self.db.metadata_groups(dataset, field)
+            for i, (value, idxs) in enumerate(groups.items()):
+                rows = self.db.get_data(dataset, idxs=idxs)
+                result = self._new_index(dataset, shards=1)
+                result.addDataPointBatch(vstack([_["data"] for _ in rows]),
+                                         [_["idx"] for _ in rows])
+                result.createIndex(index_params=self._index_params(),
+                                   print_progress=False)
+                index_file = self.settings.partition_index_file(dataset, j, i)
+                result.saveIndex(index_file, save_data=True)
+                values.append([value, len(rows)])
+            manifest["fields"].append([field, values])
+        with open(self.settings.partitions_file(dataset), "wt") as f:
+            dump(manifest, f)
+
+    def remove_partitions(self, dataset):
+        """remove sub-indexes for a dataset from memory and from disk
+
+        :param dataset: string, name of dataset
+        """
+
+        manifest = self._partitions(dataset)
+        self.partitions.pop(dataset, None)
+        for key in [_ for _ in self.sub_indexes.keys() if _[0] == dataset]:
+            self.sub_indexes.pop(key)
+        if manifest is None:
+            return
+        for j, (field, values) in enumerate(manifest["fields"]):
+            for i in range(len(values)):
+                index_file = self.settings.partition_index_file(dataset, j, i)
+                for f in index_files(index_file):
+                    if exists(f):
+                        remove(f)
+        remove(self.settings.partitions_file(dataset))
+
+    def _partitions(self, dataset):
+        """get a description of sub-indexes for a dataset
+
+        :param dataset: string, name of dataset
+        :return: dict with number of items covered by the sub-indexes and a
+            list of metadata fields and values, or None
+        """
+
+        if dataset not in self.partitions:
+            manifest = None
+            partitions_file = self.settings.partitions_file(dataset)
+            if exists(partitions_file):
+                with open(partitions_file, "rt") as f:
+                    manifest = load(f)
+            self.partitions[dataset] = manifest
+        return self.partitions[dataset]
+
+    def _get_sub_index(self, dataset, field, part):
+        """retrieve a sub-index, loading it from disk if necessary
+
+        :param dataset: string, name of dataset
+        :param field: integer, position of metadata field
+        :param part: integer, position of metadata value
+        :return: index object
+        """
+
+        key = (dataset, field, part)
+        if key not in self.sub_indexes:
+            result = self._new_index(dataset, shards=1)
+            settings = self.settings
+            index_file = settings.partition_index_file(dataset, field, part)
+            result.loadIndex(index_file, load_data=True)
+            search_quality = self.settings.indexing.search_quality
+            result.setQueryTimeParams({"efSearch": search_quality})
+            self.sub_indexes[key] = result
+        return self.sub_indexes[key]
+
+    def _filter_sources(self, dataset, metadata_filter):
+        """select indexes that can provide hits for a metadata filter
+
+        Sub-indexes are used when they cover one of the fields in the filter
+        and when they are up-to-date with the main index.
+
+        :param dataset: string, name of dataset
+        :param metadata_filter: dict mapping metadata fields to values
+        :return: list of index objects, and a boolean indicating whether
+            the hits from those indexes satisfy the entire filter
+        """
+
+        index = self._get_index(dataset)
+        main = [] if index is None else [index]
+        manifest = self._partitions(dataset)
+        if manifest is None or index is None or manifest["size"] != len(index):
+            return main, False
+        for j, (field, values) in enumerate(manifest["fields"]):
+            if field not in metadata_filter:
+                continue
+            wanted = metadata_filter[field]
+            wanted = wanted if isinstance(wanted, list) else [wanted]
+            wanted = set([str(_) for _ in wanted])
+            result = [self._get_sub_index(dataset, j, i)
+                      for i, (value, _) in enumerate(values)
+                      if str(value) in wanted]
+            return result, len(metadata_filter) == 1
+        return main, False
+
+    def rebuild_index(self, dataset, wait=True):
+        """build a new index for a dataset, replacing an existing index
+
+        The new index is built on a separate thread. Until it is ready,
+        searches use the existing index and a buffer of new items.
+
+        :param dataset: string, name of dataset to rebuild
+        :param wait: logical, set False to return before the rebuild is
+            complete
+        :return: thread performing the rebuild
+        """
+
+        with self.lock:
+            thread = self.rebuilds.get(dataset, None)
+            if thread is None or not thread.is_alive():
+                thread = Thread(target=self._rebuild, args=(dataset,))
+                self.rebuilds[dataset] = thread
+                thread.start()
+        if wait:
+            thread.join()
+        return thread
+
+    def _rebuild(self, dataset):
+        """build a new index and make it available for search"""
+
+        info("Rebuilding search index: " + dataset)
+        self._build_index(dataset, rebuild=True)
+        self._sync_buffer(dataset)
+
+    def wait(self):
+        """wait for all index rebuilds to complete"""
+
+        for thread in list(self.rebuilds.values()):
+            thread.join()
 
     def build(self):
-        """construct indexes for data collections"""
+        """construct indexes for data collections
+
+        With settings build.workers greater than one, independent datasets
+        are transferred into the db and indexed in separate processes.
+        """
 
         settings = self.settings
         self.clear()
         for dataset in settings.data.collections.keys():
             if dataset not in self.db.datasets:
                 self.db.register_dataset(dataset)
-        for dataset, filepath in settings.data.collections.items():
-            self._build_data(filepath, dataset)
-            self._build_index(dataset)
+        collections = list(settings.data.collections.items())
+        workers = min(settings.build.workers, len(collections))
+        if workers > 1:
+            info("Building datasets with " + str(workers) + " processes")
+            with Pool(workers) as pool:
+                pool.map(_build_dataset,
+                         [(settings, d, f) for d, f in collections])
+            for dataset, _ in collections:
+                self._load_index(dataset)
+        else:
+            for dataset, filepath in collections:
+                self._build_data(filepath, dataset)
+                self._build_index(dataset)
         self.db.get_feature_map()
 
+    def _register_index(self, dataset, index, index_file):
+        """record an index as loaded, evicting others to respect a budget
+
+        :param dataset: string, label identifier for the index
+        :param index: index object
+        :param index_file: string, path to file holding the index
+        """
+
+        size = 0
+        for f in index_files(index_file):
+            size += getsize(f) if exists(f) else 0
+        stamp = _file_stamp(index_file)
+        with self.lock:
+            self.indexes[dataset] = index
+            self.index_files[dataset] = index_file
+            self.index_stamps[dataset] = stamp
+            self.index_usage[dataset] = size
+            self.index_usage.move_to_end(dataset)
+            if self.memory_budget <= 0:
+                return
+            # evict least-recently used indexes (they can be loaded again)
+            for label in list(self.index_usage.keys())[:-1]:
+                if sum(self.index_usage.values()) <= self.memory_budget:
+                    break
+                info("Unloading search index: " + label)
+                self.indexes.pop(label, None)
+                self.index_usage.pop(label)
+
+    def _get_index(self, dataset):
+        """retrieve an index, loading it from disk if necessary
+
+        :param dataset: string, label identifier for the index
+        :return: index object, or None if the dataset does not have an index
+        """
+
+        with self.lock:
+            index = self.indexes.get(dataset, None)
+            if index is not None:
+                self.index_usage.move_to_end(dataset)
+                return index
+            if dataset not in self.index_files:
+                return None
+            dataset_lock = self.load_locks.setdefault(dataset, RLock())
+        # independent indexes can be loaded concurrently
+        with dataset_lock:
+            index = self.indexes.get(dataset, None)
+            if index is None:
+                index = self._load_index(dataset)
+                self._sync_buffer(dataset)
+        return index
+
+    def _index_for_file(self, index_file):
+        """create an empty index object compatible with an index file
+
+        :param index_file: string, path to an existing index file
+        :return: an nmslib index, or an object with a compatible interface
+        """
+
+        layout = sharded_layout(index_file)
+        if layout is None:
+            return None
+        method = layout["method"]
+        return ShardedIndex(lambda: self._method_index(method),
+                            shards=layout["shards"], method=method)
+
+    def _read_index(self, dataset):
+        """read an index from disk, without making it available for search
+
+        :param dataset: string, label identifier for the index
+        :return: index object
+        """
+
+        index_file = self.settings.index_file(dataset)
+        info("Loading search index: " + dataset)
+        # the layout on disk takes precedence over settings
+        result = self._index_for_file(index_file)
+        if result is None:
+            result = self._new_index(dataset, shards=1)
+        result.loadIndex(index_file, load_data=True)
+        search_quality = self.settings.indexing.search_quality
+        result.setQueryTimeParams({"efSearch": search_quality})
+        return result
+
     def _load_index(self, dataset):
         """retrieve a nmslib index from disk into memory
 
         :param dataset: string, label identifier for the index
-        :return: nothing, the internal state changes
+        :return: index object, or None if the index file does not exist
         """
         index_file = self.settings.index_file(dataset)
         if not exists(index_file):
             error("Skipping loading search index: " + dataset)
-            return
+            return None
 
-        info("Loading search index: " + dataset)
-        result = nmslib.init(method="hnsw", space="l2_sparse",
-                             data_type=nmslib.DataType.SPARSE_VECTOR)
-        result.loadIndex(index_file, load_data=True)
-        search_quality = self.settings.indexing.search_quality
-        result.setQueryTimeParams({"efSearch": search_quality})
-        self.indexes[dataset] = result
-        self.index_files[dataset] = index_file
+        result = self._read_index(dataset)
+        self._register_index(dataset, result, index_file)
+        return result
 
     def load(self):
-        """Load indexes from disk files"""
+        """Load indexes from disk files
 
-        self.clear()
-        for label in self.db.datasets.keys():
-            self._load_index(label)
+        Indexes are loaded in parallel threads, or, with settings
+        indexing.lazy_load, they are loaded on first use. Indexes that
+        are already loaded remain available for search until the new
+        indexes are ready.
+        """
+
+        labels = list(self.db.datasets.keys())
+        index_files = dict()
+        for label in labels:
+            # datasets with few items added at runtime may lack an index
+            index_file = self.settings.index_file(label)
+            if exists(index_file):
+                index_files[label] = index_file
+        # (indexes not yet in memory can be loaded on demand in the meantime)
+        with self.lock:
+            for label, index_file in index_files.items():
+                self.index_files.setdefault(label, index_file)
+        loaded = dict()
+        if not self.lazy_load and len(index_files) > 0:
+            with ThreadPoolExecutor(max_workers=len(index_files)) as pool:
+                indexes = pool.map(self._read_index, list(index_files.keys()))
+                loaded = dict(zip(index_files.keys(), indexes))
+        with self.lock:
+            self.clear()
+            self.index_files = index_files
+            for label, index in loaded.items():
+                self._register_index(label, index, index_files[label])
+        for label in labels:
+            if not self.lazy_load or label not in self.index_files:
+                self._sync_buffer(label)
+
+    def reload(self):
+        """load index files that have been replaced on disk
+
+        This picks up indexes rebuilt by another process. Each new index
+        is swapped in place of an existing index once it is ready.
+
+        :return: list of dataset labels with new indexes
+        """
+
+        result = []
+        for label in list(self.db.datasets.keys()):
+            index_file = self.settings.index_file(label)
+            if not exists(index_file):
+                continue
+            if self.index_stamps.get(label, None) == _file_stamp(index_file):
+                continue
+            result.append(label)
+            index = None
+            if label in self.indexes:
+                index = self._read_index(label)
+            with self.lock:
+                if index is not None:
+                    self._register_index(label, index, index_file)
+                else:
+                    # indexes that are not in memory are loaded on first use
+                    self.index_files[label] = index_file
+                    self.index_stamps[label] = _file_stamp(index_file)
+                self.item_ids.pop(label, None)
+                self.buffers.pop(label, None)
+                self.partitions.pop(label, None)
+                for key in [_ for _ in self.sub_indexes if _[0] == label]:
+                    self.sub_indexes.pop(key)
+            self._sync_buffer(label)
+        return result
+
+    def _neighbors_batch(self, vs, dataset, n=5, metadata_filter=None):
+        """get sets of neighbors for several documents in one query
+
+        :param vs: csr matrix, one row per query
+        :param dataset: string, name of index/dataset
+        :param n: integer, number of nearest neighbors for each query
+        :param metadata_filter: dict mapping metadata fields to a value or
+            to a list of values; hits must satisfy all the fields
+        :return: list with one tuple per query row, each holding
+            a list of integer indexes and an array of distances
+        """
+
+        if metadata_filter:
+            return self._filtered_neighbors_batch(vs, dataset, n,
+                                                  metadata_filter)
+        result = [([], []) for _ in range(vs.shape[0])]
+        index = self._get_index(dataset)
+        rerank = self._use_rerank([index])
+        if index is not None:
+            k = n * self.rerank_factor if rerank else n
+            temp = index.knnQueryBatch(vs, k, num_threads=self.threads)
+            result = [([int(_) for _ in nns], list(distances))
+                      for nns, distances in temp]
+            if rerank:
+                result = self._rerank(vs, result, dataset, n)
+        buffer = self.buffers.get(dataset, None)
+        if buffer is not None:
+            buffered = _brute_force_neighbors(vs, buffer, n)
+            result = [_merge_neighbors(a, b, n)
+                      for a, b in zip(result, buffered)]
+        return result
+
+    def _use_rerank(self, indexes):
+        """determine whether hits from indexes should be re-ranked
+
+        :param indexes: list of index objects
+        :return: logical
+        """
+
+        # exact indexes do not benefit from re-ranking
+        approximate = [_ for _ in indexes if _ is not None and
+                       not isinstance(_, (InvertedIndex, ProjectionIndex))]
+        return self.rerank_factor > 1 and len(approximate) > 0
+
+    def _rerank(self, vs, candidates, dataset, n):
+        """order candidate neighbors using exact distances
+
+        :param vs: csr matrix, one row per query
+        :param candidates: list with one tuple per query row, each holding
+            a list of integer indexes and a list of approximate distances
+        :param dataset: string, name of dataset
+        :param n: integer, number of nearest neighbors for each query
+        :return: list with one tuple per query row, each holding
+            a list of integer indexes and a list of exact distances
+        """
+
+        idxs = set([_ for nns, _d in candidates for _ in nns])
+        rows = self.db.get_data(dataset, idxs=list(idxs))
+        if len(rows) == 0:
+            return [(nns[:n], distances[:n]) for nns, distances in candidates]
+        positions = {row["idx"]: i for i, row in enumerate(rows)}
+        data = vstack([_["data"] for _ in rows], format="csr")
+        data.sort_indices()
+        vs = csr_matrix(vs, copy=True)
+        vs.sort_indices()
+        result = []
+        for i, (nns, _) in enumerate(candidates):
+            nns = [_ for _ in nns if _ in positions]
+            sub = data[[positions[_] for _ in nns]]
+            start, end = vs.indptr[i], vs.indptr[i+1]
+            distances = sparse_row_distances(vs.indices[start:end],
+                                             vs.data[start:end], sub.indptr,
+                                             sub.indices, sub.data)
+            top = argsort(distances, kind="stable")[:n]
+            result.append(([nns[_] for _ in top],
+                           [float(distances[_]) for _ in top]))
+        return result
+
+    def _filtered_neighbors_batch(self, vs, dataset, n, metadata_filter):
+        """get sets of neighbors that satisfy a filter on metadata
+
+        Indexes are queried for more than n neighbors and hits are checked
+        against the filter. Queries that do not collect n valid hits are
+        repeated with twice as many neighbors. As for searches without
+        filters, hits from approximate indexes are re-ranked using exact
+        distances when the rerank factor is larger than 1.
+
+        :param vs: csr matrix, one row per query
+        :param dataset: string, name of index/dataset
+        :param n: integer, number of nearest neighbors for each query
+        :param metadata_filter: dict mapping metadata fields to values
+        :return: list with one tuple per query row, each holding
+            a list of integer indexes and a list of distances
+        """
+
+        indexes, complete = self._filter_sources(dataset, metadata_filter)
+        buffer = self.buffers.get(dataset, None)
+        total = sum([len(_) for _ in indexes])
+        if buffer is not None:
+            total += len(buffer["idxs"])
+            complete = False
+        rerank = self._use_rerank(indexes)
+        m = n * self.rerank_factor if rerank else n
+        result = [([], []) for _ in range(vs.shape[0])]
+        pending, k = list(range(vs.shape[0])), m * filter_overfetch
+        while len(pending) > 0 and total > 0:
+            hits = [([], []) for _ in pending]
+            for index in [_ for _ in indexes if len(_) > 0]:
+                temp = index.knnQueryBatch(vs[pending], min(k, len(index)),
+                                           num_threads=self.threads)
+                hits = [_merge_neighbors(a, b, k) for a, b in zip(hits, temp)]
+            if buffer is not None:
+                temp = _brute_force_neighbors(vs[pending], buffer, k)
+                hits = [_merge_neighbors(a, b, k) for a, b in zip(hits, temp)]
+            allowed = set([int(_) for nns, _d in hits for _ in nns])
+            if not complete:
+                allowed = self.db.filter_idxs(dataset, metadata_filter,
+                                              list(allowed))
+            remaining = []
+            for i, (nns, distances) in zip(pending, hits):
+                valid = [(int(a), float(d)) for a, d in zip(nns, distances)
+                         if int(a) in allowed][:m]
+                if len(valid) < m and k < total:
+                    remaining.append(i)
+                    continue
+                result[i] = ([_[0] for _ in valid], [_[1] for _ in valid])
+            pending, k = remaining, 2 * k
+        if rerank:
+            result = self._rerank(vs, result, dataset, n)
+        return result
 
     def _neighbors(self, v, dataset, n=5, names=False):
         """get a set of neighbors for a document"""
 
-        if dataset not in self.indexes:
-            return [], []
-        get_nns = self.indexes[dataset].knnQueryBatch
-        temp = get_nns(FastCsrMatrix(v), n)
-        nns, distances = temp[0][0], temp[0][1]
-        nns = [int(_) for _ in nns]
-        if names:
+        nns, distances = self._neighbors_batch(FastCsrMatrix(v), dataset, n)[0]
+        if names and len(nns) > 0:
             nns_map = self.db.ids(dataset, nns)
             nns = [nns_map[_] for _ in nns]
         return nns, distances
@@ -239,10 +872,29 @@ class CrossmapIndexer:
         return self._neighbors(v, label, n, names=True)
 
     def _load_item_ids(self, dataset):
-        """cache string identifiers"""
+        """cache string identifiers
+
+        Identifiers are read from a table written during the index build.
+        Items added to the db after the build are looked up in the db.
 
-        if dataset not in self.item_ids:
-            self.item_ids[dataset] = self.db.all_ids(dataset)
+        :return: list-like object with identifiers ordered by integer index
+        """
+
+        result = self.item_ids.get(dataset, None)
+        if result is not None:
+            return result
+        ids_file = self.settings.ids_file(dataset)
+        if not exists(ids_file):
+            result = self.db.all_ids(dataset)
+            self.item_ids[dataset] = result
+            return result
+        result = IdTable(ids_file)
+        size = self.db.dataset_size(dataset)
+        if len(result) < size:
+            missing = self.db.ids(dataset, list(range(len(result), size)))
+            result.extend([missing[_] for _ in sorted(missing.keys())])
+        self.item_ids[dataset] = result
+        return result
 
     def distances(self, v, dataset, ids=[]):
         """get distances between a dense vector and items in the db"""
@@ -256,19 +908,9 @@ class CrossmapIndexer:
             distances.append(euc_dist(v_dense, d_dense)/sqrt2)
         return distances, ids
 
-    def suggest(self, v, dataset, n=5):
-        """suggest nearest neighbors using a composite algorithm
+    def _suggestions(self, neighbors, distances, item_ids):
+        """convert raw nmslib output into item ids and normalized distances"""
 
-        :param v: vector
-        :param dataset: string or integer, name of index/dataset
-        :param n: integer, number of nearest neighbors
-        :return: a list of items ids, a list of composite distances
-        """
-
-        self._load_item_ids(dataset)
-        v = FastCsrMatrix(v)
-        neighbors, distances = self._neighbors(v, dataset, n)
-        item_ids = self.item_ids[dataset]
         suggestions = [item_ids[_] for _ in neighbors]
         # Two entirely different unit vectors have a distance of sqrt(2)
         # The division below transforms output to [0, 1]
@@ -278,11 +920,74 @@ class CrossmapIndexer:
             suggestions = suggestions[:len(distances)]
         return suggestions, distances
 
+    def suggest(self, v, dataset, n=5):
+        """suggest nearest neighbors using a composite algorithm
+
+        :param v: vector
+        :param dataset: string or integer, name of index/dataset
+        :param n: integer, number of nearest neighbors
+        :return: a list of items ids, a list of composite distances
+        """
+
+        return self.suggest_batch(FastCsrMatrix(v), dataset, n)[0]
+
+    def suggest_batch(self, vs, dataset, n=5, metadata_filter=None):
+        """suggest nearest neighbors for many vectors at once
+
+        :param vs: csr matrix, one row per query
+        :param dataset: string or integer, name of index/dataset
+        :param n: integer, number of nearest neighbors for each query
+        :param metadata_filter: dict mapping metadata fields to a value or
+            to a list of values, used to restrict the nearest neighbors
+        :return: list with one tuple per query row, each holding
+            a list of item ids and a list of distances
+        """
+
+        result = self._neighbors_batch(vs, dataset, n, metadata_filter)
+        # (identifiers are looked up after search, as indexes can be swapped)
+        item_ids = self._load_item_ids(dataset)
+        return [self._suggestions(nns, distances, item_ids)
+                for nns, distances in result]
+
+    def suggest_datasets(self, vs, datasets, n=5, metadata_filter=None):
+        """suggest nearest neighbors for many vectors across several datasets
+
+        Indexes for the datasets are queried concurrently on threads
+        (nmslib releases the GIL during search) and hits are merged into
+        a single ranking.
+
+        :param vs: csr matrix, one row per query
+        :param datasets: list of dataset identifiers
+        :param n: integer, number of nearest neighbors for each query
+        :param metadata_filter: dict mapping metadata fields to a value or
+            to a list of values, used to restrict the nearest neighbors
+        :return: list with one tuple per query row, each holding a list of
+            item ids, a list of distances, and a list of dataset labels
+        """
+
+        for dataset in datasets:
+            self._load_item_ids(dataset)
+        with ThreadPoolExecutor(max_workers=max(1, len(datasets))) as pool:
+            per_dataset = list(pool.map(
+                lambda d: self.suggest_batch(vs, d, n, metadata_filter),
+                datasets))
+        result = []
+        for i in range(vs.shape[0]):
+            hits = []
+            for dataset, suggestions in zip(datasets, per_dataset):
+                ids, distances = suggestions[i]
+                hits.extend([(d, dataset, id)
+                             for id, d in zip(ids, distances)])
+            hits = sorted(hits, key=lambda x: x[0])[:n]
+            result.append(([_[2] for _ in hits], [_[0] for _ in hits],
+                           [_[1] for _ in hits]))
+        return result
+
     @property
     def valid(self):
         """summarizes if the object was initialized correctly"""
 
-        if len(self.indexes) == 0:
+        if len(self.index_files) == 0:
             return False
         if self.encoder.feature_map is None:
             return False
@@ -293,6 +998,62 @@ class CrossmapIndexer:
 
         result = ["Indexer",
                   "Feature map: \t" + str(len(self.encoder.feature_map)),
-                  "Num. Indexes:\t" + str(len(self.indexes))]
+                  "Num. Indexes:\t" + str(len(self.index_files))]
         return "\n".join(result)
 
+
+def _build_dataset(task):
+    """transfer one dataset into the db and build its index (in a process)
+
+    :param task: tuple with a CrossmapSettings object, a dataset label,
+        and a list of paths to data files
+    """
+
+    settings, dataset, filepath = task
+    indexer = CrossmapIndexer(settings)
+    indexer._build_data(filepath, dataset)
+    indexer._build_index(dataset)
+
+
+def _file_stamp(path):
+    """identify a version of a file (files replaced by renaming differ)
+
+    :param path: string, path to a file
+    :return: tuple with inode number and modification time
+    """
+
+    result = stat(path)
+    return result.st_ino, result.st_mtime_ns
+
+
+def _brute_force_neighbors(vs, buffer, n):
+    """find nearest neighbors by computing all distances
+
+    :param vs: csr matrix, one row per query
+    :param buffer: dict with a list of integer indexes and a csr matrix
+    :param n: integer, number of nearest neighbors for each query
+    :return: list with one tuple per query, each holding a list of
+        integer indexes and a list of l2 distances
+    """
+
+    idxs = buffer["idxs"]
+    distances = sparse_euc_distances(vs, buffer["data"])
+    result = []
+    for row in distances:
+        top = argsort(row, kind="stable")[:n]
+        result.append(([idxs[_] for _ in top], [float(row[_]) for _ in top]))
+    return result
+
+
+def _merge_neighbors(a, b, n):
+    """combine two sets of neighbors into one set ranked by distance
+
+    :param a: tuple with list of integer indexes, list of distances
+    :param b: tuple with list of integer indexes, list of distances
+    :param n: integer, number of neighbors to retain
+    :return: tuple with list of integer indexes, list of distances
+    """
+
+    merged = sorted(zip(list(a[1]) + list(b[1]), list(a[0]) + list(b[0])))
+    merged = merged[:n]
+    return [_[1] for _ in merged], [_[0] for _ in merged]
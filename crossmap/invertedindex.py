@@ -0,0 +1,205 @@
+"""
+Exact nearest-neighbor search using an inverted index
+
+The index stores data vectors as posting lists (one list per feature)
+along with the maximal absolute value in each list. Queries accumulate
+inner products feature-by-feature and use those maximal values to prune
+candidates in the style of the MaxScore algorithm. The output is exact
+and uses the same l2 distances as the nmslib 'l2_sparse' space.
+
+The class mimics the parts of the nmslib interface used by the indexer,
+so it can be used as a drop-in replacement for an nmslib index.
+"""
+
+from numpy import array, argsort, concatenate, cumsum, float32, float64
+from numpy import int32, int64, isin, load, savez, searchsorted, partition
+from numpy import sqrt, unique, bincount, zeros, abs as np_abs
+from numpy import maximum as np_maximum
+from scipy.sparse import csc_matrix, vstack
+
+
+class InvertedIndex:
+    """Exact sparse nearest-neighbor search using posting lists"""
+
+    def __init__(self):
+        self._pending_data, self._pending_ids = [], []
+        # posting lists, one column per feature
+        self.postings = csc_matrix((0, 0), dtype=float64)
+        # labels for rows, squared norms of rows, max-impact for features
+        self.ids = zeros(0, dtype=int64)
+        self.norms2 = zeros(0, dtype=float64)
+        self.max_impact = zeros(0, dtype=float64)
+        # row positions ordered by increasing norm (used for padding hits)
+        self._by_norm = zeros(0, dtype=int64)
+
+    def __len__(self):
+        return len(self.ids) + sum([len(_) for _ in self._pending_ids])
+
+    def addDataPointBatch(self, data, ids):
+        """register data vectors (ready to use after createIndex)
+
+        :param data: csr matrix, one row per data item
+        :param ids: list of integer labels for the rows
+        """
+
+        self._pending_data.append(data)
+        self._pending_ids.append(array(ids, dtype=int64))
+
+    def createIndex(self, index_params=None, print_progress=False):
+        """process registered data vectors into posting lists
+
+        :param index_params: not used, for consistency with nmslib
+        :param print_progress: not used, for consistency with nmslib
+        """
+
+        if len(self._pending_data) == 0:
+            return
+        data = vstack(self._pending_data, format="csr")
+        if len(self.ids) > 0:
+            data = vstack([self.postings.tocsr(), data], format="csr")
+        self.ids = concatenate([self.ids] + self._pending_ids)
+        self._pending_data, self._pending_ids = [], []
+        self.postings = csc_matrix(data, dtype=float64)
+        self.postings.sort_indices()
+        self.norms2 = array(data.multiply(data).sum(axis=1)).ravel()
+        max_impact = abs(self.postings).max(axis=0).toarray()
+        self.max_impact = max_impact.ravel().astype(float64)
+        self._by_norm = argsort(self.norms2, kind="stable")
+
+    def setQueryTimeParams(self, params=None):
+        """not used, for consistency with nmslib"""
+        pass
+
+    def saveIndex(self, path, save_data=True):
+        """write the index into a file
+
+        :param path: string, path to output file
+        :param save_data: not used, for consistency with nmslib
+        """
+
+        p = self.postings
+        with open(path, "wb") as f:
+            savez(f, data=p.data, indices=p.indices, indptr=p.indptr,
+                  shape=array(p.shape), ids=self.ids)
+
+    def loadIndex(self, path, load_data=True):
+        """read an index from a file
+
+        :param path: string, path to file created by saveIndex
+        :param load_data: not used, for consistency with nmslib
+        """
+
+        with open(path, "rb") as f:
+            raw = load(f)
+            shape = tuple(raw["shape"])
+            data = csc_matrix((raw["data"], raw["indices"], raw["indptr"]),
+                              shape=shape)
+            self.__init__()
+            self.addDataPointBatch(data.tocsr(), raw["ids"])
+        self.createIndex()
+
+    def knnQueryBatch(self, queries, k=10, num_threads=0):
+        """find nearest neighbors for several query vectors
+
+        :param queries: csr matrix, one row per query
+        :param k: integer, number of nearest neighbors
+        :param num_threads: not used, for consistency with nmslib
+        :return: list with one tuple per query, each holding an array
+            of integer labels and an array of l2 distances
+        """
+
+        result = []
+        for i in range(queries.shape[0]):
+            start, end = queries.indptr[i], queries.indptr[i+1]
+            result.append(self.knnQuery(queries.indices[start:end],
+                                        queries.data[start:end], k))
+        return result
+
+    def knnQuery(self, q_indices, q_data, k=10):
+        """find nearest neighbors for one query vector
+
+        :param q_indices: array of integers, feature indexes for the query
+        :param q_data: array of floats, values for the query
+        :param k: integer, number of nearest neighbors
+        :return: array of integer labels, array of l2 distances
+        """
+
+        k = min(k, len(self.ids))
+        if k == 0:
+            return zeros(0, dtype=int32), zeros(0, dtype=float32)
+        q_indices, q_data = array(q_indices), array(q_data, dtype=float64)
+        rows, dots = self._candidates(q_indices, q_data, k)
+        # ranking by l2 distance is ranking by dot - norm2/2
+        scores = dots - self.norms2[rows]/2
+        # rows without overlap with the query have zero product,
+        # they can outrank candidates with negative products
+        min_half_norm2 = self.norms2[self._by_norm[0]]/2
+        if len(rows) < k or \
+                partition(scores, len(rows)-k)[len(rows)-k] < -min_half_norm2:
+            rows, dots, scores = self._pad(rows, dots, scores, k)
+        top = argsort(-scores, kind="stable")[:k]
+        rows, dots = rows[top], dots[top]
+        q_norm2 = float((q_data*q_data).sum())
+        distances = sqrt(np_maximum(q_norm2 + self.norms2[rows] - 2*dots, 0))
+        return self.ids[rows].astype(int32), distances.astype(float32)
+
+    def _candidates(self, q_indices, q_data, k):
+        """accumulate inner products with MaxScore-style pruning
+
+        :param q_indices: array of integers, feature indexes for the query
+        :param q_data: array of floats, values for the query
+        :param k: integer, number of nearest neighbors
+        :return: array with row positions, array with exact inner products
+            between the query and those rows
+        """
+
+        postings = self.postings
+        indptr, indices = postings.indptr, postings.indices
+        data = postings.data
+        keep = q_indices < postings.shape[1]
+        q_indices, q_data = q_indices[keep], q_data[keep]
+        bounds = np_abs(q_data) * self.max_impact[q_indices]
+        order = argsort(-bounds, kind="stable")
+        # rest[j] is the largest possible contribution of terms after j
+        rest = concatenate([cumsum(bounds[order][::-1])[::-1][1:], [0.0]])
+        min_half_norm2 = self.norms2[self._by_norm[0]]/2
+        rows, dots = zeros(0, dtype=int32), zeros(0, dtype=float64)
+        admit = True
+        for j, term in enumerate(order):
+            feature, weight = q_indices[term], q_data[term]
+            start, end = indptr[feature], indptr[feature+1]
+            t_rows = indices[start:end]
+            t_values = data[start:end] * weight
+            if admit:
+                rows, inverse = unique(concatenate([rows, t_rows]),
+                                       return_inverse=True)
+                dots = bincount(inverse, concatenate([dots, t_values]),
+                                minlength=len(rows))
+            elif len(t_rows) > 0:
+                pos = searchsorted(t_rows, rows)
+                pos[pos == len(t_rows)] = 0
+                hit = t_rows[pos] == rows
+                dots[hit] += t_values[pos[hit]]
+            if len(rows) < k:
+                continue
+            # threshold: k-th best lower bound among the candidates
+            half_norm2 = self.norms2[rows]/2
+            lower = dots - half_norm2 - rest[j]
+            threshold = partition(lower, len(lower)-k)[len(lower)-k]
+            # rows not seen yet cannot score more than rest - norm2/2
+            if admit and rest[j] - min_half_norm2 < threshold:
+                admit = False
+            if not admit:
+                viable = dots - half_norm2 + rest[j] >= threshold
+                rows, dots = rows[viable], dots[viable]
+        return rows, dots
+
+    def _pad(self, rows, dots, scores, k):
+        """add rows without overlap with a query, i.e. with zero product"""
+
+        head = self._by_norm[:k+len(rows)]
+        extra = head[~isin(head, rows)][:k]
+        rows = concatenate([rows, extra])
+        dots = concatenate([dots, zeros(len(extra))])
+        scores = concatenate([scores, -self.norms2[extra]/2])
+        return rows, dots, scores
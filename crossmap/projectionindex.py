@@ -0,0 +1,230 @@
+"""
+Nearest-neighbor search on dense projections with exact re-ranking
+
+Sparse data vectors are projected onto a small number of dense dimensions
+using a truncated singular value decomposition fitted at build time. The
+dense vectors are indexed with an nmslib hnsw index in the 'l2' space.
+Queries retrieve several candidates per requested neighbor from the dense
+index, and candidates are then re-ranked using exact l2 distances against
+the original sparse vectors. Reported distances are thus the same as with
+the nmslib 'l2_sparse' space.
+
+The projection and the sparse vectors are stored in a file beside the
+nmslib index, and that file is memory-mapped after loading.
+
+The class mimics the parts of the nmslib interface used by the indexer,
+so it can be used as a drop-in replacement for an nmslib index.
+"""
+
+import nmslib
+from os import replace
+from numpy import argsort, array, concatenate, float32, float64, int32, int64
+from numpy import memmap, uint8, zeros
+from numpy.random import RandomState
+from scipy.sparse import csr_matrix, vstack
+from scipy.sparse.linalg import svds
+from .distance import sparse_euc_distances
+
+
+# maximal number of data items used to fit a projection
+fit_sample = 20000
+
+
+class ProjectionIndex:
+    """Approximate search on dense projections, with exact re-ranking"""
+
+    def __init__(self, dims=64, candidates=30, seed=0):
+        """create an empty index
+
+        :param dims: integer, number of dimensions for dense projections
+        :param candidates: integer, number of candidates retrieved from the
+            dense index per requested neighbor
+        :param seed: integer, seed for fitting projections
+        """
+
+        self.dims = dims
+        self.candidates = candidates
+        self.seed = seed
+        self._pending_data, self._pending_ids = [], []
+        self.dense = None
+        # projection matrix, one row per dense dimension
+        self.components = zeros((0, 0), dtype=float32)
+        # labels for rows and the original sparse vectors
+        self.ids = zeros(0, dtype=int64)
+        self.rows = csr_matrix((0, 0), dtype=float64)
+        self._query_params = None
+
+    def __len__(self):
+        return len(self.ids) + sum([len(_) for _ in self._pending_ids])
+
+    def addDataPointBatch(self, data, ids):
+        """register data vectors (ready to use after createIndex)
+
+        :param data: csr matrix, one row per data item
+        :param ids: list of integer labels for the rows
+        """
+
+        self._pending_data.append(data)
+        self._pending_ids.append(array(ids, dtype=int64))
+
+    def createIndex(self, index_params=None, print_progress=False):
+        """fit a projection and build a dense index for all data vectors
+
+        :param index_params: dict, parameters for the nmslib index
+        :param print_progress: logical, passed on to nmslib
+        """
+
+        if len(self._pending_data) == 0:
+            return
+        data = vstack(self._pending_data, format="csr", dtype=float64)
+        if len(self.ids) > 0:
+            data = vstack([self.rows, _conform(data, self.rows.shape[1])],
+                          format="csr")
+        self.ids = concatenate([self.ids] + self._pending_ids)
+        self._pending_data, self._pending_ids = [], []
+        self.rows = data
+        self.components = self._fit(data)
+        self.dense = _new_dense_index()
+        self.dense.addDataPointBatch(self._project(data),
+                                     list(range(data.shape[0])))
+        self.dense.createIndex(index_params=index_params,
+                               print_progress=print_progress)
+        if self._query_params is not None:
+            self.dense.setQueryTimeParams(self._query_params)
+
+    def _fit(self, data):
+        """compute a projection matrix from a sample of data vectors
+
+        :param data: csr matrix, one row per data item
+        :return: dense array with one row per dense dimension
+        """
+
+        generator = RandomState(self.seed)
+        if data.shape[0] > fit_sample:
+            sample = generator.choice(data.shape[0], fit_sample, replace=False)
+            data = data[sorted(sample)]
+        k = min(self.dims, min(data.shape) - 1)
+        if k < 1:
+            # data too small for a decomposition, use a random projection
+            result = generator.normal(size=(self.dims, data.shape[1]))
+            return (result / self.dims**0.5).astype(float32)
+        v0 = generator.uniform(size=min(data.shape))
+        _, _, vt = svds(data, k=k, v0=v0)
+        return vt.astype(float32)
+
+    def _project(self, data):
+        """compute dense projections for rows of a sparse matrix"""
+
+        data = _conform(data, self.components.shape[1])
+        return array(data.dot(self.components.T), dtype=float32)
+
+    def setQueryTimeParams(self, params=None):
+        """set parameters for querying the dense index
+
+        :param params: dict, parameters for the nmslib index
+        """
+
+        self._query_params = params
+        if self.dense is not None:
+            self.dense.setQueryTimeParams(params)
+
+    def saveIndex(self, path, save_data=True):
+        """write the dense index and a file with the projection and vectors
+
+        :param path: string, path to output file
+        :param save_data: not used, the dense index is saved with its data
+        """
+
+        self.dense.saveIndex(path, save_data=True)
+        rows = self.rows
+        header = array([len(self.ids), rows.shape[1],
+                        self.components.shape[0], rows.nnz], dtype=int64)
+        with open(path + ".projection.tmp", "wb") as f:
+            f.write(header.tobytes())
+            f.write(self.ids.astype(int64).tobytes())
+            f.write(rows.indptr.astype(int64).tobytes())
+            f.write(rows.data.astype(float32).tobytes())
+            f.write(self.components.astype(float32).tobytes())
+            f.write(rows.indices.astype(int32).tobytes())
+        replace(path + ".projection.tmp", path + ".projection")
+
+    def loadIndex(self, path, load_data=True):
+        """read an index from disk
+
+        :param path: string, path to file created by saveIndex
+        :param load_data: not used, the dense index is loaded with its data
+        """
+
+        raw = memmap(path + ".projection", dtype=uint8, mode="r")
+        n, n_features, dims, nnz = [int(_) for _ in raw[:32].view(int64)]
+        sizes = [8*n, 8*(n+1), 4*nnz, 4*dims*n_features, 4*nnz]
+        offsets = concatenate([[32], 32 + array(sizes).cumsum()])
+        parts = [raw[offsets[i]:offsets[i+1]] for i in range(len(sizes))]
+        self.ids = parts[0].view(int64)
+        indptr, data = parts[1].view(int64), parts[2].view(float32)
+        self.components = parts[3].view(float32).reshape(dims, n_features)
+        indices = parts[4].view(int32)
+        self.rows = csr_matrix((data, indices, indptr), shape=(n, n_features))
+        self.dense = _new_dense_index()
+        self.dense.loadIndex(path, load_data=True)
+        if self._query_params is not None:
+            self.dense.setQueryTimeParams(self._query_params)
+
+    def knnQueryBatch(self, queries, k=10, num_threads=0):
+        """find nearest neighbors for several query vectors
+
+        :param queries: csr matrix, one row per query
+        :param k: integer, number of nearest neighbors
+        :param num_threads: integer, number of threads for the dense index
+        :return: list with one tuple per query, each holding an array
+            of integer labels and an array of l2 distances
+        """
+
+        k = min(k, len(self.ids))
+        if k == 0:
+            empty = zeros(0, dtype=int32), zeros(0, dtype=float32)
+            return [empty for _ in range(queries.shape[0])]
+        n_candidates = min(len(self.ids), k * max(1, self.candidates))
+        width = self.rows.shape[1]
+        conformed = _conform(queries, width)
+        dense_hits = self.dense.knnQueryBatch(self._project(conformed),
+                                              n_candidates,
+                                              num_threads=num_threads)
+        # features absent from the data add a constant to all distances
+        extra = array(queries.multiply(queries).sum(axis=1)).ravel() - \
+            array(conformed.multiply(conformed).sum(axis=1)).ravel()
+        result = []
+        for i, (positions, _) in enumerate(dense_hits):
+            positions = array(positions, dtype=int64)
+            distances = sparse_euc_distances(conformed[i],
+                                             self.rows[positions])[0]
+            distances = (distances**2 + max(extra[i], 0))**0.5
+            top = argsort(distances, kind="stable")[:k]
+            result.append((self.ids[positions[top]].astype(int32),
+                           distances[top].astype(float32)))
+        return result
+
+
+def _new_dense_index():
+    """create an empty nmslib index for dense vectors"""
+
+    return nmslib.init(method="hnsw", space="l2",
+                       data_type=nmslib.DataType.DENSE_VECTOR)
+
+
+def _conform(data, width):
+    """adjust the number of columns in a csr matrix
+
+    :param data: csr matrix
+    :param width: integer, number of columns in the output
+    :return: csr matrix with the same rows as data, without entries in
+        columns beyond width
+    """
+
+    data = csr_matrix(data)
+    if data.shape[1] == width:
+        return data
+    if data.shape[1] > width:
+        data = data[:, :width]
+    return csr_matrix((data.data, data.indices, data.indptr),
+                      shape=(data.shape[0], width))
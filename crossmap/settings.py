@@ -13,6 +13,7 @@ from .subsettings import \
     CrossmapServerSettings, \
     CrossmapFeatureSettings, \
     CrossmapIndexingSettings, \
+    CrossmapBuildSettings, \
     CrossmapDiffusionSettings, \
     CrossmapTokenSettings, \
     CrossmapCacheSettings
@@ -35,6 +36,8 @@ class CrossmapSettingsDefaults:
         self.features = CrossmapFeatureSettings()
         # settings for indexing and search quality
         self.indexing = CrossmapIndexingSettings()
+        # settings for parallel processing during build
+        self.build = CrossmapBuildSettings()
         # setting for diffusion
         self.diffusion = CrossmapDiffusionSettings()
         # settings for tokens (e.g. kmer length)
@@ -84,6 +87,35 @@ class CrossmapSettingsDefaults:
         """path for a project indexer file"""
         return self._filepath(label, "-index.dat")
 
+    def vectors_file(self, label):
+        """prefix for files of a vector store"""
+        return self._filepath(label, "-vectors")
+
+    def diffusion_file(self, label):
+        """prefix for files with a matrix of counts prepared for diffusion"""
+        return self._filepath(label, "-diffusion")
+
+    def counts_tmp_file(self, label):
+        """prefix for temporary files used while building counts"""
+        return self._filepath(label, "-counts-tmp")
+
+    def ids_file(self, label):
+        """path for a table of item identifiers"""
+        return self._filepath(label, "-ids")
+
+    def partitions_file(self, label):
+        """path for a description of sub-indexes"""
+        return self._filepath(label, "-partitions.json")
+
+    def partition_index_file(self, label, field, part):
+        """path for a sub-index file
+
+        :param label: string, dataset label
+        :param field: integer, position of metadata field in partitions file
+        :param part: integer, position of metadata value for the field
+        """
+        return self._filepath(label, "-index-" + str(field) + "-" + str(part))
+
 
 class CrossmapSettings(CrossmapSettingsDefaults):
     """Container with settings for a Crossmap project"""
@@ -139,6 +171,8 @@ class CrossmapSettings(CrossmapSettingsDefaults):
                 self.server = CrossmapServerSettings(v)
             elif k == "indexing":
                 self.indexing = CrossmapIndexingSettings(v)
+            elif k == "build":
+                self.build = CrossmapBuildSettings(v)
             elif k == "diffusion":
                 self.diffusion = CrossmapDiffusionSettings(v)
             elif k == "logging":
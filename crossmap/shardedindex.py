@@ -0,0 +1,189 @@
+"""
+Nearest-neighbor search over a dataset split into several indexes
+
+Data items are assigned to shards using their integer labels (label modulo
+the number of shards). Shards are built concurrently on threads, and
+queries are sent to all shards concurrently; the hits are then merged into
+a single ranking.
+
+On disk, each shard is saved next to the main index path. The main path
+holds a small json file recording the shard layout, so that a sharded
+index can be loaded without knowing how it was built.
+
+The class mimics the parts of the nmslib interface used by the indexer,
+so it can be used as a drop-in replacement for an nmslib index.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps, loads
+from os import replace
+from os.path import exists
+from numpy import argsort, array, concatenate, float32, int32, int64, zeros
+
+
+# prefix that identifies files with a shard layout
+layout_prefix = b'{"sharded"'
+
+
+def shard_path(path, shard):
+    """path for one shard of an index
+
+    :param path: string, path to the main index file
+    :param shard: integer, shard number
+    :return: string
+    """
+
+    return path + ".shard" + str(shard)
+
+
+def sharded_layout(path):
+    """read a shard layout from an index file
+
+    :param path: string, path to an index file
+    :return: dict with a shard layout, or None if the file does not
+        describe a sharded index
+    """
+
+    if not exists(path):
+        return None
+    with open(path, "rb") as f:
+        if f.read(len(layout_prefix)) != layout_prefix:
+            return None
+        f.seek(0)
+        return loads(f.read().decode("utf-8"))
+
+
+def index_files(path):
+    """list all files that can belong to an index
+
+    :param path: string, path to the main index file
+    :return: list of paths (some of these may not exist)
+    """
+
+    result = [path, path + ".dat", path + ".projection"]
+    layout = sharded_layout(path)
+    if layout is not None:
+        for i in range(layout["shards"]):
+            result.extend(index_files(shard_path(path, i)))
+    return result
+
+
+class ShardedIndex:
+    """Search over several indexes, each holding part of a dataset"""
+
+    def __init__(self, new_index, shards=2, method="hnsw"):
+        """create an index with empty shards
+
+        :param new_index: function without arguments that creates an empty
+            nmslib index, or an object with a compatible interface
+        :param shards: integer, number of shards
+        :param method: string, indexing method used by the shards
+        """
+
+        self.method = method
+        self.shards = [new_index() for _ in range(shards)]
+        self._pool = None
+
+    def __len__(self):
+        return sum([len(_) for _ in self.shards])
+
+    def _map(self, f, shards):
+        """apply a function to several shards concurrently"""
+
+        if len(shards) < 2:
+            return [f(_) for _ in shards]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=len(self.shards))
+        return list(self._pool.map(f, shards))
+
+    def addDataPointBatch(self, data, ids):
+        """register data vectors (ready to use after createIndex)
+
+        :param data: csr matrix, one row per data item
+        :param ids: list of integer labels for the rows
+        """
+
+        ids = array(ids, dtype=int64)
+        assignment = ids % len(self.shards)
+        for i, shard in enumerate(self.shards):
+            rows = (assignment == i).nonzero()[0]
+            if len(rows) > 0:
+                shard.addDataPointBatch(data[rows], ids[rows])
+
+    def createIndex(self, index_params=None, print_progress=False):
+        """build all shards concurrently
+
+        :param index_params: dict, parameters passed on to the shards
+        :param print_progress: logical, passed on to the shards
+        """
+
+        def create(shard):
+            shard.createIndex(index_params=index_params,
+                              print_progress=print_progress)
+        self._map(create, [_ for _ in self.shards if len(_) > 0])
+
+    def setQueryTimeParams(self, params=None):
+        """set query parameters for all shards
+
+        :param params: dict, parameters passed on to the shards
+        """
+
+        for shard in self.shards:
+            if len(shard) > 0:
+                shard.setQueryTimeParams(params)
+
+    def saveIndex(self, path, save_data=True):
+        """write all shards and a file describing the layout
+
+        :param path: string, path to the main index file
+        :param save_data: logical, passed on to the shards
+        """
+
+        for i, shard in enumerate(self.shards):
+            if len(shard) > 0:
+                shard.saveIndex(shard_path(path, i), save_data=save_data)
+        layout = dict(sharded=True, method=self.method,
+                      shards=len(self.shards),
+                      sizes=[len(_) for _ in self.shards])
+        with open(path + ".tmp", "wt") as f:
+            f.write(dumps(layout))
+        replace(path + ".tmp", path)
+
+    def loadIndex(self, path, load_data=True):
+        """read shards from disk
+
+        :param path: string, path to the main index file
+        :param load_data: logical, passed on to the shards
+        """
+
+        layout = sharded_layout(path)
+        for i, (shard, size) in enumerate(zip(self.shards, layout["sizes"])):
+            if size > 0:
+                shard.loadIndex(shard_path(path, i), load_data=load_data)
+
+    def knnQueryBatch(self, queries, k=10, num_threads=0):
+        """find nearest neighbors for several query vectors in all shards
+
+        :param queries: csr matrix, one row per query
+        :param k: integer, number of nearest neighbors
+        :param num_threads: integer, number of threads for each shard
+        :return: list with one tuple per query, each holding an array
+            of integer labels and an array of l2 distances
+        """
+
+        def query(shard):
+            return shard.knnQueryBatch(queries, min(k, len(shard)),
+                                       num_threads=num_threads)
+        per_shard = self._map(query, [_ for _ in self.shards if len(_) > 0])
+        result = []
+        for i in range(queries.shape[0]):
+            hits = [_[i] for _ in per_shard]
+            if len(hits) == 0:
+                result.append((zeros(0, dtype=int32), zeros(0, dtype=float32)))
+                continue
+            ids = concatenate([array(_[0], dtype=int32) for _ in hits])
+            distances = concatenate([array(_[1], dtype=float32)
+                                     for _ in hits])
+            top = argsort(distances, kind="stable")[:k]
+            result.append((ids[top], distances[top]))
+        return result
@@ -124,6 +124,34 @@ class CrossmapIndexingSettings:
         self.trim_search = 1
         self.build_quality = 200
         self.search_quality = 200
+        # number of threads for nmslib (search and index construction),
+        # 0 signals all available cores
+        self.threads = 0
+        # number of added items searched by brute force before re-indexing
+        self.buffer_size = 1000
+        # indexing method for specific datasets,
+        # 'hnsw' (default), 'exact', or 'projection'
+        self.methods = dict()
+        # dense dimensions for 'projection' indexes, and number of
+        # candidates (per requested neighbor) re-ranked using exact distances
+        self.projection_dims = 64
+        self.projection_candidates = 30
+        # rebuild indexes in the background after many items are added
+        self.background_rebuild = 1
+        # number of shards for indexes for specific datasets
+        self.shards = dict()
+        # number of candidates (per requested neighbor) retrieved from
+        # approximate indexes and re-ranked using exact distances
+        self.rerank_factor = 1
+        # number of candidates retrieved at once for decompositions,
+        # 0 signals a new search for each component
+        self.decompose_pool = 0
+        # load indexes on first use instead of at startup
+        self.lazy_load = 0
+        # memory for loaded indexes in megabytes, 0 signals no limit
+        self.memory_budget = 0
+        # metadata fields for building sub-indexes for specific datasets
+        self.partitions = dict()
 
         if config is None:
             return
@@ -134,11 +162,73 @@ class CrossmapIndexingSettings:
                 self.search_quality = int(val)
             elif key == "trim_search":
                 self.trim_search = int(val)
+            elif key == "threads":
+                self.threads = int(val)
+            elif key == "buffer_size":
+                self.buffer_size = int(val)
+            elif key == "methods":
+                self.methods = {k: str(v) for k, v in val.items()}
+            elif key == "projection_dims":
+                self.projection_dims = int(val)
+            elif key == "projection_candidates":
+                self.projection_candidates = int(val)
+            elif key == "background_rebuild":
+                self.background_rebuild = int(val)
+            elif key == "shards":
+                self.shards = {k: int(v) for k, v in val.items()}
+            elif key == "rerank_factor":
+                self.rerank_factor = int(val)
+            elif key == "decompose_pool":
+                self.decompose_pool = int(val)
+            elif key == "lazy_load":
+                self.lazy_load = int(val)
+            elif key == "memory_budget":
+                self.memory_budget = int(val)
+            elif key == "partitions":
+                self.partitions = {k: [str(_) for _ in v]
+                                   for k, v in val.items()}
 
     def __str__(self):
         result = dict(indexing={"build_quality": self.build_quality,
                                 "search_quality": self.search_quality,
-                                "trim_search": self.trim_search})
+                                "trim_search": self.trim_search,
+                                "threads": self.threads,
+                                "buffer_size": self.buffer_size,
+                                "methods": self.methods,
+                                "projection_dims": self.projection_dims,
+                                "projection_candidates":
+                                    self.projection_candidates,
+                                "background_rebuild":
+                                    self.background_rebuild,
+                                "shards": self.shards,
+                                "rerank_factor": self.rerank_factor,
+                                "decompose_pool": self.decompose_pool,
+                                "lazy_load": self.lazy_load,
+                                "memory_budget": self.memory_budget,
+                                "partitions": self.partitions})
+        return dump(result)
+
+
+class CrossmapBuildSettings:
+    """Container for settings for the build stage"""
+
+    def __init__(self, config=None):
+        # number of processes for transferring datasets into the db
+        self.workers = 1
+        # memory for building diffusion counts in megabytes
+        self.counts_memory = 1024
+
+        if config is None:
+            return
+        for key, val in config.items():
+            if key == "workers":
+                self.workers = int(val)
+            elif key == "counts_memory":
+                self.counts_memory = int(val)
+
+    def __str__(self):
+        result = dict(build={"workers": self.workers,
+                             "counts_memory": self.counts_memory})
         return dump(result)
 
 
@@ -226,6 +316,9 @@ class CrossmapCacheSettings:
         self.data = 16384
         self.ids = 8192
         self.titles = 4096
+        # memory for query results in megabytes, and time-to-live in seconds
+        self.results = 64
+        self.results_ttl = 600
 
         if config is None:
             return
@@ -238,11 +331,17 @@ class CrossmapCacheSettings:
                 self.titles = int(val)
             elif key == "data":
                 self.data = int(val)
+            elif key == "results":
+                self.results = int(val)
+            elif key == "results_ttl":
+                self.results_ttl = float(val)
 
     def __str__(self):
         result = dict(cache={"counts": self.counts,
                              "titles": self.titles,
                              "ids": self.ids,
-                             "data": self.data})
+                             "data": self.data,
+                             "results": self.results,
+                             "results_ttl": self.results_ttl})
         return dump(result)
 
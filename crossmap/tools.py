@@ -7,6 +7,7 @@ import gzip
 import yaml
 import pickle
 import re
+import sys
 from json import dumps
 from logging import error
 from yaml import CBaseLoader
@@ -226,6 +227,30 @@ def json_print(x, pretty=False, **kwargs):
     print_pipesafe(x)
 
 
+def jsonl_print(x, flush_interval=100, **kwargs):
+    """print items from an iterable as json strings, one item per line
+
+    :param x: iterable, e.g. a list or a generator, or a dict (printed
+        as a single item)
+    :param flush_interval: integer, number of lines between flushes of
+        the output stream
+    :param kwargs: other arguments not used, here for consistency with
+        json_print
+    """
+
+    if isinstance(x, dict):
+        x = [x]
+    out = sys.stdout
+    try:
+        for i, xi in enumerate(x):
+            out.write(dumps(xi) + "\n")
+            if (i + 1) % flush_interval == 0:
+                out.flush()
+        out.flush()
+    except BrokenPipeError:
+        pass
+
+
 def _max_depth(z):
     """get maximal length of lists stored in a dictionary"""
     depth = 0
@@ -4,8 +4,9 @@ Handling vectors and vector decompositions
 
 import numba
 from math import sqrt
-from numpy import matmul
+from numpy import matmul, zeros
 from numpy.linalg import lstsq
+from scipy.linalg import solve_triangular
 
 
 @numba.jit
@@ -184,6 +185,70 @@ def vec_decomposition(v_t, b_t):
     return x
 
 
+def gram_append(gram, g, gamma):
+    """extend a Gram matrix by one vector
+
+    :param gram: matrix with inner products between basis vectors (k x k)
+    :param g: array with inner products between the new vector and the
+        existing basis vectors (k)
+    :param gamma: squared norm of the new vector
+    :return: matrix (k+1 x k+1)
+    """
+    k = gram.shape[0]
+    result = zeros((k+1, k+1))
+    result[:k, :k] = gram
+    result[k, :k] = g
+    result[:k, k] = g
+    result[k, k] = gamma
+    return result
+
+
+def cholesky_append(factor, g, gamma, tol=1e-10):
+    """extend a Cholesky factor of a Gram matrix by one vector
+
+    The Gram matrix G holds inner products between basis vectors and has
+    a factorization G = LL'. Adding a new basis vector adds one row and
+    one column to G, and one row to L.
+
+    :param factor: lower-triangular matrix L (k x k)
+    :param g: array with inner products between the new vector and the
+        existing basis vectors (k)
+    :param gamma: squared norm of the new vector
+    :param tol: relative tolerance for a positive-definite result
+    :return: lower-triangular matrix (k+1 x k+1), or None if the new vector
+        is (nearly) a linear combination of the existing basis vectors
+    """
+    k = factor.shape[0]
+    l = solve_triangular(factor, g, lower=True) if k > 0 else zeros(0)
+    d2 = gamma - l.dot(l)
+    if d2 <= tol * max(gamma, 1.0):
+        return None
+    result = zeros((k+1, k+1))
+    result[:k, :k] = factor
+    result[k, :k] = l
+    result[k, k] = sqrt(d2)
+    return result
+
+
+def gram_decomposition(factor, gram, b):
+    """solves a linear set of equations involving a Gram matrix
+
+    The underlying model is Gx = b, where G is the Gram matrix of a basis
+    and b holds inner products between a vector and the basis vectors.
+    This is equivalent to vec_decomposition, given G and b.
+
+    :param factor: lower-triangular Cholesky factor of G, or None
+    :param gram: matrix G, used when the factor is None
+    :param b: array, inner products with the basis vectors (k x 1)
+    :return: a vector with coefficients (k x 1)
+    """
+    if factor is None:
+        x, residuals, _, _ = lstsq(gram, b, rcond=None)
+        return x
+    y = solve_triangular(factor, b, lower=True)
+    return solve_triangular(factor.T, y, lower=False)
+
+
 def sparse_to_dense(v):
     """convert a one-row sparse matrix into a dense ndarray"""
     return v.toarray()[0]
@@ -0,0 +1,267 @@
+"""
+Store of sparse data vectors in memory-mapped files
+
+Vectors for one dataset are held in columnar form, as in a csr matrix:
+an array of row pointers (indptr), an array of column indexes (indices),
+and an array of values (data). Each array is a headerless binary file,
+so new rows can be appended without rewriting existing content.
+
+String identifiers are stored in a table in the format of idtable.py.
+Identifiers of appended rows are first recorded in a separate file, one
+json pair [idx, id] per line, and are moved into the table when that
+file grows large relative to the table.
+
+Rows become visible to readers only when their row pointers are written,
+so other processes can read a store while one process appends to it.
+Reads map the files into memory, and rows are returned as csr matrices
+that share memory with the mapped arrays. Stores are meant to have a
+single writer; readers only open existing files.
+"""
+
+from json import dumps, loads
+from os import remove, stat
+from os.path import exists, getsize
+from threading import Lock
+from numpy import array, concatenate, cumsum, float64, int32, int64
+from numpy import memmap, zeros
+from .csr import FastCsrMatrix
+from .idtable import IdTable, write_id_table
+
+
+# file extensions and types for the columnar arrays
+store_arrays = dict(indptr=int64, indices=int32, data=float64)
+
+
+def vector_store_files(path):
+    """list files that hold a vector store
+
+    :param path: string, prefix for paths to files
+    :return: list of paths (some of these may not exist)
+    """
+
+    parts = list(store_arrays.keys()) + ["ids", "ids-added"]
+    return [path + "." + _ for _ in parts]
+
+
+def _read_array(path, dtype):
+    """map a binary file into memory, ignoring any incomplete element"""
+
+    n = getsize(path) // dtype().itemsize
+    if n == 0:
+        return zeros(0, dtype=dtype)
+    return memmap(path, dtype=dtype, mode="r", shape=(n,))
+
+
+def _write_at(path, offset, content):
+    """write bytes into a file at an offset, discarding content beyond"""
+
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(content)
+        f.truncate()
+
+
+class CrossmapVectorStore:
+    """Append-only store of sparse vectors for one dataset"""
+
+    # smallest number of appended identifiers that triggers a rewrite of
+    # the table of identifiers
+    ids_rewrite_min = 1024
+
+    def __init__(self, path):
+        """open a store, creating empty files if needed
+
+        :param path: string, prefix for paths to files
+        """
+
+        self.path = path
+        self.lock = Lock()
+        if not exists(self._file("indptr")):
+            self._create()
+        self.ids = []
+        self.size = 0
+        self._ids_stamp = None
+        self._added_end = 0
+        self.refresh()
+
+    def _file(self, part):
+        return self.path + "." + part
+
+    def _create(self):
+        """write empty files"""
+
+        for part in ["indices", "data", "ids-added"]:
+            with open(self._file(part), "wb"):
+                pass
+        write_id_table(self._file("ids"), [])
+        with open(self._file("indptr"), "wb") as f:
+            f.write(zeros(1, dtype=int64).tobytes())
+
+    def __len__(self):
+        return self.size
+
+    def refresh(self):
+        """map files into memory, picking up rows appended by others"""
+
+        with self.lock:
+            self._refresh()
+
+    def _refresh(self):
+        """map files into memory (must be called holding the lock)"""
+
+        data = _read_array(self._file("data"), float64)
+        indices = _read_array(self._file("indices"), int32)
+        indptr = _read_array(self._file("indptr"), int64)
+        self._refresh_ids()
+        size = min(len(indptr) - 1, len(self.ids))
+        # rows beyond the mapped data are incomplete
+        while size > 0 and indptr[size] > min(len(data), len(indices)):
+            size -= 1
+        self.data, self.indices = data, indices
+        self.indptr = indptr
+        self.size = size
+
+    def _refresh_ids(self):
+        """read identifiers that are new since the last refresh"""
+
+        st = stat(self._file("ids"))
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        ids, start = self.ids, self._added_end
+        added_size = getsize(self._file("ids-added"))
+        if stamp == self._ids_stamp and added_size == start:
+            return
+        if stamp != self._ids_stamp or added_size < start:
+            # the table has been rewritten, so start from scratch
+            ids, start = IdTable(self._file("ids")), 0
+        added = []
+        with open(self._file("ids-added"), "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                idx, id = loads(line)
+                if idx > len(ids) + len(added):
+                    break
+                if idx == len(ids) + len(added):
+                    added.append(id)
+                start += len(line)
+        ids.extend(added)
+        self.ids, self._ids_stamp, self._added_end = ids, stamp, start
+
+    def _append_ids(self, size, ids):
+        """record identifiers for rows appended after row size
+
+        (must be called holding the lock)
+
+        :param size: integer, number of rows before the new rows
+        :param ids: list of string identifiers
+        """
+
+        n_added = len(self.ids) - self.ids.size
+        # identifiers beyond size are left over from an interrupted append
+        if len(self.ids) == size and \
+                n_added + len(ids) < max(self.ids_rewrite_min, size // 8):
+            content = [dumps([size + i, _]) + "\n" for i, _ in enumerate(ids)]
+            _write_at(self._file("ids-added"), self._added_end,
+                      "".join(content).encode())
+            return
+        write_id_table(self._file("ids"),
+                       [self.ids[_] for _ in range(size)] + list(ids))
+        _write_at(self._file("ids-added"), 0, b"")
+
+    def append(self, vectors, ids):
+        """add rows at the end of the store
+
+        :param vectors: list of csr vectors (one-row matrices)
+        :param ids: list of string identifiers
+        """
+
+        if len(vectors) == 0:
+            return
+        with self.lock:
+            size = self.size
+            nnz = int(self.indptr[size])
+            counts = array([len(_.data) for _ in vectors], dtype=int64)
+            _write_at(self._file("data"), 8 * nnz,
+                      concatenate([_.data for _ in vectors])
+                      .astype(float64).tobytes())
+            _write_at(self._file("indices"), 4 * nnz,
+                      concatenate([_.indices for _ in vectors])
+                      .astype(int32).tobytes())
+            self._append_ids(size, ids)
+            # writing row pointers last makes the rows visible
+            _write_at(self._file("indptr"), 8 * (size + 1),
+                      (nnz + cumsum(counts)).astype(int64).tobytes())
+            self._refresh()
+
+    def row(self, idx, n_features):
+        """get one row as a one-row csr matrix
+
+        :param idx: integer index
+        :param n_features: integer, number of columns
+        :return: csr matrix sharing memory with the store
+        """
+
+        start, end = self.indptr[idx], self.indptr[idx+1]
+        return FastCsrMatrix((self.data[start:end], self.indices[start:end],
+                              array([0, end - start])),
+                             shape=(1, n_features))
+
+    def rows(self, start, end, n_features):
+        """get a range of rows as a csr matrix
+
+        :param start: integer, first row
+        :param end: integer, row after the last row
+        :param n_features: integer, number of columns
+        :return: csr matrix with data and indices sharing memory with
+            the store
+        """
+
+        end = max(start, min(end, self.size))
+        first, last = self.indptr[start], self.indptr[end]
+        return FastCsrMatrix((self.data[first:last],
+                              self.indices[first:last],
+                              array(self.indptr[start:end+1]) - first),
+                             shape=(end - start, n_features))
+
+    def get(self, idxs, n_features):
+        """get rows with their identifiers
+
+        :param idxs: list of integer indexes
+        :param n_features: integer, number of columns
+        :return: list of dicts with id, idx, and data (indexes outside the
+            store are skipped)
+        """
+
+        # (refresh() replaces ids before size, so ids cover all size rows)
+        size, ids = self.size, self.ids
+        return [dict(id=ids[i], idx=i, data=self.row(i, n_features))
+                for i in idxs if 0 <= i < size]
+
+    def scan(self, n_features, batch_size=10000):
+        """generator for all rows, reading files sequentially
+
+        :param n_features: integer, number of columns
+        :param batch_size: integer, number of rows to read at once
+        :return: dicts with id, idx, and data
+        """
+
+        size, ids = self.size, self.ids
+        for start in range(0, size, batch_size):
+            batch = self.rows(start, start + batch_size, n_features)
+            indptr = batch.indptr
+            for i in range(batch.shape[0]):
+                a, b = indptr[i], indptr[i+1]
+                data = FastCsrMatrix((batch.data[a:b], batch.indices[a:b],
+                                      array([0, b - a])),
+                                     shape=(1, n_features))
+                yield dict(id=ids[start + i], idx=start + i, data=data)
+
+    def remove(self):
+        """delete all files"""
+
+        with self.lock:
+            for f in vector_store_files(self.path):
+                if exists(f):
+                    remove(f)
+            self.ids, self.size = [], 0
@@ -14,4 +14,5 @@ urlpatterns = [
     path('diffuse/', views.diffuse, name='diffuse'),
     path('search/', views.search, name='search'),
     path('delta/', views.delta, name='delta'),
+    path('reload/', views.reload, name='reload'),
 ]
@@ -2,8 +2,11 @@
 views for crossmap server
 """
 
+from contextlib import suppress
 from functools import wraps
 from json import dumps, loads
+from signal import signal, SIGHUP
+from threading import Thread
 from crossmap.crossmap import Crossmap
 from crossmap.settings import CrossmapSettings
 from crossmap.vectors import sparse_to_dense
@@ -21,6 +24,16 @@ crossmap.load()
 info("database collections: "+str(crossmap.db._db.list_collection_names()))
 
 
+def reload_on_signal(signum, frame):
+    """pick up index files rebuilt by another process (without blocking)"""
+    Thread(target=crossmap.reload).start()
+
+
+# signal handlers can only be installed from the main thread
+with suppress(ValueError):
+    signal(SIGHUP, reload_on_signal)
+
+
 def get_vector(dataset, item_id):
     db = crossmap.indexer.db
     result = db.get_data(dataset, ids=[item_id])
@@ -82,7 +95,7 @@ def parse_request(request):
     for k in ["dataset", "data_pos", "data_neg"]:
         doc[k] = data.get(k, [])
     doc["n"] = data.get("n", 1)
-    for k in ["diffusion", "expected_id", "query_id"]:
+    for k in ["diffusion", "expected_id", "query_id", "filter"]:
         doc[k] = data.get(k, None)
     return doc
 
@@ -107,9 +120,25 @@ def parse_add_request(request):
 
 
 def process_search_decompose(request, process_function):
-    """handle search and decomposition"""
+    """handle search and decomposition, using a cache for results
+
+    Results are cached for each distinct request. Requests that use an item
+    id as query, or that search several datasets, depend on all datasets.
+    Other requests depend on the searched dataset and on the datasets used
+    for diffusion.
+    """
 
     doc = parse_request(request)
+    key = crossmap.result_cache.key(action=process_function.__name__, **doc)
+    datasets = crossmap.result_cache.dependencies(
+        doc["dataset"], doc["data_pos"], doc["diffusion"])
+    return crossmap.result_cache.get(
+        key, datasets, lambda: compute_search_decompose(doc, process_function))
+
+
+def compute_search_decompose(doc, process_function):
+    """compute search or decomposition results for a parsed request"""
+
     dataset = doc["dataset"]
     db = crossmap.db
 
@@ -121,9 +150,27 @@ def process_search_decompose(request, process_function):
             if db.has_id(d, item_id):
                 doc_input = db.get_document(d, item_id)
 
-    # process the input
+    # several datasets, or "all", are searched in one call
+    if process_function == crossmap.search and \
+            (dataset == "all" or isinstance(dataset, list)):
+        result = crossmap.search(doc_input, n=doc["n"], datasets=dataset,
+                                 diffusion=doc["diffusion"],
+                                 metadata_filter=doc["filter"],
+                                 query_name="query")
+        result["titles"] = []
+        for target, label in zip(result["targets"], result["datasets"]):
+            title = crossmap.db.get_titles(label, ids=[target])[target]
+            result["titles"].append(title)
+        result["dataset"] = dataset
+        return result
+
+    # process the input (only search supports filters on metadata)
+    kwargs = dict()
+    if process_function == crossmap.search:
+        kwargs["metadata_filter"] = doc["filter"]
     result = process_function(doc_input, dataset=dataset, n=doc["n"],
-                              diffusion=doc["diffusion"], query_name="query")
+                              diffusion=doc["diffusion"], query_name="query",
+                              **kwargs)
     targets = result["targets"]
     target_titles = crossmap.db.get_titles(dataset, ids=targets)
     result["titles"] = [target_titles[_] for _ in targets]
@@ -166,6 +213,17 @@ def datasets(request):
     return dict(datasets=result)
 
 
+@access_http_response
+def reload(request):
+    """load index files that have been replaced on disk
+
+    :param request: this is passed, but is not used
+    :return: http response listing datasets with new indexes
+    """
+
+    return dict(datasets=crossmap.reload())
+
+
 @access_http_response
 def add(request):
     """add a new data item into the db
@@ -0,0 +1,89 @@
+"""
+Tests for benchmarking recall and latency of search indexes
+"""
+
+import unittest
+from os.path import join
+from scipy.sparse import csr_matrix
+from numpy import array
+from crossmap.settings import CrossmapSettings
+from crossmap.crossmap import Crossmap
+from crossmap.benchmark import CrossmapBenchmark, exact_neighbors
+from .tools import remove_crossmap_cache
+
+data_dir = join("tests", "testdata")
+config_plain = join(data_dir, "config-simple.yaml")
+documents_file = join(data_dir, "documents.yaml")
+
+
+class ExactNeighborsTests(unittest.TestCase):
+    """computing exact neighbors by brute force"""
+
+    def test_exact_neighbors_in_batches(self):
+        """neighbors are combined across batches of data items"""
+
+        data = csr_matrix(array([[1.0, 0, 0], [0, 1.0, 0],
+                                 [0, 0, 1.0], [0.8, 0.6, 0]]))
+        vs = csr_matrix(array([[1.0, 0, 0], [0, 0.6, 0.8]]))
+        idxs = [10, 11, 12, 13]
+        result = exact_neighbors(vs, data, idxs, 2, batch_size=3)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0][0], [10, 13])
+        self.assertAlmostEqual(result[0][1][0], 0.0)
+        self.assertEqual(set(result[1][0]), {11, 12})
+
+
+class CrossmapBenchmarkTests(unittest.TestCase):
+    """benchmarking index parameters on a small instance"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings = CrossmapSettings(config_plain)
+        Crossmap(cls.settings).build()
+        cls.benchmark = CrossmapBenchmark(cls.settings)
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_queries_from_sample(self):
+        """queries can be sampled from a dataset"""
+
+        vs = self.benchmark.queries("targets", sample=4)
+        self.assertEqual(vs.shape[0], 4)
+
+    def test_queries_from_file(self):
+        """queries can be read from a data file"""
+
+        vs = self.benchmark.queries("targets", filepath=documents_file)
+        self.assertGreater(vs.shape[0], 4)
+
+    def test_benchmark_sweep(self):
+        """benchmark reports one result for each parameter combination"""
+
+        result = self.benchmark.benchmark_index("targets", n=3,
+                                                build_qualities=[10, 100],
+                                                search_qualities=[10, 50, 100],
+                                                sample=5)
+        self.assertEqual(len(result), 6)
+        for item in result:
+            self.assertEqual(item["queries"], 5)
+            self.assertGreater(item["recall"], 0.5)
+            self.assertLessEqual(item["recall"], 1.0)
+            self.assertLessEqual(item["latency_p50"], item["latency_p99"])
+            self.assertGreater(item["index_size"], 0)
+            self.assertGreaterEqual(item["build_time"], 0)
+        # a small dataset can be searched perfectly with a good index
+        self.assertEqual(result[-1]["recall"], 1.0)
+
+    def test_benchmark_methods(self):
+        """benchmark compares several indexing methods"""
+
+        result = self.benchmark.benchmark_index("targets", n=3,
+                                                search_qualities=[100],
+                                                methods=["hnsw", "projection"],
+                                                sample=5)
+        self.assertEqual([_["method"] for _ in result],
+                         ["hnsw", "projection"])
+        # projection indexes re-rank with exact distances
+        self.assertEqual(result[1]["recall"], 1.0)
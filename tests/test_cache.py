@@ -3,7 +3,9 @@ Tests for a simple cache
 """
 
 import unittest
-from crossmap.cache import CrossmapCache
+from threading import Event, Thread
+from time import sleep
+from crossmap.cache import CrossmapCache, CrossmapResultCache
 
 
 class CrossmapCacheTests(unittest.TestCase):
@@ -59,6 +61,19 @@ class CrossmapCacheTests(unittest.TestCase):
         self.assertEqual(len(result1), 0)
         self.assertEqual(len(m1), 2)
 
+    def test_remove(self):
+        """remove some items, keep others"""
+
+        cache = CrossmapCache(8)
+        cache.set(0, 0, "a")
+        cache.set(0, 1, "b")
+        cache.set(1, 0, "c")
+        cache.remove(0, [0, 5])
+        result, missing = cache.get(0, [0, 1])
+        self.assertListEqual(missing, [0])
+        self.assertEqual(result[1], "b")
+        self.assertEqual(cache.get(1, [0])[0][0], "c")
+
     def test_get_empty(self):
         """handling when request is empty"""
 
@@ -81,6 +96,17 @@ class CrossmapCacheTests(unittest.TestCase):
         result1, _ = cache.get(0, [0])
         self.assertEqual(result1[0]["a"], 3)
 
+    def test_get_without_copy(self):
+        """cache can provide stored objects without copies"""
+
+        cache = CrossmapCache(8)
+        value = dict(a=3)
+        cache.set(0, 0, value, copy=False)
+        result, _ = cache.get(0, [0], copy=False)
+        self.assertTrue(result[0] is value)
+        copied, _ = cache.get(0, [0])
+        self.assertFalse(copied[0] is value)
+
     def test_remove_old(self):
         """remove old elements when cache becomes full"""
 
@@ -93,3 +119,130 @@ class CrossmapCacheTests(unittest.TestCase):
         self.assertTrue((0, 38) in cache._cache)
         self.assertFalse((0, 0) in cache._cache)
 
+
+class CrossmapResultCacheTests(unittest.TestCase):
+    """Caching query results"""
+
+    def setUp(self):
+        self.calls = 0
+
+    def compute(self, value=None):
+        """function that counts how many times results are computed"""
+
+        self.calls += 1
+        return dict(targets=["A", "B"], value=value)
+
+    def test_key_is_canonical(self):
+        """keys do not depend on the order of query components"""
+
+        a = CrossmapResultCache.key(data="abc", n=2, diffusion={"x": 1})
+        b = CrossmapResultCache.key(diffusion={"x": 1}, n=2, data="abc")
+        c = CrossmapResultCache.key(data="abc", n=3, diffusion={"x": 1})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_dependencies(self):
+        """results depend on searched datasets and diffusion datasets"""
+
+        all_datasets = CrossmapResultCache.all_datasets
+        dependencies = CrossmapResultCache.dependencies
+        self.assertEqual(dependencies("targets", "a b"), ["targets"])
+        self.assertEqual(dependencies("targets", "a b", dict(documents=1)),
+                         ["targets", "documents"])
+        self.assertEqual(dependencies("all", "a b"), [all_datasets])
+        self.assertEqual(dependencies("targets", "a"), [all_datasets])
+
+    def test_get_computes_once(self):
+        """repeated requests are served from the cache"""
+
+        cache = CrossmapResultCache()
+        result1 = cache.get("k", ["targets"], self.compute)
+        result1["targets"].append("corrupt")
+        result2 = cache.get("k", ["targets"], self.compute)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(result2["targets"], ["A", "B"])
+        self.assertGreater(cache.size, 0)
+
+    def test_ttl(self):
+        """old entries are computed again"""
+
+        cache = CrossmapResultCache(ttl=0.01)
+        cache.get("k", ["targets"], self.compute)
+        sleep(0.02)
+        cache.get("k", ["targets"], self.compute)
+        self.assertEqual(self.calls, 2)
+
+    def test_size_budget(self):
+        """least-recently used entries are evicted to respect a budget"""
+
+        cache = CrossmapResultCache(max_bytes=100)
+        cache.get("a", ["targets"], lambda: self.compute("x"*30))
+        cache.get("b", ["targets"], lambda: self.compute("y"*30))
+        self.assertLessEqual(cache.size, 100)
+        self.assertEqual(list(cache._cache.keys()), ["b"])
+        # results larger than the budget are not stored
+        cache.get("c", ["targets"], lambda: self.compute("z"*200))
+        self.assertEqual(list(cache._cache.keys()), ["b"])
+
+    def test_invalidate(self):
+        """entries can be removed when a dataset changes"""
+
+        cache = CrossmapResultCache()
+        cache.get("a", ["targets"], self.compute)
+        cache.get("b", ["documents"], self.compute)
+        cache.get("c", [cache.all_datasets], self.compute)
+        cache.invalidate("targets")
+        self.assertEqual(list(cache._cache.keys()), ["b"])
+        cache.clear()
+        self.assertEqual(cache.size, 0)
+
+    def test_coalesce_requests(self):
+        """identical requests in flight are computed once"""
+
+        cache = CrossmapResultCache()
+        started, release = Event(), Event()
+
+        def slow():
+            started.set()
+            release.wait()
+            return self.compute()
+
+        results = []
+        threads = [Thread(target=lambda: results.append(
+            cache.get("k", ["targets"], slow))) for _ in range(4)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        sleep(0.05)
+        release.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(results), 4)
+
+    def test_invalidate_during_compute(self):
+        """results computed before an invalidation are not stored"""
+
+        cache = CrossmapResultCache()
+
+        def compute_and_invalidate():
+            cache.invalidate("targets")
+            return self.compute()
+
+        cache.get("k", ["targets"], compute_and_invalidate)
+        self.assertEqual(len(cache._cache), 0)
+
+    def test_errors(self):
+        """errors during computation are raised and not cached"""
+
+        cache = CrossmapResultCache()
+
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            cache.get("k", ["targets"], fail)
+        result = cache.get("k", ["targets"], self.compute)
+        self.assertEqual(result["targets"], ["A", "B"])
+
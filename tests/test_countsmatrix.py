@@ -0,0 +1,127 @@
+"""
+Tests for storing matrices of counts in memory-mapped files
+"""
+
+import unittest
+from numpy import allclose
+from os.path import join, exists
+from os import remove
+from crossmap.countsmatrix import CrossmapCountsMatrix, counts_matrix_files
+from crossmap.countsmatrix import save_counts_matrix, remove_counts_matrix
+from crossmap.countsmatrix import record_counts_updates, trim_counts_updates
+from crossmap.countsmatrix import count_counts_updates, counts_updates_file
+from .tools import random_unit_rows
+
+
+data_dir = join("tests", "testdata")
+matrix_path = join(data_dir, "crossmap-testing-counts")
+
+
+class CrossmapCountsMatrixTests(unittest.TestCase):
+    """Writing and reading matrices"""
+
+    def setUp(self):
+        self.data = random_unit_rows(30, 30, 0.2, 1)
+
+    def tearDown(self):
+        remove_counts_matrix(matrix_path)
+
+    def blocks(self, size):
+        return [self.data[i:i+size] for i in range(0, 30, size)]
+
+    def test_missing(self):
+        """a matrix without files is not available"""
+
+        matrix = CrossmapCountsMatrix(matrix_path)
+        self.assertFalse(matrix.refresh())
+        self.assertEqual(len(matrix), 0)
+        self.assertEqual(matrix.get([0, 1]), dict())
+
+    def test_save_get(self):
+        """rows can be retrieved after writing blocks"""
+
+        save_counts_matrix(matrix_path, self.blocks(7), 30)
+        for f in counts_matrix_files(matrix_path):
+            self.assertTrue(exists(f))
+        matrix = CrossmapCountsMatrix(matrix_path)
+        self.assertTrue(matrix.refresh())
+        self.assertEqual(len(matrix), 30)
+        result = matrix.get([0, 12, 29, 40])
+        self.assertListEqual(sorted(result.keys()), [0, 12, 29])
+        for i in [0, 12, 29]:
+            data, indices = result[i]
+            self.assertListEqual(list(indices), list(self.data[i].indices))
+            self.assertTrue(allclose(data, self.data[i].data))
+
+    def test_save_wrong_size(self):
+        """writing signals inconsistent number of rows"""
+
+        with self.assertRaises(Exception):
+            save_counts_matrix(matrix_path, self.blocks(10)[:2], 30)
+        for f in counts_matrix_files(matrix_path):
+            self.assertFalse(exists(f))
+
+    def test_replace(self):
+        """readers pick up replaced and removed files"""
+
+        save_counts_matrix(matrix_path, self.blocks(10), 30)
+        matrix = CrossmapCountsMatrix(matrix_path)
+        self.assertTrue(matrix.refresh())
+        save_counts_matrix(matrix_path, [self.data[10:20]] * 3, 30)
+        self.assertTrue(matrix.refresh())
+        data, indices = matrix.get([0])[0]
+        self.assertListEqual(list(indices), list(self.data[10].indices))
+        remove_counts_matrix(matrix_path)
+        self.assertFalse(matrix.refresh())
+        self.assertEqual(matrix.get([0]), dict())
+
+    def test_inconsistent(self):
+        """a matrix with incomplete files is not available"""
+
+        save_counts_matrix(matrix_path, self.blocks(10), 30)
+        remove(counts_matrix_files(matrix_path)[0])
+        save_counts_matrix(join(data_dir, "crossmap-testing-other"),
+                           [self.data[:5]], 5)
+        other = counts_matrix_files(join(data_dir, "crossmap-testing-other"))
+        # data from a different matrix does not match the row pointers
+        with open(other[0], "rb") as f_in:
+            with open(counts_matrix_files(matrix_path)[0], "wb") as f_out:
+                f_out.write(f_in.read())
+        remove_counts_matrix(join(data_dir, "crossmap-testing-other"))
+        matrix = CrossmapCountsMatrix(matrix_path)
+        self.assertFalse(matrix.refresh())
+
+    def test_updates(self):
+        """rows recorded as updated are skipped by readers"""
+
+        save_counts_matrix(matrix_path, self.blocks(10), 30)
+        matrix = CrossmapCountsMatrix(matrix_path)
+        self.assertTrue(matrix.refresh())
+        self.assertListEqual(matrix.recent_updates, [])
+        record_counts_updates(matrix_path, [3, 5])
+        # another reader also records an update
+        record_counts_updates(matrix_path, [5, 8])
+        self.assertEqual(count_counts_updates(matrix_path), 4)
+        self.assertTrue(matrix.refresh())
+        self.assertListEqual(matrix.recent_updates, [3, 5, 5, 8])
+        self.assertListEqual(sorted(matrix.get([2, 3, 5, 8]).keys()), [2])
+        self.assertTrue(matrix.refresh())
+        self.assertListEqual(matrix.recent_updates, [])
+
+    def test_trim_updates(self):
+        """records of updates captured in a new matrix can be discarded"""
+
+        save_counts_matrix(matrix_path, self.blocks(10), 30)
+        record_counts_updates(matrix_path, [3, 5])
+        matrix = CrossmapCountsMatrix(matrix_path)
+        self.assertTrue(matrix.refresh())
+        record_counts_updates(matrix_path, [8])
+        trim_counts_updates(matrix_path, 2)
+        self.assertEqual(count_counts_updates(matrix_path), 1)
+        self.assertTrue(matrix.refresh())
+        self.assertEqual(matrix.updated, {8})
+        self.assertListEqual(sorted(matrix.get([3, 5, 8]).keys()), [3, 5])
+        trim_counts_updates(matrix_path, 1)
+        self.assertFalse(exists(counts_updates_file(matrix_path)))
+        self.assertTrue(matrix.refresh())
+        self.assertEqual(len(matrix.get([3, 5, 8])), 3)
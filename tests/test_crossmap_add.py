@@ -4,9 +4,14 @@ Tests for adding documents into a new dataset
 
 import yaml
 import unittest
+from numpy import allclose
 from os.path import join, exists
+from threading import Event, Thread
 from crossmap.crossmap import Crossmap
+from crossmap.indexer import _file_stamp
+from crossmap.invertedindex import InvertedIndex
 from crossmap.tools import yaml_document
+from crossmap.countsmatrix import counts_matrix_files
 from .tools import remove_crossmap_cache
 
 
@@ -151,6 +156,105 @@ class CrossmapAddTests(unittest.TestCase):
         self.assertGreater(len(after.data), len(before.data))
 
 
+class CrossmapAddIncrementalTests(unittest.TestCase):
+    """Adding documents without rebuilding nearest-neighbor indexes"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.crossmap = Crossmap(config_file)
+        cls.crossmap.build()
+        cls.indexer = cls.crossmap.indexer
+        cls.indexer.buffer_size = 3
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_add_uses_buffer_then_compacts(self):
+        """new items are searchable before and after an index rebuild"""
+
+        crossmap, indexer = self.crossmap, self.indexer
+        index_file = crossmap.settings.index_file("incremental")
+        docs = [dict(data="Alice A"), dict(data="Bob B"),
+                dict(data="Catherine C"), dict(data="Daniel D")]
+        for i in range(3):
+            crossmap.add("incremental", docs[i], id="I"+str(i))
+        # a few items are held in a buffer, without an index file
+        self.assertFalse(exists(index_file))
+        self.assertEqual(len(indexer.buffers["incremental"]["idxs"]), 3)
+        hits = crossmap.search(dict(data="Bob"), "incremental", n=2)
+        self.assertEqual(hits["targets"][0], "I1")
+        # reloading should recover the buffer from the db
+        crossmap.load()
+        self.assertEqual(len(indexer.buffers["incremental"]["idxs"]), 3)
+        # exceeding the buffer size triggers a rebuild of the index
+        crossmap.add("incremental", docs[3], id="I3")
+        indexer.wait()
+        self.assertTrue(exists(index_file))
+        self.assertFalse("incremental" in indexer.buffers)
+        hits = crossmap.search(dict(data="Daniel"), "incremental", n=2)
+        self.assertEqual(hits["targets"][0], "I3")
+        # subsequent items are buffered and merged with index hits
+        crossmap.add("incremental", dict(data="Daniel Bob"), id="I4")
+        self.assertEqual(len(indexer.buffers["incremental"]["idxs"]), 1)
+        hits = crossmap.search(dict(data="Daniel Bob"), "incremental", n=3)
+        self.assertEqual(hits["targets"][0], "I4")
+        self.assertTrue("I3" in hits["targets"])
+
+
+class CrossmapAddExactTests(unittest.TestCase):
+    """Adding documents into datasets with exact indexes"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.crossmap = Crossmap(config_file)
+        cls.crossmap.build()
+        cls.indexer = cls.crossmap.indexer
+        cls.indexer.buffer_size = 2
+        cls.indexer.settings.indexing.methods["exact"] = "exact"
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_compact_during_search(self):
+        """compaction replaces an exact index while searches continue"""
+
+        crossmap, indexer = self.crossmap, self.indexer
+        words = ["Alice", "Bob", "Catherine", "Daniel", "Alpha", "Bravo",
+                 "Charlie", "Delta"]
+        for i in range(3):
+            crossmap.add("exact", dict(data=words[i]), id="E"+str(i))
+        indexer.wait()
+        self.assertTrue(isinstance(indexer._get_index("exact"),
+                                   InvertedIndex))
+        errors, done = [], Event()
+        query = crossmap.encoder.document(dict(data="Alice Bob"))
+
+        def search():
+            while not done.is_set():
+                try:
+                    indexer.suggest(query, "exact", 3)
+                except Exception as e:
+                    errors.append(e)
+
+        thread = Thread(target=search)
+        thread.start()
+        for i in range(3, len(words)):
+            crossmap.add("exact", dict(data=words[i]), id="E"+str(i))
+        done.set()
+        thread.join()
+        self.assertListEqual(errors, [])
+        # the compacted index is on disk, with a matching id table
+        index = indexer._get_index("exact")
+        self.assertGreater(len(index), 3)
+        self.assertEqual(indexer.index_stamps["exact"],
+                         _file_stamp(indexer.index_files["exact"]))
+        self.assertListEqual(indexer.reload(), [])
+        hits = crossmap.search(dict(data="Delta"), "exact", n=2)
+        self.assertEqual(hits["targets"][0], "E7")
+
+
 class CrossmapAddBatchTests(unittest.TestCase):
     """Add many documents into db at once - in batch"""
 
@@ -182,6 +286,60 @@ class CrossmapAddBatchTests(unittest.TestCase):
         # the original config_simple setup
 
 
+class CrossmapAddBatchCountsTests(unittest.TestCase):
+    """Diffusion counts for documents added in batch"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.crossmap = Crossmap(config_file)
+        cls.crossmap.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_add_file_counts(self):
+        """counts from batch updates match counts from single updates"""
+
+        crossmap = self.crossmap
+        crossmap.add_file("batch", similars_file)
+        with open(similars_file, "rt") as f:
+            for id, doc in yaml_document(f):
+                crossmap.add("single", doc, id=id)
+        nf = len(crossmap.diffuser.feature_map)
+        batch = crossmap.db.get_counts("batch", list(range(nf)))
+        single = crossmap.db.get_counts("single", list(range(nf)))
+        self.assertEqual(len(batch), nf)
+        self.assertGreater(sum([_.nnz for _ in batch.values()]), 0)
+        for i in range(nf):
+            self.assertTrue(allclose(batch[i].toarray(),
+                                     single[i].toarray()))
+        # batch additions write a memory-mapped matrix, single additions
+        # leave rows in the db
+        settings = crossmap.settings
+        for f in counts_matrix_files(settings.diffusion_file("batch")):
+            self.assertTrue(exists(f))
+        for f in counts_matrix_files(settings.diffusion_file("single")):
+            self.assertFalse(exists(f))
+        # rows prepared for diffusion are also consistent
+        batch = crossmap.db.get_diffusion_arrays("batch", list(range(nf)))
+        single = crossmap.db.get_diffusion_arrays("single", list(range(nf)))
+        for i in range(nf):
+            self.assertTrue(allclose(batch[i][0], single[i][0]))
+        # single additions keep an existing matrix, updated rows are
+        # read from the db
+        doc = dict(data="Alice and Catherine, Charlie and Delta")
+        crossmap.add("batch", doc, id="extra")
+        crossmap.add("single", doc, id="extra")
+        for f in counts_matrix_files(settings.diffusion_file("batch")):
+            self.assertTrue(exists(f))
+        batch = crossmap.db.get_diffusion_arrays("batch", list(range(nf)))
+        single = crossmap.db.get_diffusion_arrays("single", list(range(nf)))
+        for i in range(nf):
+            self.assertListEqual(list(batch[i][1]), list(single[i][1]))
+            self.assertTrue(allclose(batch[i][0], single[i][0]))
+
+
 class CrossmapAddDiffusionTests(unittest.TestCase):
     """Adding documents to affect diffusion and search"""
 
@@ -243,6 +401,27 @@ class CrossmapAddDiffusionTests(unittest.TestCase):
         self.assertTrue("A" in d1_Alice["targets"])
         self.assertTrue("U" in d1_Alice["targets"])
 
+    def test_add_invalidates_diffused_results(self):
+        """cached results diffused with a dataset are updated after add"""
+
+        crossmap = self.crossmap
+        crossmap.add("cached", dict(data="Alice Catherine"), id="C0")
+        diffusion = dict(cached=1)
+        key = crossmap.result_cache.key(data="Alice A", diffusion=diffusion)
+        datasets = crossmap.result_cache.dependencies(
+            "targets", "Alice A", diffusion)
+
+        def compute():
+            return crossmap.search(self.doc_Alice, "targets", n=2,
+                                   diffusion=diffusion)
+
+        before = crossmap.result_cache.get(key, datasets, compute)
+        for i in range(3):
+            crossmap.add("cached", dict(data="Alice unique"), id="C"+str(i+1))
+        after = crossmap.result_cache.get(key, datasets, compute)
+        self.assertNotEqual(before, after)
+        self.assertTrue("U" in after["targets"])
+
     def test_add_negative(self):
         """adding documents with neg associations can remove links"""
 
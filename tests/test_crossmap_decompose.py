@@ -78,6 +78,34 @@ class CrossmapDecomposeTests(unittest.TestCase):
         result = self.crossmap.decompose(doc, "targets", n=2, factors=["B1"])
         self.assertListEqual(list(result["targets"]), ["B1", "C1"])
 
+    def test_decompose_pool(self):
+        """decomposition selecting components from a pool of candidates"""
+
+        docs = [dict(data="Bob Bravo Delta David. Bob Bravo Bernard"),
+                dict(data="Bob Bravo Benjamin Charlie Clare. Bob Bravo.")]
+        for doc in docs:
+            plain = self.crossmap.decompose(doc, "targets", n=2, pool=0)
+            result = self.crossmap.decompose(doc, "targets", n=2, pool=10)
+            self.assertListEqual(list(result["targets"]),
+                                 list(plain["targets"]))
+            for r, p in zip(result["coefficients"], plain["coefficients"]):
+                self.assertAlmostEqual(r, p)
+
+    def test_decompose_pool_exhausted(self):
+        """small pools are extended with new searches"""
+
+        doc = dict(data="Bob Bravo Benjamin Charlie Clare. Bob Bravo.")
+        result = self.crossmap.decompose(doc, "targets", n=2, pool=1)
+        self.assertListEqual(list(result["targets"]), ["B2", "C1"])
+
+    def test_decompose_pool_factors(self):
+        """candidate pools can be used together with factor suggestions"""
+
+        doc = dict(data="Bob Bravo Benjamin Charlie Clare. Bob Bravo.")
+        result = self.crossmap.decompose(doc, "targets", n=2, pool=10,
+                                         factors=["B1"])
+        self.assertListEqual(list(result["targets"]), ["B1", "C1"])
+
 
 class CrossmapDecomposeBatchTests(unittest.TestCase):
     """Decomposing objects onto targets - in batch"""
@@ -105,3 +133,14 @@ class CrossmapDecomposeBatchTests(unittest.TestCase):
             self.assertEqual(len(iresult["coefficients"]), 1)
             self.assertAlmostEqual(iresult["coefficients"][0], 1.0)
 
+    def test_decompose_documents_workers(self):
+        """decomposition with worker processes gives results in input order"""
+
+        targets_file = self.crossmap.settings.data.collections["targets"]
+        expected = self.crossmap.decompose_file(targets_file, "targets", 2)
+        result = self.crossmap.decompose_file(targets_file, "targets", 2,
+                                              workers=2)
+        self.assertEqual(len(result), len(expected))
+        for r, e in zip(result, expected):
+            self.assertEqual(r["query"], e["query"])
+            self.assertEqual(list(r["targets"]), list(e["targets"]))
@@ -0,0 +1,138 @@
+"""
+Tests for nearest-neighbor search restricted by metadata
+"""
+
+import unittest
+from os.path import join, exists
+from crossmap.crossmap import Crossmap
+from crossmap.tools import read_yaml_documents
+from .tools import remove_crossmap_cache
+
+
+data_dir = join("tests", "testdata")
+config_metadata = join(data_dir, "config-metadata.yaml")
+dataset_file = join(data_dir, "dataset-metadata.yaml")
+dataset_docs = read_yaml_documents(dataset_file)
+
+
+def satisfies(id, conditions):
+    """check if an item from the dataset file satisfies conditions"""
+
+    metadata = dataset_docs[id].get("metadata", dict())
+    for k, v in conditions.items():
+        values = v if isinstance(v, list) else [v]
+        if metadata.get(k, None) not in [str(_) for _ in values]:
+            return False
+    return True
+
+
+class CrossmapFilterTests(unittest.TestCase):
+    """Search restricted to items with certain metadata"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.crossmap = Crossmap(config_metadata)
+        cls.crossmap.build()
+        cls.crossmap.indexer.trim_search = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_metadata")
+
+    def expected(self, doc, conditions, n):
+        """compute filtered distances from an unrestricted search"""
+
+        result = self.crossmap.search(doc, "targets", n=100)
+        hits = zip(result["targets"], result["distances"])
+        return [d for id, d in hits if satisfies(id, conditions)][:n]
+
+    def check(self, result, expected, conditions):
+        """check search results against expected distances"""
+
+        self.assertEqual(len(result["targets"]), len(expected))
+        for id in result["targets"]:
+            self.assertTrue(satisfies(id, conditions))
+        for r_d, e_d in zip(result["distances"], expected):
+            self.assertAlmostEqual(r_d, e_d)
+
+    def test_build_sub_indexes(self):
+        """build creates sub-indexes for metadata values"""
+
+        settings = self.crossmap.settings
+        self.assertTrue(exists(settings.partitions_file("targets")))
+        for i in range(3):
+            index_file = settings.partition_index_file("targets", 0, i)
+            self.assertTrue(exists(index_file))
+
+    def test_filter_partitioned_field(self):
+        """search within one value of a field that has sub-indexes"""
+
+        doc = dict(data="alpha bravo")
+        conditions = dict(year=2020)
+        result = self.crossmap.search(doc, "targets", n=3,
+                                      metadata_filter=conditions)
+        self.assertEqual(len(result["targets"]), 3)
+        self.check(result, self.expected(doc, conditions, 3), conditions)
+
+    def test_filter_several_values(self):
+        """search within several values of a field"""
+
+        doc = dict(data="charlie delta")
+        conditions = dict(year=[2019, 2021])
+        result = self.crossmap.search(doc, "targets", n=4,
+                                      metadata_filter=conditions)
+        self.check(result, self.expected(doc, conditions, 4), conditions)
+
+    def test_filter_without_sub_indexes(self):
+        """search with a filter on a field without sub-indexes"""
+
+        doc = dict(data="echo foxtrot")
+        conditions = dict(journal="J1")
+        result = self.crossmap.search(doc, "targets", n=5,
+                                      metadata_filter=conditions)
+        self.assertEqual(len(result["targets"]), 5)
+        self.check(result, self.expected(doc, conditions, 5), conditions)
+
+    def test_filter_several_fields(self):
+        """search with a filter on several fields"""
+
+        doc = dict(data="golf hotel alpha")
+        conditions = dict(journal="J0", year=2019)
+        result = self.crossmap.search(doc, "targets", n=5,
+                                      metadata_filter=conditions)
+        expected = self.expected(doc, conditions, 5)
+        self.check(result, expected, conditions)
+        self.assertEqual(len(expected), 3)
+
+    def test_filter_rerank(self):
+        """filtered searches re-rank hits using exact distances"""
+
+        indexer = self.crossmap.indexer
+        calls = []
+        rerank = indexer._rerank
+
+        def counting_rerank(vs, candidates, dataset, n):
+            calls.append([len(_[0]) for _ in candidates])
+            return rerank(vs, candidates, dataset, n)
+
+        doc = dict(data="alpha bravo")
+        conditions = dict(journal="J1")
+        expected = self.expected(doc, conditions, 3)
+        indexer._rerank = counting_rerank
+        indexer.rerank_factor = 2
+        try:
+            result = self.crossmap.search(doc, "targets", n=3,
+                                          metadata_filter=conditions)
+        finally:
+            indexer.rerank_factor = 1
+            del indexer._rerank
+        self.assertEqual(calls, [[6]])
+        self.check(result, expected, conditions)
+
+    def test_filter_without_matches(self):
+        """search with a filter that excludes all items"""
+
+        doc = dict(data="alpha bravo")
+        result = self.crossmap.search(doc, "targets", n=3,
+                                      metadata_filter=dict(year=1900))
+        self.assertEqual(result["targets"], [])
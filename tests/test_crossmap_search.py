@@ -4,8 +4,9 @@ Tests for simple nearest-neighbor search
 
 import unittest
 from json import dumps
+from os import remove
 from os.path import join
-from crossmap.crossmap import Crossmap
+from crossmap.crossmap import Crossmap, file_batch_size
 from crossmap.tools import read_yaml_documents
 from .tools import remove_crossmap_cache
 
@@ -176,6 +177,95 @@ class CrossmapSearchBatchTests(unittest.TestCase):
             if len(result[i]["targets"]) > 1:
                 self.assertTrue(result[i]["targets"][1] in dataset_docs)
 
+    def test_file_targets_iter(self):
+        """search results can be streamed from a generator"""
+
+        crossmap = self.crossmap
+        docs_file = crossmap.settings.data.collections["documents"]
+        expected = crossmap.search_file(docs_file, "targets", 2)
+        result = crossmap.search_file_iter(docs_file, "targets", 2)
+        self.assertFalse(type(result) is list)
+        self.assertEqual(list(result), expected)
+
+    def test_file_targets_iter_streams(self):
+        """search results are available before the whole file is read"""
+
+        crossmap = self.crossmap
+        docs_file = join(data_dir, "crossmap-testing-stream.yaml")
+        with open(docs_file, "wt") as f:
+            for i in range(file_batch_size + 1):
+                f.write("Q" + str(i) + ":\n  data: Alice Bob\n")
+            # a malformed document at the end of the file
+            f.write("broken:\n  data: [unclosed\n")
+        try:
+            result = crossmap.search_file_iter(docs_file, "targets", 2)
+            first = next(result)
+            self.assertEqual(first["query"], "Q0")
+            with self.assertRaises(Exception):
+                list(result)
+        finally:
+            remove(docs_file)
+
+    def test_file_targets_workers(self):
+        """search with worker processes gives results in input order"""
+
+        crossmap = self.crossmap
+        docs_file = crossmap.settings.data.collections["documents"]
+        expected = crossmap.search_file(docs_file, "targets", 2)
+        result = crossmap.search_file(docs_file, "targets", 2, workers=2)
+        self.assertEqual(len(result), len(expected))
+        # (targets with tied distances can appear in either order)
+        for r, e in zip(result, expected):
+            self.assertEqual(r["query"], e["query"])
+            for r_d, e_d in zip(r["distances"], e["distances"]):
+                self.assertAlmostEqual(r_d, e_d)
+            last = max(e["distances"], default=0) - 1e-6
+            r_closer = [t for t, d in zip(r["targets"], r["distances"])
+                          if d < last]
+            e_closer = [t for t, d in zip(e["targets"], e["distances"])
+                          if d < last]
+            self.assertEqual(set(r_closer), set(e_closer))
+
+    def test_search_batch_matches_search(self):
+        """batch search should give same results as individual searches"""
+
+        docs = [dataset_docs["A"], dict(data=""), dataset_docs["B"]]
+        result = self.crossmap.search_batch(docs, "targets", n=2,
+                                            query_names=["A", "empty", "B"])
+        self.assertEqual(len(result), 3)
+        self.assertEqual([_["query"] for _ in result], ["A", "empty", "B"])
+        self.assertEqual(len(result[1]["targets"]), 0)
+        for i in [0, 2]:
+            expected = self.crossmap.search(docs[i], "targets", n=2)
+            self.assertEqual(result[i]["targets"], expected["targets"])
+
+    def test_search_several_datasets(self):
+        """search across datasets merges hits into one ranking"""
+
+        doc = dict(data="C D")
+        targets = self.crossmap.search(doc, "targets", n=3)
+        documents = self.crossmap.search(doc, "documents", n=3)
+        result = self.crossmap.search(doc, n=3,
+                                      datasets=["targets", "documents"])
+        self.assertEqual(len(result["targets"]), 3)
+        self.assertEqual(len(result["datasets"]), 3)
+        self.assertEqual(sorted(result["distances"]), result["distances"])
+        expected = sorted(targets["distances"] + documents["distances"])
+        for r_d, e_d in zip(result["distances"], expected[:3]):
+            self.assertAlmostEqual(r_d, e_d)
+        for target, label in zip(result["targets"], result["datasets"]):
+            self.assertTrue(self.crossmap.db.has_id(label, target))
+
+    def test_search_all_datasets(self):
+        """search can look for targets in all datasets"""
+
+        docs = [dataset_docs["A"], dict(data="")]
+        result = self.crossmap.search_batch(docs, n=2, datasets="all")
+        self.assertEqual(len(result[0]["targets"]), 2)
+        self.assertEqual(result[1]["datasets"], [])
+        self.assertEqual(result[0]["targets"][0], "A")
+        self.assertEqual(result[0]["datasets"][0], "targets")
+
     def test_complains_improper_filed(self):
         """should raise if data file has improper content"""
 
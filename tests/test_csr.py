@@ -11,6 +11,7 @@ from crossmap.csr import \
     normalize_csr, \
     threshold_csr, \
     dimcollapse_csr, \
+    dense_on_support, \
     add_sparse_skip, \
     harmonic_multiply_sparse, \
     max_multiply_sparse
@@ -135,6 +136,15 @@ class CsrDimensionalCollapseTests(unittest.TestCase):
         self.assertListEqual(list(sparse_to_dense(result)), expected)
         self.assertEqual(result.shape, (1, 8))
 
+    def test_dense_on_support(self):
+        """extract values at selected dimensions"""
+
+        a = csr_matrix([0.0, 0.1, 0.5, 0.0,
+                        0.9, 0.0, 0.0, 0.4])
+        values, present = dense_on_support(a, array([0, 1, 4, 5, 7]))
+        self.assertListEqual(list(values), [0.0, 0.1, 0.9, 0.0, 0.4])
+        self.assertListEqual(list(present), [False, True, True, False, True])
+
     def test_normalized_collapse(self):
         """collapse to dimension, with global rescaling/normalization"""
 
@@ -264,3 +264,72 @@ class CrossmapMongoDBQueriesTests(unittest.TestCase):
 
         self.assertDictEqual(self.db.ids("targets", [0]), {0: "a_target"})
 
+
+class CrossmapMongoDBVectorStoreTests(unittest.TestCase):
+    """Data vectors held in local files beside the db"""
+
+    def setUp(self):
+        self.settings = CrossmapSettings(config_plain, create_dir=True)
+        self.db = CrossmapMongoDB(self.settings)
+        self.db.register_dataset("targets")
+        self.db.set_feature_map(test_feature_map)
+        self.data = [csr_matrix([0.0, 0.0, 1.0, 0.0]),
+                     csr_matrix([0.0, 2.0, 0.0, 0.5]),
+                     csr_matrix([1.0, 0.0, 0.0, 0.0])]
+        self.db.add_data("targets", self.data[:2], ["a", "b"])
+
+    def tearDown(self):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_store_files(self):
+        """adding data writes files with vectors"""
+
+        prefix = self.settings.vectors_file("targets")
+        self.assertTrue(exists(prefix + ".data"))
+        store = self.db._vector_store(self.db.datasets["targets"])
+        self.assertEqual(len(store), 2)
+        self.db.add_data("targets", self.data[2:], ["c"])
+        self.assertEqual(len(store), 3)
+
+    def test_get_data_from_store(self):
+        """vectors from the store match the db"""
+
+        self.db.add_data("targets", self.data[2:], ["c"])
+        result = self.db.get_data("targets", ids=["c", "a", "z"])
+        self.assertListEqual([_["idx"] for _ in result], [2, 0])
+        self.assertListEqual(list(result[1]["data"].toarray()[0]),
+                             [0.0, 0.0, 1.0, 0.0])
+        all_data = list(self.db.all_data("targets"))
+        self.assertListEqual([_["id"] for _ in all_data], ["a", "b", "c"])
+        self.assertListEqual(list(all_data[1]["data"].toarray()[0]),
+                             [0.0, 2.0, 0.0, 0.5])
+
+    def test_store_rebuilt_from_db(self):
+        """a missing store is recreated from the db when adding data"""
+
+        targets = self.db.datasets["targets"]
+        self.db._remove_vector_stores(dict(targets=targets))
+        db = CrossmapMongoDB(self.settings)
+        # reading data uses the db, and does not create a store
+        result = db.get_data("targets", idxs=[1])
+        self.assertEqual(result[0]["id"], "b")
+        self.assertListEqual(list(result[0]["data"].toarray()[0]),
+                             [0.0, 2.0, 0.0, 0.5])
+        self.assertEqual([_["id"] for _ in db.all_data("targets")],
+                         ["a", "b"])
+        prefix = self.settings.vectors_file("targets")
+        self.assertFalse(exists(prefix + ".ids"))
+        # adding data fills a new store with all the vectors
+        db.add_data("targets", self.data[2:], ["c"])
+        self.assertTrue(exists(prefix + ".ids"))
+        self.assertEqual(len(db._vector_store(targets)), 3)
+        result = db.get_data("targets", ids=["b"])
+        self.assertListEqual(list(result[0]["data"].toarray()[0]),
+                             [0.0, 2.0, 0.0, 0.5])
+
+    def test_remove_dataset(self):
+        """removing a dataset removes its store"""
+
+        self.db.remove_dataset("targets")
+        prefix = self.settings.vectors_file("targets")
+        self.assertFalse(exists(prefix + ".data"))
@@ -3,12 +3,21 @@ Tests for obtaining feature co-occurance and diffusing vectors
 """
 
 import unittest
-from os.path import join
+from glob import glob
+from os.path import join, exists
 from crossmap.settings import CrossmapSettings
 from crossmap.indexer import CrossmapIndexer
 from crossmap.diffuser import CrossmapDiffuser
 from crossmap.tokenizer import CrossmapTokenizer, CrossmapDiffusionTokenizer
-from crossmap.diffuser import _pass_weights
+from crossmap.diffuser import _pass_weights, counts_product, counts_rows
+from crossmap.diffuser import diffusion_row
+from crossmap.cache import CrossmapCache
+from crossmap.countsmatrix import counts_matrix_files
+from crossmap.sparsevector import Sparsevector
+from crossmap.vectors import sign_norm_vec
+from numpy import allclose
+from numpy.linalg import norm
+from scipy.sparse import csr_matrix, vstack
 from .tools import remove_crossmap_cache
 from crossmap.vectors import sparse_to_dense
 from crossmap.distance import euc_dist
@@ -44,6 +53,38 @@ class CrossmapDiffuserBuildTests(unittest.TestCase):
         self.assertEqual(self.db.count_rows("targets", "counts"), n)
         self.assertEqual(self.db.count_rows("documents", "counts"), n)
 
+    def test_diffuser_build_adds_diffusion_rows(self):
+        """diffusion tables hold counts prepared for diffusion"""
+
+        n = len(self.feature_map)
+        self.assertEqual(self.db.count_rows("targets", "diffusion"), n)
+        alice_idx = self.feature_map["alice"][0]
+        counts = self.db.get_counts_arrays("targets", [alice_idx])
+        data, indices = counts[alice_idx]
+        expected = diffusion_row(data, indices, alice_idx,
+                                 self.diffuser.feature_weights)
+        result = self.db.get_diffusion_arrays("targets", [alice_idx])
+        self.assertListEqual(list(result[alice_idx][1]), list(indices))
+        self.assertTrue(allclose(result[alice_idx][0], expected))
+
+    def test_diffuser_build_saves_diffusion_matrix(self):
+        """build writes a memory-mapped matrix consistent with the db"""
+
+        settings = self.diffuser.settings
+        files = counts_matrix_files(settings.diffusion_file("targets"))
+        for f in files:
+            self.assertTrue(exists(f))
+        n = len(self.feature_map)
+        idxs = list(range(n))
+        mapped = self.db.get_diffusion_arrays("targets", idxs)
+        dataset = self.db.datasets["targets"]
+        stored = self.db._get_rows_arrays("diffusion", CrossmapCache(n),
+                                          dataset, idxs)
+        self.assertEqual(len(mapped), n)
+        for i in idxs:
+            self.assertListEqual(list(mapped[i][1]), list(stored[i][1]))
+            self.assertTrue(allclose(mapped[i][0], stored[i][0]))
+
     def test_retrieve_counts(self):
         """extract counts from db for one feature"""
 
@@ -133,6 +174,26 @@ class CrossmapDiffuserBuildTests(unittest.TestCase):
         self.assertEqual(doc_data.toarray()[0][with_idx], 0.0)
         self.assertGreater(array2[with_idx], array1[with_idx])
 
+    def test_diffuse_batch(self):
+        """diffuse several vectors at once, consistent with diffuse"""
+
+        docs = [{"data": "alice"}, {"data": "bob"}, {"data": ""},
+                {"data": "alice with a"}]
+        vectors = [self.encoder.document(_) for _ in docs]
+        strength = dict(targets=1, documents=0.5)
+        result = self.diffuser.diffuse_batch(vstack(vectors, format="csr"),
+                                             dict(strength))
+        self.assertEqual(result.shape, (4, len(self.feature_map)))
+        # empty vectors remain empty
+        self.assertEqual(result[2].nnz, 0)
+        for i in [0, 1, 3]:
+            expected = self.diffuser.diffuse(vectors[i], dict(strength))
+            self.assertListEqual(list(result[i].indices),
+                                 list(expected.indices))
+            self.assertTrue(allclose(result[i].data, expected.data))
+            self.assertAlmostEqual(norm(result[i].data), 1.0)
+        self.assertGreater(result[0].nnz, vectors[0].nnz)
+
 
 class CrossmapDiffuserBuildReBuildTests(unittest.TestCase):
     """Managing co-occurance counts"""
@@ -163,6 +224,62 @@ class CrossmapDiffuserBuildReBuildTests(unittest.TestCase):
         after = diffuser.db.count_rows("targets", "counts")
         self.assertEqual(after, before)
 
+    def test_diffuse_without_diffusion_rows(self):
+        """diffusion prepares rows from counts when they are not in db"""
+
+        diffuser = self.diffuser
+        v = self.indexer.encoder.document({"data": "alice"})
+        expected = diffuser.diffuse(v, dict(targets=1))
+        diffuser.db._clear_table("targets", "diffusion")
+        diffuser.db._remove_diffusion_matrices(
+            {"targets": diffuser.db.datasets["targets"]})
+        diffuser.db.diffusion_cache.clear()
+        self.assertEqual(diffuser.db.count_rows("targets", "diffusion"), 0)
+        result = diffuser.diffuse(v, dict(targets=1))
+        self.assertListEqual(list(result.indices), list(expected.indices))
+        self.assertTrue(allclose(result.data, expected.data))
+
+
+class CrossmapDiffuserBuildOutOfCoreTests(unittest.TestCase):
+    """Building counts in several processes with a small memory budget"""
+
+    @classmethod
+    def setUpClass(cls):
+        settings = CrossmapSettings(config_plain, create_dir=True)
+        cls.indexer = CrossmapIndexer(settings)
+        cls.indexer.build()
+        cls.diffuser = CrossmapDiffuser(settings)
+        cls.diffuser.build()
+        cls.nf = len(cls.diffuser.feature_map)
+        cls.expected = cls.diffuser.db.get_counts("targets",
+                                                  list(range(cls.nf)))
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_build_spills(self):
+        """counts are the same when partial counts are merged from files"""
+
+        settings = self.diffuser.settings
+        settings.build.workers = 2
+        settings.build.counts_memory = 0
+        db = self.diffuser.db
+        db.set_counts("targets", [])
+        with self.assertLogs(level="INFO") as cm:
+            self.diffuser._build_counts("targets")
+        # a zero budget leads to many small blocks
+        merge_log = [_ for _ in cm.output if "Merging" in _][0]
+        self.assertGreater(int(merge_log.split(" in ")[1].split(" ")[0]), 2)
+        self.assertEqual(db.count_rows("targets", "counts"), self.nf)
+        result = db.get_counts("targets", list(range(self.nf)))
+        for i in range(self.nf):
+            self.assertAlmostEqual(abs(result[i] - self.expected[i]).sum(),
+                                   0.0)
+        # temporary files are removed
+        prefix = settings.counts_tmp_file("targets")
+        self.assertListEqual(glob(prefix + "*"), [])
+
 
 class CrossmapDiffuserWeightsTests(unittest.TestCase):
     """Checking overlapping tokens do not swamp diffusion"""
@@ -266,3 +383,61 @@ class CrossmapDiffuserMultistep(unittest.TestCase):
         self.assertAlmostEqual(result[1], 3/11)
         self.assertAlmostEqual(result[2], 2/11)
 
+
+class CrossmapDiffuserCountsTests(unittest.TestCase):
+    """Computing co-occurrence counts with matrix products"""
+
+    def setUp(self):
+        self.vectors = [csr_matrix([0.5, -0.2, 0.0, 0.8, 0.0]),
+                        csr_matrix([0.0, 0.4, 0.6, -0.05, -0.3]),
+                        csr_matrix([0.0, 0.0, 0.0, 0.0, 0.0]),
+                        csr_matrix([0.1, 0.0, 0.9, 0.0, 0.0])]
+
+    def expected(self, threshold=0.0):
+        """counts computed one data vector at a time"""
+        result = [Sparsevector() for _ in range(5)]
+        for v in self.vectors:
+            keep = abs(v.data) > threshold
+            indices = v.indices[keep]
+            values = sign_norm_vec(v.data[keep].copy())
+            for i, d in zip(indices, values):
+                result[i].add(indices, values if d > 0 else -values)
+        return [_.to_csr(5).toarray()[0] for _ in result]
+
+    def test_counts_product(self):
+        """matrix products give same counts as vector additions"""
+
+        result = counts_product(self.vectors, 5).toarray()
+        for i, expected in enumerate(self.expected()):
+            self.assertListEqual(list(result[i]), list(expected))
+
+    def test_counts_product_threshold(self):
+        """small values in data vectors can be ignored"""
+
+        result = counts_product(self.vectors, 5, 0.1).toarray()
+        for i, expected in enumerate(self.expected(0.1)):
+            self.assertListEqual(list(result[i]), list(expected))
+
+    def test_counts_product_chunks(self):
+        """counts can be accumulated over several batches"""
+
+        whole = counts_product(self.vectors, 5)
+        parts = counts_product(self.vectors[:1], 5) + \
+            counts_product(self.vectors[1:], 5)
+        self.assertEqual(abs(whole - parts).sum(), 0.0)
+        self.assertEqual(counts_product([], 5).shape, (5, 5))
+
+    def test_counts_rows(self):
+        """rows are thresholded relative to their largest value"""
+
+        counts = csr_matrix([[1.0, 0.05, -0.5, 0.0],
+                             [0.0, 0.0, 0.0, 0.0],
+                             [0.2, 0.3, 0.0, 0.01]])
+        result = counts_rows(counts, 0.1)
+        self.assertEqual(len(result), 3)
+        self.assertListEqual(list(result[0].toarray()[0]),
+                             [1.0, 0.0, -0.5, 0.0])
+        self.assertEqual(len(result[1].data), 0)
+        self.assertListEqual(list(result[2].toarray()[0]),
+                             [0.2, 0.3, 0.0, 0.0])
+        self.assertEqual(len(counts_rows(counts)[0].data), 3)
@@ -5,7 +5,9 @@ Tests for handling distances between vectors
 import unittest
 from numpy import array
 from math import sqrt
-from crossmap.distance import euc_dist, norm_euc_dist
+from scipy.sparse import csr_matrix
+from crossmap.distance import euc_dist, norm_euc_dist, sparse_euc_distances
+from crossmap.distance import sparse_row_distances
 
 
 class DistanceTests(unittest.TestCase):
@@ -27,3 +29,28 @@ class DistanceTests(unittest.TestCase):
         self.assertEqual(neucd(array([0, 2.0]), array([1.0, 0])), sq2)
         self.assertEqual(neucd(array([0, 2.0, 0]), array([1.0, 0, 0])), sq2)
 
+    def test_sparse_distances(self):
+        """distances between all rows of two sparse matrices"""
+
+        a = csr_matrix(array([[0, 1.0, 0], [1.0, 0, 0]]))
+        b = csr_matrix(array([[0, 1.0, 0], [0, 0, 0], [0, 0, 2.0]]))
+        result = sparse_euc_distances(a, b)
+        self.assertEqual(result.shape, (2, 3))
+        self.assertAlmostEqual(result[0, 0], 0.0)
+        self.assertAlmostEqual(result[0, 1], 1.0)
+        self.assertAlmostEqual(result[1, 2], sqrt(5))
+
+    def test_sparse_row_distances(self):
+        """distances between a sparse vector and rows of a csr matrix"""
+
+        q = csr_matrix(array([[0, 1.0, 0, 0.5]]))
+        b = csr_matrix(array([[0, 1.0, 0, 0], [0, 0, 0, 0],
+                              [2.0, 0, 0, 0.5], [0, 1.0, 0, 0.5]]))
+        result = sparse_row_distances(q.indices, q.data,
+                                      b.indptr, b.indices, b.data)
+        expected = sparse_euc_distances(q, b)[0]
+        self.assertEqual(len(result), 4)
+        for r, e in zip(result, expected):
+            self.assertAlmostEqual(r, e)
+        self.assertAlmostEqual(result[3], 0.0)
+
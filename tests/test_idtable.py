@@ -0,0 +1,54 @@
+"""
+Tests for compact tables of string identifiers
+"""
+
+import unittest
+from os.path import join
+from tempfile import TemporaryDirectory
+from crossmap.idtable import IdTable, write_id_table
+
+
+class IdTableTests(unittest.TestCase):
+    """Writing and reading tables of identifiers"""
+
+    def test_round_trip(self):
+        """identifiers are read back in the same order"""
+
+        ids = ["A", "B:12", "", "été", "long-identifier-" * 5]
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "ids")
+            write_id_table(path, ids)
+            table = IdTable(path)
+            self.assertEqual(len(table), len(ids))
+            self.assertEqual([table[_] for _ in range(len(ids))], ids)
+
+    def test_empty(self):
+        """table can be empty"""
+
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "ids")
+            write_id_table(path, [])
+            self.assertEqual(len(IdTable(path)), 0)
+
+    def test_extend(self):
+        """table can hold extra identifiers in memory"""
+
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "ids")
+            write_id_table(path, ["A", "B"])
+            table = IdTable(path)
+            table.extend(["C"])
+            self.assertEqual(len(table), 3)
+            self.assertEqual(table[1], "B")
+            self.assertEqual(table[2], "C")
+
+    def test_replace_file(self):
+        """a mapped table remains readable after the file is replaced"""
+
+        with TemporaryDirectory() as tmp_dir:
+            path = join(tmp_dir, "ids")
+            write_id_table(path, ["A", "B"])
+            table = IdTable(path)
+            write_id_table(path, ["X"])
+            self.assertEqual(table[1], "B")
+            self.assertEqual(IdTable(path)[0], "X")
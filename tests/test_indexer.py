@@ -3,10 +3,16 @@ Tests for turning documents into indexes
 """
 
 import unittest
+from math import sqrt
 from os.path import join, exists
+from scipy.sparse import vstack
 from crossmap.settings import CrossmapSettings
 from crossmap.indexer import CrossmapIndexer
 from crossmap.features import CrossmapFeatures
+from crossmap.invertedindex import InvertedIndex
+from crossmap.projectionindex import ProjectionIndex
+from crossmap.shardedindex import ShardedIndex, sharded_layout, index_files
+from crossmap.idtable import IdTable
 from .tools import remove_crossmap_cache
 
 data_dir = join("tests", "testdata")
@@ -50,6 +56,36 @@ class CrossmapIndexerBuildTests(unittest.TestCase):
         self.assertTrue(exists(self.indexer.index_files["targets"]))
         self.assertTrue(exists(self.indexer.index_files["documents"]))
 
+    def test_indexer_build_ids_table(self):
+        """build writes a table of identifiers used by suggest"""
+
+        self.indexer.build()
+        ids_file = self.indexer.settings.ids_file("targets")
+        self.assertTrue(exists(ids_file))
+        self.indexer.load()
+        doc = {"data_pos": "Alice A"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.suggest(v, "targets", 1)
+        self.assertEqual(nns, ["A"])
+        item_ids = self.indexer.item_ids["targets"]
+        self.assertTrue(type(item_ids) is IdTable)
+        self.assertEqual(list(item_ids), self.indexer.db.all_ids("targets"))
+
+    def test_indexer_build_parallel(self):
+        """build datasets in separate processes"""
+
+        self.indexer.settings.build.workers = 2
+        self.indexer.settings.indexing.threads = 1
+        self.indexer.build()
+        self.assertEqual(len(self.indexer.db.all_ids("targets")), 6)
+        self.assertGreater(len(self.indexer.db.all_ids("documents")), 6)
+        self.assertEqual(len(self.indexer.indexes), 2)
+        self.assertTrue(exists(self.indexer.index_files["documents"]))
+        doc = {"data_pos": "Alice A"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.suggest(v, "targets", 1)
+        self.assertEqual(nns, ["A"])
+
     def test_indexer_load(self):
         """prepared indexes from disk"""
 
@@ -90,6 +126,56 @@ class CrossmapIndexerBuildTests(unittest.TestCase):
         self.assertTrue("Indexes:\t2" in str(self.indexer))
 
 
+class CrossmapIndexerLazyLoadTests(unittest.TestCase):
+    """Loading indexes on first use and within a memory budget"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings = CrossmapSettings(config_plain, create_dir=True)
+        cls.settings.tokens.k = 10
+        CrossmapFeatures(cls.settings, features=test_features)
+        CrossmapIndexer(cls.settings).build()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def setUp(self):
+        self.settings.indexing.lazy_load = 1
+        self.indexer = CrossmapIndexer(self.settings)
+        self.indexer.load()
+        self.doc = {"data_pos": "Alice A"}
+
+    def tearDown(self):
+        self.settings.indexing.lazy_load = 0
+
+    def test_load_is_lazy(self):
+        """indexes are loaded on first use"""
+
+        indexer = self.indexer
+        self.assertEqual(len(indexer.indexes), 0)
+        self.assertEqual(len(indexer.index_files), 2)
+        self.assertTrue(indexer.valid)
+        v = indexer.encode_document(self.doc)
+        nns, distances = indexer.suggest(v, "targets", 1)
+        self.assertEqual(nns, ["A"])
+        self.assertEqual(list(indexer.indexes.keys()), ["targets"])
+
+    def test_memory_budget_evicts_indexes(self):
+        """least-recently used indexes are unloaded to respect a budget"""
+
+        indexer = self.indexer
+        indexer.memory_budget = 1
+        v = indexer.encode_document(self.doc)
+        indexer.suggest(v, "targets", 1)
+        indexer.suggest(v, "documents", 1)
+        self.assertEqual(list(indexer.indexes.keys()), ["documents"])
+        # evicted indexes are loaded again when needed
+        nns, distances = indexer.suggest(v, "targets", 1)
+        self.assertEqual(nns, ["A"])
+        self.assertEqual(list(indexer.indexes.keys()), ["targets"])
+
+
 class CrossmapIndexerSkippingTests(unittest.TestCase):
     """Building index should skip items that have null features vectors"""
 
@@ -185,6 +271,18 @@ class CrossmapIndexerNeighborTests(unittest.TestCase):
         self.assertEqual(nns[0], "A")
         self.assertEqual(nns[1], "B")
 
+    def test_suggest_batch(self):
+        """suggestions for several vectors at once"""
+
+        docs = [{"data": "Alice A B", "data_neg": "unique token"},
+                {"data": "Alice A and Daniel"}]
+        vs = vstack([self.indexer.encode_document(_) for _ in docs])
+        result = self.indexer.suggest_batch(vs, "targets", 2)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0][0], ["A", "B"])
+        self.assertEqual(result[1][0], ["A", "D"])
+        self.assertEqual(len(result[1][1]), 2)
+
     def test_suggest_without_docs(self):
         """make target suggestion without docs"""
 
@@ -197,6 +295,259 @@ class CrossmapIndexerNeighborTests(unittest.TestCase):
         self.assertEqual(len(distances), 0)
 
 
+class CrossmapIndexerRerankTests(unittest.TestCase):
+    """Re-ranking candidates from approximate indexes"""
+
+    @classmethod
+    def setUpClass(cls):
+        settings = CrossmapSettings(config_plain, create_dir=True)
+        settings.tokens.k = 10
+        settings.indexing.search_quality = 1
+        settings.indexing.rerank_factor = 4
+        CrossmapFeatures(settings, features=test_features)
+        cls.indexer = CrossmapIndexer(settings)
+        cls.indexer.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_nn_targets_B(self):
+        """find nearest neighbors among targets with re-ranking"""
+
+        doc = {"data_pos": "Bob Bob Bob Alice Alice unique"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.nearest(v, "targets", 3)
+        self.assertEqual(nns, ["B", "A", "U"])
+        self.assertListEqual(distances, sorted(distances))
+
+    def test_exact_distances(self):
+        """re-ranked distances match exact distances"""
+
+        doc = {"data_pos": "Alice Catherine"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.nearest(v, "targets", 2)
+        self.assertEqual(len(nns), 2)
+        exact, ids = self.indexer.distances(v, "targets", ids=nns)
+        exact = dict(zip(ids, exact))
+        for id, d in zip(nns, distances):
+            self.assertAlmostEqual(d, exact[id] * sqrt(2), places=5)
+
+
+class CrossmapIndexerExactTests(unittest.TestCase):
+    """Mapping vectors into targets using exact inverted indexes"""
+
+    @classmethod
+    def setUpClass(cls):
+        settings = CrossmapSettings(config_plain, create_dir=True)
+        settings.tokens.k = 10
+        settings.indexing.methods = dict(targets="exact", documents="exact")
+        CrossmapFeatures(settings, features=test_features)
+        cls.indexer = CrossmapIndexer(settings)
+        cls.indexer.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_exact_index_type(self):
+        """indexes are created according to settings"""
+
+        self.assertTrue(type(self.indexer.indexes["targets"]) is InvertedIndex)
+
+    def test_nn_targets_B(self):
+        """find nearest neighbors among targets, B"""
+
+        doc = {"data_pos": "Bob Bob Bob Alice Alice unique"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.nearest(v, "targets", 3)
+        self.assertEqual(nns, ["B", "A", "U"])
+
+    def test_suggest_after_load(self):
+        """exact indexes can be loaded from disk"""
+
+        self.indexer.load()
+        self.assertTrue(type(self.indexer.indexes["targets"]) is InvertedIndex)
+        doc = {"data": "Alice A B", "data_neg": "unique token"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.suggest(v, "targets", 2)
+        self.assertEqual(nns, ["A", "B"])
+        doc = {"data": "alpha bravo"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.suggest(v, "targets", 2)
+        self.assertEqual(len(distances), 0)
+
+
+class CrossmapIndexerRebuildTests(unittest.TestCase):
+    """Replacing indexes while they are in use"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.settings = CrossmapSettings(config_plain, create_dir=True)
+        cls.settings.tokens.k = 10
+        CrossmapFeatures(cls.settings, features=test_features)
+        cls.indexer = CrossmapIndexer(cls.settings)
+        cls.indexer.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def suggest_B(self, indexer):
+        doc = {"data_pos": "Bob Bob Bob Alice Alice unique"}
+        v = indexer.encode_document(doc)
+        return indexer.suggest(v, "targets", 3)[0]
+
+    def test_background_rebuild(self):
+        """index is swapped after a rebuild, with search in the meantime"""
+
+        indexer = self.indexer
+        before = indexer.indexes["targets"]
+        thread = indexer.rebuild_index("targets", wait=False)
+        self.assertEqual(self.suggest_B(indexer), ["B", "A", "U"])
+        thread.join()
+        self.assertFalse(indexer.indexes["targets"] is before)
+        self.assertEqual(self.suggest_B(indexer), ["B", "A", "U"])
+        index_file = self.settings.index_file("targets")
+        self.assertFalse(exists(index_file + ".new"))
+
+    def test_reload(self):
+        """indexes rebuilt by another process are picked up"""
+
+        indexer = self.indexer
+        indexer.load()
+        self.assertEqual(indexer.reload(), [])
+        before = indexer.indexes["targets"]
+        # another indexer writes a new index file
+        CrossmapIndexer(self.settings).rebuild_index("targets")
+        self.assertEqual(indexer.reload(), ["targets"])
+        self.assertFalse(indexer.indexes["targets"] is before)
+        self.assertEqual(self.suggest_B(indexer), ["B", "A", "U"])
+        self.assertEqual(indexer.reload(), [])
+
+    def test_reload_during_lazy_load(self):
+        """reload tolerates an index loaded by another thread"""
+
+        indexer = self.indexer
+        indexer.load()
+        indexer.indexes.pop("targets")
+        CrossmapIndexer(self.settings).rebuild_index("targets")
+        lock = indexer.lock
+
+        class LoadingLock:
+            """lock that loads an index just before its first use"""
+            def __init__(self):
+                self.pending = True
+
+            def __enter__(self):
+                if self.pending:
+                    self.pending = False
+                    indexer._get_index("targets")
+                return lock.__enter__()
+
+            def __exit__(self, *args):
+                return lock.__exit__(*args)
+
+        indexer.lock = LoadingLock()
+        try:
+            self.assertEqual(indexer.reload(), ["targets"])
+        finally:
+            indexer.lock = lock
+        self.assertEqual(self.suggest_B(indexer), ["B", "A", "U"])
+        self.assertEqual(indexer.reload(), [])
+
+
+class CrossmapIndexerProjectionTests(unittest.TestCase):
+    """Mapping vectors into targets using dense projection indexes"""
+
+    @classmethod
+    def setUpClass(cls):
+        settings = CrossmapSettings(config_plain, create_dir=True)
+        settings.tokens.k = 10
+        settings.indexing.methods = dict(targets="projection")
+        settings.indexing.projection_dims = 4
+        CrossmapFeatures(settings, features=test_features)
+        cls.indexer = CrossmapIndexer(settings)
+        cls.indexer.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_projection_files(self):
+        """indexes and projections are created according to settings"""
+
+        settings = self.indexer.settings
+        self.assertTrue(type(self.indexer.indexes["targets"])
+                        is ProjectionIndex)
+        for dataset, expected in [("targets", True), ("documents", False)]:
+            files = index_files(settings.index_file(dataset))
+            projection = [_ for _ in files if _.endswith(".projection")]
+            self.assertEqual(exists(projection[0]), expected)
+
+    def test_suggest_after_load(self):
+        """projection indexes can be loaded from disk"""
+
+        self.indexer.load()
+        self.assertTrue(type(self.indexer.indexes["targets"])
+                        is ProjectionIndex)
+        doc = {"data_pos": "Bob Bob Bob Alice Alice unique"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.nearest(v, "targets", 3)
+        self.assertEqual(nns, ["B", "A", "U"])
+
+
+class CrossmapIndexerShardedTests(unittest.TestCase):
+    """Mapping vectors into targets using sharded indexes"""
+
+    @classmethod
+    def setUpClass(cls):
+        settings = CrossmapSettings(config_plain, create_dir=True)
+        settings.tokens.k = 10
+        settings.indexing.shards = dict(targets=3)
+        CrossmapFeatures(settings, features=test_features)
+        cls.indexer = CrossmapIndexer(settings)
+        cls.indexer.build()
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_crossmap_cache(data_dir, "crossmap_simple")
+
+    def test_shard_layout(self):
+        """index files record the shard layout"""
+
+        settings = self.indexer.settings
+        self.assertTrue(type(self.indexer.indexes["targets"]) is ShardedIndex)
+        layout = sharded_layout(settings.index_file("targets"))
+        self.assertEqual(layout["shards"], 3)
+        self.assertIsNone(sharded_layout(settings.index_file("documents")))
+
+    def test_nn_targets_B(self):
+        """find nearest neighbors among targets in several shards"""
+
+        doc = {"data_pos": "Bob Bob Bob Alice Alice unique"}
+        v = self.indexer.encode_document(doc)
+        nns, distances = self.indexer.nearest(v, "targets", 3)
+        self.assertEqual(nns, ["B", "A", "U"])
+
+    def test_load_uses_layout(self):
+        """loading follows the layout on disk rather than settings"""
+
+        indexer = CrossmapIndexer(self.indexer.settings)
+        indexer.settings.indexing.shards = dict()
+        try:
+            indexer.load()
+        finally:
+            indexer.settings.indexing.shards = dict(targets=3)
+        index = indexer._get_index("targets")
+        self.assertTrue(type(index) is ShardedIndex)
+        self.assertEqual(len(index.shards), 3)
+        doc = {"data": "Alice A B", "data_neg": "unique token"}
+        v = indexer.encode_document(doc)
+        nns, distances = indexer.suggest(v, "targets", 2)
+        self.assertEqual(nns, ["A", "B"])
+
+
 class CrossmapIndexerNeighborNoDocsTests(unittest.TestCase):
     """Mapping vectors into targets when document index is missing"""
 
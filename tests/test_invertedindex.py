@@ -0,0 +1,86 @@
+"""
+Tests for exact nearest-neighbor search with an inverted index
+"""
+
+import unittest
+from numpy import array, sqrt, sort, allclose
+from os.path import join
+from scipy.sparse import csr_matrix
+from crossmap.invertedindex import InvertedIndex
+from .tools import remove_cachefile, random_unit_rows
+from .tools import brute_force_distances
+
+
+data_dir = join("tests", "testdata")
+index_file = join(data_dir, "crossmap-testing-inverted-index")
+
+
+class InvertedIndexTests(unittest.TestCase):
+    """Nearest-neighbor queries using posting lists"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = random_unit_rows(400, 80, 0.05, 1)
+        cls.queries = random_unit_rows(20, 80, 0.1, 2)
+        cls.index = InvertedIndex()
+        cls.index.addDataPointBatch(cls.data, list(range(400)))
+        cls.index.createIndex()
+
+    def tearDown(self):
+        remove_cachefile(data_dir, "crossmap-testing-inverted-index")
+
+    def test_size(self):
+        """index reports number of data items"""
+
+        self.assertEqual(len(self.index), 400)
+
+    def test_exact_neighbors(self):
+        """distances match brute-force computation"""
+
+        for i in range(self.queries.shape[0]):
+            q = self.queries[i]
+            expected = sort(brute_force_distances(self.data, q))[:5]
+            ids, distances = self.index.knnQueryBatch(q, 5)[0]
+            self.assertEqual(len(ids), 5)
+            self.assertTrue(allclose(distances, expected, atol=1e-5))
+            direct = brute_force_distances(self.data[ids], q)
+            self.assertTrue(allclose(distances, direct, atol=1e-5))
+
+    def test_query_without_overlap(self):
+        """query without shared features still reports neighbors"""
+
+        q = csr_matrix((array([1.0]), array([150]), array([0, 1])),
+                       shape=(1, 200))
+        ids, distances = self.index.knnQueryBatch(q, 3)[0]
+        self.assertEqual(len(ids), 3)
+        # (data has 80 features, so the query is far from all items)
+        self.assertGreaterEqual(float(distances[0]), 1.0)
+        norms = brute_force_distances(self.data, csr_matrix((1, 80)))
+        expected = sort(sqrt(1 + norms**2))[:3]
+        self.assertTrue(allclose(distances, expected, atol=1e-5))
+
+    def test_save_load(self):
+        """index can be saved and loaded from disk"""
+
+        self.index.saveIndex(index_file)
+        loaded = InvertedIndex()
+        loaded.loadIndex(index_file)
+        self.assertEqual(len(loaded), 400)
+        q = self.queries[0]
+        ids_a, d_a = self.index.knnQueryBatch(q, 4)[0]
+        ids_b, d_b = loaded.knnQueryBatch(q, 4)[0]
+        self.assertListEqual(list(ids_a), list(ids_b))
+
+    def test_extend_index(self):
+        """additional data items can be merged into an existing index"""
+
+        index = InvertedIndex()
+        index.addDataPointBatch(self.data[:300], list(range(300)))
+        index.createIndex()
+        index.addDataPointBatch(self.data[300:], list(range(300, 400)))
+        index.createIndex()
+        self.assertEqual(len(index), 400)
+        q = self.data[350]
+        ids, distances = index.knnQueryBatch(q, 1)[0]
+        self.assertEqual(int(ids[0]), 350)
+        self.assertAlmostEqual(float(distances[0]), 0.0, places=5)
@@ -0,0 +1,99 @@
+"""
+Tests for search on dense projections with exact re-ranking
+"""
+
+import unittest
+from numpy import array, allclose, sort
+from os.path import join
+from scipy.sparse import csr_matrix
+from crossmap.projectionindex import ProjectionIndex
+from .tools import remove_cachefile, random_unit_rows
+from .tools import brute_force_distances
+
+
+data_dir = join("tests", "testdata")
+index_file = join(data_dir, "crossmap-testing-projection-index")
+
+
+class ProjectionIndexTests(unittest.TestCase):
+    """Nearest-neighbor queries using dense projections"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = random_unit_rows(400, 80, 0.05, 1)
+        cls.queries = random_unit_rows(20, 80, 0.1, 2)
+        cls.index = ProjectionIndex(dims=16, candidates=10)
+        cls.index.addDataPointBatch(cls.data, list(range(100, 500)))
+        cls.index.createIndex({"efConstruction": 100})
+        cls.index.setQueryTimeParams({"efSearch": 100})
+
+    def tearDown(self):
+        for suffix in ["", ".dat", ".projection"]:
+            remove_cachefile(data_dir,
+                             "crossmap-testing-projection-index" + suffix)
+
+    def test_size(self):
+        """index reports number of data items and projection size"""
+
+        self.assertEqual(len(self.index), 400)
+        self.assertEqual(self.index.components.shape, (16, 80))
+
+    def test_exact_distances(self):
+        """distances are exact for re-ranked candidates"""
+
+        for i in range(self.queries.shape[0]):
+            q = self.queries[i]
+            ids, distances = self.index.knnQueryBatch(q, 5)[0]
+            self.assertEqual(len(ids), 5)
+            direct = brute_force_distances(self.data[ids - 100], q)
+            self.assertTrue(allclose(distances, direct, atol=1e-5))
+            self.assertListEqual(list(distances), sorted(distances))
+
+    def test_recall(self):
+        """most nearest neighbors are found among candidates"""
+
+        hits = 0
+        for i in range(self.queries.shape[0]):
+            q = self.queries[i]
+            expected = sort(brute_force_distances(self.data, q))[:5]
+            ids, distances = self.index.knnQueryBatch(q, 5)[0]
+            hits += sum(distances <= expected[-1] + 1e-5)
+        self.assertGreater(hits / (5 * self.queries.shape[0]), 0.8)
+
+    def test_wide_query(self):
+        """features absent from the data contribute to distances"""
+
+        q = csr_matrix((array([0.6, 0.8]), array([3, 150]), array([0, 2])),
+                       shape=(1, 200))
+        ids, distances = self.index.knnQueryBatch(q, 3)[0]
+        self.assertEqual(len(ids), 3)
+        narrow = csr_matrix((array([0.6]), array([3]), array([0, 1])),
+                            shape=(1, 80))
+        direct = brute_force_distances(self.data[ids - 100], narrow)
+        self.assertTrue(allclose(distances, (direct**2 + 0.64)**0.5,
+                                 atol=1e-5))
+
+    def test_save_load(self):
+        """index can be saved and loaded from disk"""
+
+        self.index.saveIndex(index_file)
+        loaded = ProjectionIndex()
+        loaded.loadIndex(index_file)
+        loaded.setQueryTimeParams({"efSearch": 100})
+        self.assertEqual(len(loaded), 400)
+        q = self.queries[0]
+        ids_a, d_a = self.index.knnQueryBatch(q, 4)[0]
+        ids_b, d_b = loaded.knnQueryBatch(q, 4)[0]
+        # (items at tied distances can appear in either order)
+        self.assertEqual(int(ids_a[0]), int(ids_b[0]))
+        self.assertTrue(allclose(d_a, d_b))
+
+    def test_small_data(self):
+        """a projection can be created for a single data item"""
+
+        index = ProjectionIndex(dims=4)
+        index.addDataPointBatch(self.data[:1], [7])
+        index.createIndex()
+        ids, distances = index.knnQueryBatch(self.data[0], 3)[0]
+        self.assertEqual(list(ids), [7])
+        self.assertAlmostEqual(float(distances[0]), 0.0, places=5)
@@ -0,0 +1,88 @@
+"""
+Tests for search over indexes split into shards
+"""
+
+import unittest
+import nmslib
+from numpy import allclose, sort
+from os.path import join, exists
+from crossmap.invertedindex import InvertedIndex
+from crossmap.shardedindex import ShardedIndex, sharded_layout, shard_path
+from crossmap.shardedindex import index_files
+from .tools import remove_file, random_unit_rows, brute_force_distances
+
+
+data_dir = join("tests", "testdata")
+index_file = join(data_dir, "crossmap-testing-sharded-index")
+
+
+def new_hnsw():
+    return nmslib.init(method="hnsw", space="l2_sparse",
+                       data_type=nmslib.DataType.SPARSE_VECTOR)
+
+
+class ShardedIndexTests(unittest.TestCase):
+    """Nearest-neighbor queries over several shards"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = random_unit_rows(300, 80, 0.05, 1)
+        cls.queries = random_unit_rows(10, 80, 0.1, 2)
+        cls.index = ShardedIndex(InvertedIndex, shards=3, method="exact")
+        cls.index.addDataPointBatch(cls.data, list(range(300)))
+        cls.index.createIndex()
+
+    def tearDown(self):
+        remove_file(index_files(index_file))
+
+    def test_size(self):
+        """items are spread across shards"""
+
+        self.assertEqual(len(self.index), 300)
+        self.assertEqual([len(_) for _ in self.index.shards], [100, 100, 100])
+
+    def test_merged_neighbors(self):
+        """hits from several shards are merged into one ranking"""
+
+        for i in range(self.queries.shape[0]):
+            q = self.queries[i]
+            expected = sort(brute_force_distances(self.data, q))[:5]
+            ids, distances = self.index.knnQueryBatch(q, 5)[0]
+            self.assertEqual(len(ids), 5)
+            self.assertTrue(allclose(distances, expected, atol=1e-5))
+
+    def test_save_load(self):
+        """index and layout can be saved and loaded from disk"""
+
+        self.index.saveIndex(index_file)
+        layout = sharded_layout(index_file)
+        self.assertEqual(layout["shards"], 3)
+        self.assertEqual(layout["method"], "exact")
+        self.assertTrue(exists(shard_path(index_file, 2)))
+        loaded = ShardedIndex(InvertedIndex, shards=3)
+        loaded.loadIndex(index_file)
+        self.assertEqual(len(loaded), 300)
+        q = self.queries[0]
+        ids_a, d_a = self.index.knnQueryBatch(q, 4)[0]
+        ids_b, d_b = loaded.knnQueryBatch(q, 4)[0]
+        self.assertListEqual(list(ids_a), list(ids_b))
+
+    def test_hnsw_shards(self):
+        """shards can hold approximate indexes, including empty shards"""
+
+        index = ShardedIndex(new_hnsw, shards=4)
+        index.addDataPointBatch(self.data[:30], list(range(0, 90, 3)))
+        index.createIndex({"efConstruction": 100})
+        index.setQueryTimeParams({"efSearch": 100})
+        # labels are multiples of three, so one shard is empty
+        self.assertEqual(len(index), 30)
+        ids, distances = index.knnQueryBatch(self.data[3], 2)[0]
+        self.assertEqual(int(ids[0]), 9)
+        self.assertAlmostEqual(float(distances[0]), 0.0, places=5)
+
+    def test_layout_of_plain_file(self):
+        """files that do not describe shards do not have a layout"""
+
+        InvertedIndex().saveIndex(index_file)
+        self.assertIsNone(sharded_layout(index_file))
+        self.assertIsNone(sharded_layout(index_file + ".missing"))
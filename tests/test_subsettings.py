@@ -14,6 +14,7 @@ from crossmap.subsettings import \
     CrossmapFeatureSettings, \
     CrossmapTokenSettings, \
     CrossmapIndexingSettings, \
+    CrossmapBuildSettings, \
     CrossmapServerSettings, \
     CrossmapDiffusionSettings, \
     CrossmapCacheSettings
@@ -169,12 +170,104 @@ class CrossmapIndexingSettingsTests(unittest.TestCase):
         self.assertEqual(self.default.search_quality, 200)
         self.assertEqual(self.custom.search_quality, 100)
 
+    def test_threads(self):
+        """parsing number of threads for nmslib"""
+
+        self.assertEqual(self.default.threads, 0)
+        custom = CrossmapIndexingSettings({"threads": 4})
+        self.assertEqual(custom.threads, 4)
+
+    def test_buffer_size(self):
+        """parsing size of buffer for items added after build"""
+
+        self.assertEqual(self.default.buffer_size, 1000)
+        custom = CrossmapIndexingSettings({"buffer_size": 10})
+        self.assertEqual(custom.buffer_size, 10)
+
+    def test_methods(self):
+        """parsing indexing methods for specific datasets"""
+
+        self.assertEqual(self.default.methods, dict())
+        custom = CrossmapIndexingSettings({"methods": {"targets": "exact"}})
+        self.assertEqual(custom.methods["targets"], "exact")
+
+    def test_rerank(self):
+        """parsing settings for projection indexes and re-ranking"""
+
+        self.assertEqual(self.default.rerank_factor, 1)
+        custom = CrossmapIndexingSettings({"rerank_factor": 5,
+                                           "projection_dims": 32,
+                                           "projection_candidates": 8})
+        self.assertEqual(custom.rerank_factor, 5)
+        self.assertEqual(custom.projection_dims, 32)
+        self.assertEqual(custom.projection_candidates, 8)
+
+    def test_decompose_pool(self):
+        """parsing settings for candidate pools in decompositions"""
+
+        self.assertEqual(self.default.decompose_pool, 0)
+        custom = CrossmapIndexingSettings({"decompose_pool": 20})
+        self.assertEqual(custom.decompose_pool, 20)
+        self.assertTrue("decompose_pool" in str(custom))
+
+    def test_background_rebuild(self):
+        """parsing setting for rebuilding indexes"""
+
+        self.assertEqual(self.default.background_rebuild, 1)
+        custom = CrossmapIndexingSettings({"background_rebuild": 0})
+        self.assertEqual(custom.background_rebuild, 0)
+
+    def test_shards(self):
+        """parsing number of shards for specific datasets"""
+
+        self.assertEqual(self.default.shards, dict())
+        custom = CrossmapIndexingSettings({"shards": {"targets": "4"}})
+        self.assertEqual(custom.shards["targets"], 4)
+
+    def test_lazy_load(self):
+        """parsing settings for loading indexes"""
+
+        self.assertEqual(self.default.lazy_load, 0)
+        self.assertEqual(self.default.memory_budget, 0)
+        custom = CrossmapIndexingSettings({"lazy_load": 1,
+                                           "memory_budget": 512})
+        self.assertEqual(custom.lazy_load, 1)
+        self.assertEqual(custom.memory_budget, 512)
+
+    def test_partitions(self):
+        """parsing metadata fields for sub-indexes"""
+
+        self.assertEqual(self.default.partitions, dict())
+        partitions = {"targets": ["year"]}
+        custom = CrossmapIndexingSettings({"partitions": partitions})
+        self.assertEqual(custom.partitions["targets"], ["year"])
+
     def test_str(self):
         """summarize settings in a string"""
 
         self.assertTrue("quality" in str(self.custom))
 
 
+class CrossmapBuildSettingsTests(unittest.TestCase):
+    """Settings related to parallel processing during build"""
+
+    def test_workers(self):
+        """parsing number of build processes"""
+
+        self.assertEqual(CrossmapBuildSettings().workers, 1)
+        custom = CrossmapBuildSettings({"workers": 4})
+        self.assertEqual(custom.workers, 4)
+        self.assertTrue("workers" in str(custom))
+
+    def test_counts_memory(self):
+        """parsing memory budget for building counts"""
+
+        self.assertEqual(CrossmapBuildSettings().counts_memory, 1024)
+        custom = CrossmapBuildSettings({"counts_memory": 256})
+        self.assertEqual(custom.counts_memory, 256)
+        self.assertTrue("counts_memory" in str(custom))
+
+
 class CrossmapServerSettingsTests(unittest.TestCase):
     """Settings related to configuring servers"""
 
@@ -245,6 +338,14 @@ class CrossmapCacheTests(unittest.TestCase):
         self.assertEqual(self.custom.titles, 128)
         self.assertEqual(self.custom.data, 1024)
 
+    def test_results(self):
+        """parsing settings for caching query results"""
+
+        self.assertEqual(self.default.results, 64)
+        custom = CrossmapCacheSettings({"results": 8, "results_ttl": 30})
+        self.assertEqual(custom.results, 8)
+        self.assertEqual(custom.results_ttl, 30)
+
     def test_str(self):
         """settings can be displayed in yaml string"""
 
@@ -5,11 +5,14 @@ Tests for turning datasets into tokens
 import unittest
 import numpy as np
 import yaml
+from contextlib import redirect_stdout
+from io import StringIO
+from json import loads
 from os.path import join, exists
 from crossmap.tools import read_obj, write_obj, write_matrix
 from crossmap.tools import write_csv, read_csv_set, read_set
 from crossmap.tools import write_dict, read_dict
-from crossmap.tools import yaml_document
+from crossmap.tools import yaml_document, jsonl_print
 from .tools import remove_cachefile
 
 
@@ -157,3 +160,31 @@ class ReadYamlTests(unittest.TestCase):
         self.assertEqual(len(docs), len(result))
         self.assertSetEqual(set(docs.keys()), set(result.keys()))
 
+
+class JsonlPrintTests(unittest.TestCase):
+    """Printing objects as json lines"""
+
+    def test_jsonl_from_generator(self):
+        """items from a generator are printed one per line"""
+
+        def items():
+            for i in range(5):
+                yield dict(query=str(i), targets=[i])
+
+        out = StringIO()
+        with redirect_stdout(out):
+            jsonl_print(items(), flush_interval=2)
+        lines = out.getvalue().strip().split("\n")
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(loads(lines[3]), dict(query="3", targets=[3]))
+
+    def test_jsonl_from_dict(self):
+        """a dict is printed as a single item"""
+
+        item = dict(alpha=[0.5], bravo=[0.25])
+        out = StringIO()
+        with redirect_stdout(out):
+            jsonl_print(item)
+        lines = out.getvalue().strip().split("\n")
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(loads(lines[0]), item)
@@ -10,6 +10,9 @@ from scipy.sparse import csr_matrix, vstack
 from crossmap.vectors import \
     csr_residual, \
     vec_decomposition, \
+    gram_append, \
+    cholesky_append, \
+    gram_decomposition, \
     num_nonzero, \
     all_zero, \
     vec_norm, \
@@ -275,3 +278,44 @@ class SignNormTests(unittest.TestCase):
         a.data = sign_norm_vec(a.data)
         self.assertEqual(len(a.data), 0)
 
+
+class GramDecompositionTests(unittest.TestCase):
+    """decomposition using incremental Gram matrices"""
+
+    def build(self, BT):
+        """add basis vectors one at a time"""
+        gram, factor = np.zeros((0, 0)), np.zeros((0, 0))
+        for k in range(BT.shape[0]):
+            g = BT[:k].dot(BT[k])
+            gamma = BT[k].dot(BT[k])
+            gram = gram_append(gram, g, gamma)
+            if factor is not None:
+                factor = cholesky_append(factor, g, gamma)
+        return gram, factor
+
+    def test_gram_append(self):
+        """incremental Gram matrix matches a direct computation"""
+        BT = np.array([[5.0, 1, 0], [1, 5, 0], [0, 2, 3]])
+        gram, factor = self.build(BT)
+        self.assertTrue(np.allclose(gram, BT.dot(BT.T)))
+        self.assertTrue(np.allclose(factor.dot(factor.T), gram))
+
+    def test_decomp_matches(self):
+        """coefficients are the same as from vec_decomposition"""
+        vT = np.array([[4.0, 4, 1]])
+        BT = np.array([[5.0, 1, 0], [1, 5, 0], [0, 2, 3]])
+        gram, factor = self.build(BT)
+        expected = vec_decomposition(vT, BT)
+        result = gram_decomposition(factor, gram, BT.dot(vT.T))
+        self.assertEqual(result.shape, (3, 1))
+        self.assertTrue(np.allclose(result, expected))
+
+    def test_decomp_dependent(self):
+        """linearly dependent basis vectors fall back to least squares"""
+        vT = np.array([[4.0, 4, 0]])
+        BT = np.array([[5.0, 1, 0], [10, 2, 0]])
+        gram, factor = self.build(BT)
+        self.assertIsNone(factor)
+        expected = vec_decomposition(vT, BT)
+        result = gram_decomposition(factor, gram, BT.dot(vT.T))
+        self.assertTrue(np.allclose(result, expected))
@@ -0,0 +1,165 @@
+"""
+Tests for storing data vectors in memory-mapped files
+"""
+
+import unittest
+from numpy import allclose
+from os.path import join, exists, getsize
+from threading import Thread
+from crossmap.idtable import IdTable
+from crossmap.vectorstore import CrossmapVectorStore, vector_store_files
+from .tools import remove_file, random_unit_rows
+
+
+data_dir = join("tests", "testdata")
+store_path = join(data_dir, "crossmap-testing-vectors")
+
+
+class CrossmapVectorStoreTests(unittest.TestCase):
+    """Appending and reading data vectors"""
+
+    def setUp(self):
+        self.data = random_unit_rows(50, 40, 0.1, 1)
+        self.vectors = [self.data[i] for i in range(50)]
+        self.ids = ["item_" + str(i) for i in range(50)]
+
+    def tearDown(self):
+        remove_file(vector_store_files(store_path))
+
+    def test_empty(self):
+        """a new store creates files and has no rows"""
+
+        store = CrossmapVectorStore(store_path)
+        self.assertEqual(len(store), 0)
+        for f in vector_store_files(store_path):
+            self.assertTrue(exists(f))
+        self.assertListEqual(store.get([0, 1], 40), [])
+        self.assertListEqual(list(store.scan(40)), [])
+
+    def test_append_get(self):
+        """rows can be retrieved by integer index"""
+
+        store = CrossmapVectorStore(store_path)
+        store.append(self.vectors[:20], self.ids[:20])
+        store.append(self.vectors[20:], self.ids[20:])
+        self.assertEqual(len(store), 50)
+        result = store.get([3, 30, 60], 40)
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0]["id"], "item_3")
+        self.assertEqual(result[1]["idx"], 30)
+        self.assertEqual(result[1]["data"].shape, (1, 40))
+        self.assertTrue(allclose(result[0]["data"].toarray(),
+                                 self.data[3].toarray()))
+
+    def test_ids_table(self):
+        """identifiers are held in a table, after a record of additions"""
+
+        store = CrossmapVectorStore(store_path)
+        store.ids_rewrite_min = 10
+        store.append(self.vectors[:10], self.ids[:10])
+        store.append(self.vectors[10:12], self.ids[10:12])
+        table = IdTable(store_path + ".ids")
+        self.assertEqual(len(table), 10)
+        self.assertEqual(table[3], "item_3")
+        self.assertGreater(getsize(store_path + ".ids-added"), 0)
+        self.assertEqual(store.get([11], 40)[0]["id"], "item_11")
+        # many additions are moved into the table
+        for i in range(12, 50):
+            store.append(self.vectors[i:i+1], self.ids[i:i+1])
+        self.assertEqual(len(IdTable(store_path + ".ids")), 50)
+        self.assertEqual(getsize(store_path + ".ids-added"), 0)
+        reopened = CrossmapVectorStore(store_path)
+        self.assertListEqual([_["id"] for _ in reopened.scan(40)], self.ids)
+
+    def test_rows(self):
+        """range reads give a csr matrix"""
+
+        store = CrossmapVectorStore(store_path)
+        store.append(self.vectors, self.ids)
+        result = store.rows(10, 20, 40)
+        self.assertEqual(result.shape, (10, 40))
+        self.assertTrue(allclose(result.toarray(), self.data[10:20].toarray()))
+        self.assertEqual(store.rows(45, 60, 40).shape, (5, 40))
+
+    def test_scan(self):
+        """scans visit all rows in order"""
+
+        store = CrossmapVectorStore(store_path)
+        store.append(self.vectors, self.ids)
+        result = list(store.scan(40, batch_size=7))
+        self.assertListEqual([_["idx"] for _ in result], list(range(50)))
+        self.assertListEqual([_["id"] for _ in result], self.ids)
+        self.assertTrue(allclose(result[49]["data"].toarray(),
+                                 self.data[49].toarray()))
+
+    def test_reopen(self):
+        """a store can be opened again from disk"""
+
+        store = CrossmapVectorStore(store_path)
+        store.append(self.vectors, self.ids)
+        reopened = CrossmapVectorStore(store_path)
+        self.assertEqual(len(reopened), 50)
+        self.assertEqual(reopened.get([7], 40)[0]["id"], "item_7")
+        self.assertTrue(allclose(reopened.rows(0, 50, 40).toarray(),
+                                 self.data.toarray()))
+
+    def test_refresh(self):
+        """a reader picks up rows appended by a writer"""
+
+        writer = CrossmapVectorStore(store_path)
+        writer.append(self.vectors[:10], self.ids[:10])
+        reader = CrossmapVectorStore(store_path)
+        writer.append(self.vectors[10:], self.ids[10:])
+        self.assertEqual(len(reader), 10)
+        reader.refresh()
+        self.assertEqual(len(reader), 50)
+        self.assertEqual(reader.get([40], 40)[0]["id"], "item_40")
+
+    def test_concurrent_refresh(self):
+        """readers in several threads keep identifiers consistent"""
+
+        writer = CrossmapVectorStore(store_path)
+        reader = CrossmapVectorStore(store_path)
+
+        def refresh():
+            for _ in range(20):
+                reader.refresh()
+
+        for i in range(0, 50, 5):
+            writer.append(self.vectors[i:i+5], self.ids[i:i+5])
+            threads = [Thread(target=refresh) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(len(reader), 50)
+        self.assertEqual(len(reader.ids), 50)
+        self.assertListEqual([_["id"] for _ in reader.scan(40)], self.ids)
+
+    def test_incomplete_append(self):
+        """content without row pointers is ignored and later overwritten"""
+
+        store = CrossmapVectorStore(store_path)
+        store.append(self.vectors[:10], self.ids[:10])
+        # simulate an interrupted append, data written without row pointers
+        with open(store_path + ".data", "ab") as f:
+            f.write(b"\x00" * 24)
+        with open(store_path + ".ids-added", "at") as f:
+            f.write('[10, "partial"]\n')
+        reopened = CrossmapVectorStore(store_path)
+        self.assertEqual(len(reopened), 10)
+        reopened.append(self.vectors[10:], self.ids[10:])
+        self.assertEqual(len(CrossmapVectorStore(store_path)), 50)
+        self.assertEqual(reopened.get([10], 40)[0]["id"], "item_10")
+        self.assertEqual(getsize(store_path + ".data"), 8 * self.data.nnz)
+        self.assertTrue(allclose(reopened.rows(0, 50, 40).toarray(),
+                                 self.data.toarray()))
+
+    def test_remove(self):
+        """stores can delete their files"""
+
+        store = CrossmapVectorStore(store_path)
+        store.append(self.vectors, self.ids)
+        store.remove()
+        for f in vector_store_files(store_path):
+            self.assertFalse(exists(f))
@@ -6,7 +6,9 @@ import glob
 from contextlib import suppress
 from os import environ, remove, rmdir
 from os.path import join, exists
+from numpy import sqrt
 from pymongo import MongoClient
+from scipy.sparse import random as sparse_random
 
 
 def remove_file(files):
@@ -40,3 +42,22 @@ def remove_cachefile(dir, filename):
     filepath = join(dir, filename)
     remove_file([filepath])
 
+
+def random_unit_rows(n, m, density, seed):
+    """create a matrix with rows of unit norm and mixed-sign values"""
+
+    result = sparse_random(n, m, density=density, format="csr",
+                           random_state=seed)
+    result.data -= 0.4
+    for i in range(n):
+        start, end = result.indptr[i], result.indptr[i+1]
+        norm = sqrt((result.data[start:end]**2).sum())
+        if norm > 0:
+            result.data[start:end] /= norm
+    return result
+
+
+def brute_force_distances(data, v):
+    """l2 distances between a vector and all rows in a matrix"""
+
+    return sqrt(((data.toarray() - v.toarray())**2).sum(axis=1))